@@ -0,0 +1,95 @@
+import json
+import gzip
+import time
+import argparse
+
+from preprocess._tokenizer import Indexlizer, CLEAN_STR_TABLE
+from preprocess._stop_words import ENGLISH_STOP_WORDS
+from preprocess.divide_and_create_example_word import clean_str
+from benchmarks.synthetic import make_sized_corpus
+
+"""
+NOTE:
+    - Tokens/sec of the word indexing: `python -m benchmarks.bench_indexlizer --size small`
+    - The reference is what `Indexlizer.transform` did before: `clean_str`, `str.split`, then a loop over the tokens
+    with three dict probes (`reference_transform`). Target speedup is 10x.
+    - "tokens": the lookup table (`pd.Index`) on already tokenized reviews, same tokenization as the reference.
+    - "bytes": `Indexlizer.encode` with `CLEAN_STR_TABLE`, tokenization and lookup are done on the joined bytes,
+    tokens up to 16 bytes are looked up as two uint64 words in an open addressing table.
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="small")
+    parser.add_argument("--work_dir", default="./datasets/benchmarks/")
+    parser.add_argument("--max_len", default=60, type=int)
+    parser.add_argument("--repeats", default=3, type=int)
+    parser.add_argument("--target", default=10., type=float)
+    parser.add_argument("--out", default=None)
+
+    args = parser.parse_args()
+
+    return args
+
+def reference_transform(indexlizer, reviews, max_len):
+    list_of_tokens = indexlizer._list_of_str_to_list_of_tokens(reviews)
+    oov = {w:i for i, w in enumerate(indexlizer._vocab._oov)}
+    sws = {w: i for i, w in enumerate(indexlizer._vocab._stop_words)}
+    unk_id = indexlizer._token2id[indexlizer._unk_token]
+
+    review_ids = []
+    for tokens in list_of_tokens:
+        token_ids = []
+        for tok in tokens:
+            if tok in oov:
+                token_ids.append(unk_id)
+            elif tok in sws:
+                continue
+            elif tok in indexlizer._token2id:
+                token_ids.append(indexlizer._token2id[tok])
+            else:
+                token_ids.append(unk_id)
+        review_ids.append(indexlizer._pad_and_truncate_sequence(token_ids, max_len))
+    return review_ids
+
+def tokens_transform(indexlizer, reviews, max_len):
+    token_ids, lengths = indexlizer._encode_tokens(indexlizer._list_of_str_to_list_of_tokens(reviews))
+    return indexlizer._pad_flat(token_ids, lengths, max_len)
+
+def bytes_transform(indexlizer, reviews, max_len):
+    return indexlizer.encode(reviews, max_len)[0]
+
+def best_time(func, repeats, *args):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+if __name__ == "__main__":
+    args = parse_args()
+    with gzip.open(make_sized_corpus(args.size, f"{args.work_dir}/{args.size}")) as f:
+        reviews = [json.loads(line)["reviewText"] for line in f]
+
+    indexlizer = Indexlizer(reviews, special_tokens=["<pad>", "<unk>"], preprocessor=clean_str, mode="word",
+                            stop_words=ENGLISH_STOP_WORDS, max_len=args.max_len, byte_table=CLEAN_STR_TABLE)
+    num_tokens = sum(len(clean_str(rev).split()) for rev in reviews)
+    reference = reference_transform(indexlizer, reviews, args.max_len)
+    assert tokens_transform(indexlizer, reviews, args.max_len).tolist() == reference
+    assert bytes_transform(indexlizer, reviews, args.max_len).tolist() == reference
+
+    reference_time = best_time(reference_transform, args.repeats, indexlizer, reviews, args.max_len)
+    results = {"size": args.size, "num_reviews": len(reviews), "num_tokens": num_tokens,
+                "reference_tokens_per_sec": num_tokens / reference_time}
+    print(f"reference: {results['reference_tokens_per_sec']:.0f} tokens/s")
+    for name, func in [("tokens", tokens_transform), ("bytes", bytes_transform)]:
+        total_time = best_time(func, args.repeats, indexlizer, reviews, args.max_len)
+        results[name] = {"tokens_per_sec": num_tokens / total_time, "speedup": reference_time / total_time}
+        print(f"{name}: {results[name]}")
+    print(f"speedup {results['bytes']['speedup']:.1f}x, target {args.target:.0f}x: "
+          f"{'ok' if results['bytes']['speedup'] >= args.target else 'missed'}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,91 @@
+import json
+import gzip
+import time
+import argparse
+from itertools import islice
+
+from preprocess._tokenizer import get_sent_splitter
+from benchmarks.synthetic import make_sized_corpus
+
+"""
+NOTE:
+    - Throughput of the sentence splitters of `Indexlizer.transform2sent`, and how often "regex" agrees
+    with "punkt", on a real corpus: `python -m benchmarks.bench_sent_splitter --data_path reviews_Toys_and_Games_5.json.gz`
+    - Agreement is measured on sentence start offsets: precision/recall of the regex boundaries against the Punkt
+    ones, and the fraction of reviews split exactly the same.
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", default=None, help="json.gz reviews, default to the tiny synthetic corpus")
+    parser.add_argument("--max_reviews", default=50000, type=int)
+    parser.add_argument("--splitters", default="punkt,regex")
+    parser.add_argument("--reference", default="punkt")
+    parser.add_argument("--out", default=None)
+
+    args = parser.parse_args()
+
+    return args
+
+def load_reviews(path, max_reviews):
+    with gzip.open(path) as f:
+        return [json.loads(line)["reviewText"] for line in islice(f, max_reviews)]
+
+def sent_starts(text, sents):
+    starts = set()
+    cursor = 0
+    for sent in sents:
+        pos = text.find(sent, cursor)
+        if pos < 0:
+            continue
+        if pos > 0:
+            starts.add(pos)
+        cursor = pos + len(sent)
+    return starts
+
+def agreement(reviews, ref_sents, sents):
+    true_pos = pred_num = ref_num = exact = 0
+    for text, ref, pred in zip(reviews, ref_sents, sents):
+        ref_starts = sent_starts(text, ref)
+        pred_starts = sent_starts(text, pred)
+        true_pos += len(ref_starts & pred_starts)
+        ref_num += len(ref_starts)
+        pred_num += len(pred_starts)
+        exact += ref_starts == pred_starts
+    precision = true_pos / pred_num if pred_num > 0 else 1.
+    recall = true_pos / ref_num if ref_num > 0 else 1.
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.
+    return {"precision": precision, "recall": recall, "f1": f1, "exact_match": exact / len(reviews)}
+
+if __name__ == "__main__":
+    args = parse_args()
+    data_path = args.data_path if args.data_path is not None else make_sized_corpus("tiny", "./datasets/benchmarks/tiny")
+    reviews = load_reviews(data_path, args.max_reviews)
+
+    results = {"data_path": data_path, "num_reviews": len(reviews)}
+    outputs = {}
+    for name in args.splitters.split(","):
+        try:
+            splitter = get_sent_splitter(name)
+        except LookupError as exc:
+            # e.g. the Punkt model is not downloaded
+            results[name] = {"error": next(line.strip() for line in str(exc).split("\n") if line.strip("* "))}
+            print(f"{name}: {results[name]}")
+            continue
+        start_time = time.perf_counter()
+        outputs[name] = [splitter(rev) for rev in reviews]
+        total_time = time.perf_counter() - start_time
+        results[name] = {"seconds": total_time, "reviews_per_sec": len(reviews) / total_time,
+                         "sents_per_review": sum(map(len, outputs[name])) / len(reviews)}
+        print(f"{name}: {results[name]}")
+
+    if args.reference in outputs:
+        for name, sents in outputs.items():
+            if name == args.reference:
+                continue
+            results[name]["agreement"] = agreement(reviews, outputs[args.reference], sents)
+            print(f"{name} vs {args.reference}: {results[name]['agreement']}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,56 @@
+import sys
+import json
+import gzip
+import pickle
+import argparse
+
+from preprocess._tokenizer import Indexlizer
+from preprocess._stop_words import ENGLISH_STOP_WORDS
+from preprocess.divide_and_create_example_word import clean_str
+from benchmarks.synthetic import make_sized_corpus
+
+"""
+NOTE:
+    - Size regression check of the persisted `Indexlizer`: `python -m benchmarks.check_vocab_size`
+    - The pickled indexlizer must scale with the vocab, not with the corpus it was built on: it is built on corpora
+    of increasing sizes and the bytes per vocab entry must stay under `--max_bytes_per_token`. Exits with 1 otherwise.
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="tiny,small")
+    parser.add_argument("--work_dir", default="./datasets/benchmarks/")
+    parser.add_argument("--max_bytes_per_token", default=32., type=float)
+
+    args = parser.parse_args()
+
+    return args
+
+def load_reviews(path):
+    with gzip.open(path) as f:
+        return [json.loads(line)["reviewText"] for line in f]
+
+def indexlizer_size(reviews, keep_corpus):
+    indexlizer = Indexlizer(reviews, special_tokens=["<pad>", "<unk>"], preprocessor=clean_str, mode="word",
+                            stop_words=ENGLISH_STOP_WORDS, max_len=60, keep_corpus=keep_corpus)
+    indexlizer.transform(reviews)
+    build_bytes = len(pickle.dumps(indexlizer))
+    frozen_bytes = len(pickle.dumps(indexlizer.freeze()))
+    return len(indexlizer._vocab), build_bytes, frozen_bytes
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    failed = False
+    for size in args.sizes.split(","):
+        reviews = load_reviews(make_sized_corpus(size, f"{args.work_dir}/{size}"))
+        vocab_size, build_bytes, frozen_bytes = indexlizer_size(reviews, keep_corpus=True)
+        _, _, default_bytes = indexlizer_size(reviews, keep_corpus=False)
+        bytes_per_token = max(frozen_bytes, default_bytes) / vocab_size
+        ok = bytes_per_token <= args.max_bytes_per_token
+        failed = failed or not ok
+        print(json.dumps({"size": size, "num_reviews": len(reviews), "vocab_size": vocab_size, "keep_corpus_bytes": build_bytes,
+                          "frozen_bytes": frozen_bytes, "default_bytes": default_bytes,
+                          "bytes_per_token": round(bytes_per_token, 2), "ok": ok}))
+
+    sys.exit(1 if failed else 0)
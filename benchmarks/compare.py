@@ -0,0 +1,66 @@
+import json
+import argparse
+
+"""
+NOTE:
+    - Compare two json reports of `benchmarks/run_benchmarks.py`, e.g. before and after a commit:
+    `python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json`
+    - Only timings (seconds, lower is better) and throughputs (`*_per_sec`, higher is better) are compared,
+    `speedup` > 1 means the new run is faster.
+"""
+
+def flatten(report, prefix=""):
+    flat = {}
+    for key, val in report.items():
+        name = f"{prefix}/{key}" if prefix else key
+        if isinstance(val, dict):
+            if "median" in val:
+                flat[name] = val["median"]
+            else:
+                flat.update(flatten(val, name))
+        elif isinstance(val, float):
+            flat[name] = val
+    return flat
+
+def is_throughput(name):
+    return name.endswith("_per_sec")
+
+def compare(old_report, new_report):
+    old_flat = flatten(old_report["results"])
+    new_flat = flatten(new_report["results"])
+
+    rows = []
+    for name in old_flat:
+        if name not in new_flat or old_flat[name] == 0 or new_flat[name] == 0:
+            continue
+        if is_throughput(name):
+            speedup = new_flat[name] / old_flat[name]
+        else:
+            speedup = old_flat[name] / new_flat[name]
+        rows.append((name, old_flat[name], new_flat[name], speedup))
+    return rows
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", default=0.05, type=float, help="only print changes larger than this ratio")
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    with open(args.old, "r") as f:
+        old_report = json.load(f)
+    with open(args.new, "r") as f:
+        new_report = json.load(f)
+
+    print("old: {} ({}), new: {} ({})".format(old_report["env"]["commit"], old_report["env"]["time"],
+                                              new_report["env"]["commit"], new_report["env"]["time"]))
+    print("{:60} {:>12} {:>12} {:>8}".format("metric", "old", "new", "speedup"))
+    for name, old_val, new_val, speedup in compare(old_report, new_report):
+        if abs(speedup - 1.) < args.threshold:
+            continue
+        print("{:60} {:12.4f} {:12.4f} {:8.2f}".format(name, old_val, new_val, speedup))
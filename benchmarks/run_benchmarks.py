@@ -0,0 +1,441 @@
+import os
+import io
+import json
+import time
+import platform
+import argparse
+import tempfile
+import importlib
+import itertools
+import subprocess
+import contextlib
+import traceback
+from datetime import datetime
+
+import numpy as np
+import torch
+
+from benchmarks.synthetic import SIZES, make_sized_corpus
+from preprocess._meta import HEADER_NAME, INDEXLIZER_NAME, write_meta
+from utils import compile_model
+from models.registry import MODELS
+from export import Predictor, trace_model, export_onnx, OrtPredictor, time_predictor, tune_num_threads, SEQ_AXES
+from quantize import compare_quantized
+
+"""
+NOTE:
+    - Run from the repository root: `python -m benchmarks.run_benchmarks --sizes tiny,small`
+    - Stages: preprocessing (`split_data`, `create_meta`, `create_examples`) of the word/sent/doc pipelines,
+    collate throughput of each model's Dataset, forward/backward of each model at its default config.
+    - The `compile` stage (not run by default, compiling takes minutes) reports the graph breaks of each model
+    under torch.compile and the throughput eager vs compiled: `--stages compile`.
+    - The `inference` stage (not run by default, needs `onnxruntime`) exports each model with TorchScript and ONNX,
+    checks both against eager and compares the latency of eager, TorchScript and onnxruntime: `--stages inference`.
+    - The `quantize` stage (not run by default) compares RMSE, latency and size of fp32, dynamic int8 and static int8
+    (see `quantize.py`) on training batches: `--stages quantize`.
+    - Every stage is timed independently, a failing stage records its error and the rest keeps running.
+    - Results are written to a json file, see `benchmarks/compare.py` to compare two runs.
+"""
+
+PREPROCESSORS = {
+    "word": ("preprocess.divide_and_create_example_word", {"rv_num_keep_prob": 0.9, "max_rv_len": 60, "random_shuffle": False}),
+    "sent": ("preprocess.divide_and_create_example_sent", {"rv_num_keep_prob": 0.9, "max_sent_num": 10, "max_word_num": 20,
+                                                            "random_shuffle": True, "sent_splitter": "punkt", "num_workers": 8}),
+    "doc": ("preprocess.divide_and_create_example_doc", {"rv_num_keep_prob": 0.9, "max_doc_len": 500, "random_shuffle": False}),
+}
+
+class Args(object):
+    pass
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="tiny", help="comma separated names in benchmarks.synthetic.SIZES")
+    parser.add_argument("--models", default=",".join(MODELS))
+    parser.add_argument("--stages", default="preprocess,collate,model")
+    parser.add_argument("--work_dir", default="./datasets/benchmarks/")
+    parser.add_argument("--out", default=None, help="json path, default to benchmarks/results/<commit>_<time>.json")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num_workers", default=0, type=int)
+    parser.add_argument("--sent_splitter", default=None, help="override the sentence splitter of the sent pipeline")
+    parser.add_argument("--collate_batches", default=100, type=int)
+    parser.add_argument("--model_batches", default=20, type=int)
+    parser.add_argument("--warmup", default=3, type=int)
+    parser.add_argument("--seed", default=20200616, type=int)
+    parser.add_argument("--verbose", action="store_true")
+
+    args = parser.parse_args()
+
+    return args
+
+@contextlib.contextmanager
+def quiet(verbose=False):
+    """
+    Silence the prints and tqdm bars of the preprocessing scripts and trainers.
+    """
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            yield
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+def summarize(times):
+    times = np.asarray(times)
+    return {"mean": float(times.mean()), "median": float(np.median(times)), "min": float(times.min()),
+            "std": float(times.std()), "n": int(len(times))}
+
+def get_env_info(bench_args):
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                             stderr=subprocess.DEVNULL).decode().strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = "unknown", False
+
+    return {"commit": commit,
+            "dirty": dirty,
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "torch": torch.__version__,
+            "numpy": np.__version__,
+            "num_threads": torch.get_num_threads(),
+            "device": bench_args.device,
+            "cuda_device": torch.cuda.get_device_name() if bench_args.device.startswith("cuda") else None,
+            "args": vars(bench_args)}
+
+def run_stage(results, name, func, *args):
+    """
+    Run `func` and store its result (or error) in `results[name]`.
+    """
+    try:
+        results[name] = func(*args)
+    except Exception as exc:
+        traceback.print_exc()
+        results[name] = {"error": "{}: {}".format(type(exc).__name__, exc)}
+    return results[name]
+
+def bench_preprocess(kind, data_path, dest_dir, bench_args):
+    """
+    Time each stage of a preprocessing script and write its outputs to `dest_dir` like the script does.
+    """
+    module_name, defaults = PREPROCESSORS[kind]
+    module = importlib.import_module(module_name)
+
+    args = Args()
+    args.data_path = data_path
+    args.dest_dir = dest_dir
+    for name, val in defaults.items():
+        setattr(args, name, val)
+    if kind == "sent" and bench_args.sent_splitter is not None:
+        args.sent_splitter = bench_args.sent_splitter
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    timings = {}
+    with quiet(bench_args.verbose):
+        start_time = time.perf_counter()
+        train_df, valid_df, test_df = module.split_data(args)
+        timings["split_data"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        meta = module.create_meta(train_df, args)
+        timings["create_meta"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        examples = {}
+        for set_name, df in zip(["train", "valid", "test"], [train_df, valid_df, test_df]):
+            examples[set_name] = module.create_examples(df, meta, set_name, args)
+        timings["create_examples"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        write_meta(dest_dir, meta)
+        for set_name, set_examples in examples.items():
+            module.write_pickle(os.path.join(dest_dir, f"{set_name}_exmaples.pkl"), set_examples)
+        timings["write_pickle"] = time.perf_counter() - start_time
+
+    timings["total"] = sum(timings.values())
+    timings["num_train_examples"] = len(examples["train"])
+    timings["meta_header_bytes"] = os.path.getsize(os.path.join(dest_dir, HEADER_NAME))
+    timings["meta_bytes"] = sum(os.path.getsize(os.path.join(dest_dir, name)) for name in os.listdir(dest_dir)
+                                if name == HEADER_NAME or name == INDEXLIZER_NAME or name.endswith(".npy"))
+    timings["train_examples_bytes"] = os.path.getsize(os.path.join(dest_dir, "train_exmaples.pkl"))
+    return timings
+
+def load_model_args(model_name, data_dir, bench_args):
+    module_name, _, _, config_path, _, _ = MODELS[model_name]
+    module = importlib.import_module(module_name)
+    args = module.parse_args(config_path)
+    args.data_dir = data_dir
+    args.log_dir = os.path.join(bench_args.work_dir, "logs")
+    args.log = False
+    args.stats = False
+    args.use_pretrain = False
+    args.parallel = False
+    args.tensorboard = False
+    args.resume_path = None
+    return module, args
+
+def build_dataloader(module, dataset, args, bench_args):
+    if getattr(args, "sort_by_length", False):
+        batch_sampler = module.LengthSortedBatchSampler(dataset.lengths, args.batch_size, shuffle=True)
+        return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn,
+                                            num_workers=bench_args.num_workers)
+    return torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True, collate_fn=dataset.collate_fn,
+                                        num_workers=bench_args.num_workers)
+
+def bench_collate(model_name, data_dir, bench_args):
+    """
+    Time dataset loading and `collate_fn` throughput (examples/s) of a model's training DataLoader.
+    """
+    module, args = load_model_args(model_name, data_dir, bench_args)
+    dataset_cls = getattr(module, MODELS[model_name][2])
+
+    with quiet(bench_args.verbose):
+        start_time = time.perf_counter()
+        dataset = dataset_cls(args, "train")
+        load_time = time.perf_counter() - start_time
+
+    dataloader = build_dataloader(module, dataset, args, bench_args)
+    num_examples = 0
+    batch_times = []
+    start_time = time.perf_counter()
+    batch_start = start_time
+    for batch in itertools.islice(dataloader, bench_args.collate_batches):
+        num_examples += batch[-1].size(0)
+        batch_times.append(time.perf_counter() - batch_start)
+        batch_start = time.perf_counter()
+    total_time = time.perf_counter() - start_time
+
+    return {"load_dataset": load_time,
+            "batch_size": args.batch_size,
+            "num_batches": len(batch_times),
+            "examples_per_sec": num_examples / total_time,
+            "batch_time": summarize(batch_times)}
+
+def build_experiment(model_name, data_dir, bench_args):
+    module, args = load_model_args(model_name, data_dir, bench_args)
+    _, experiment_name, dataset_name, _, _, _ = MODELS[model_name]
+
+    with quiet(bench_args.verbose):
+        dataset = getattr(module, dataset_name)(args, "train")
+        dataloader = build_dataloader(module, dataset, args, bench_args)
+        dataloaders = {"train": dataloader, "valid": None, "test": None}
+        experiment = getattr(module, experiment_name)(args, dataloaders)
+    return experiment, args
+
+def time_train_steps(experiment, batches, get_inputs, device, warmup):
+    """
+    Time forward, backward and optimizer step of `experiment.model` on each batch, the first `warmup` ones excluded.
+    """
+    model = experiment.model
+    forward_times, backward_times, step_times = [], [], []
+    num_examples = 0
+    for i, batch in enumerate(batches):
+        inputs, ratings = get_inputs(experiment, batch)
+        inputs = [x.to(device) for x in inputs]
+        ratings = ratings.to(device)
+        synchronize(device)
+
+        start_time = time.perf_counter()
+        experiment.optimizer.zero_grad()
+        outputs = model(*inputs)
+        y_pred = outputs[0] if isinstance(outputs, tuple) else outputs
+        loss = experiment.loss_func(y_pred, ratings)
+        synchronize(device)
+        forward_time = time.perf_counter()
+
+        loss.backward()
+        synchronize(device)
+        backward_time = time.perf_counter()
+
+        experiment.optimizer.step()
+        synchronize(device)
+        step_time = time.perf_counter()
+
+        if i >= warmup:
+            forward_times.append(forward_time - start_time)
+            backward_times.append(backward_time - forward_time)
+            step_times.append(step_time - backward_time)
+            num_examples += ratings.size(0)
+
+    total_time = sum(forward_times) + sum(backward_times) + sum(step_times)
+    return {"forward": summarize(forward_times),
+            "backward": summarize(backward_times),
+            "optimizer_step": summarize(step_times),
+            "examples_per_sec": num_examples / total_time}
+
+def bench_model(model_name, data_dir, bench_args):
+    """
+    Time forward, backward and optimizer step of a model on pre-collated training batches.
+    """
+    experiment, args = build_experiment(model_name, data_dir, bench_args)
+    get_inputs = MODELS[model_name][5]
+    device = torch.device(bench_args.device)
+    model = experiment.model.to(device)
+    model.train()
+
+    num_batches = bench_args.warmup + bench_args.model_batches
+    batches = list(itertools.islice(itertools.cycle(experiment.train_dataloader), num_batches))
+
+    results = {"batch_size": args.batch_size,
+                "num_parameters": sum(p.numel() for p in model.parameters())}
+    results.update(time_train_steps(experiment, batches, get_inputs, device, bench_args.warmup))
+    if device.type == "cuda":
+        results["max_memory_allocated"] = torch.cuda.max_memory_allocated(device)
+    return results
+
+def bench_compile(model_name, data_dir, bench_args):
+    """
+    Count the graph breaks of a model under torch.compile and compare the throughput of the train steps,
+    eager vs compiled. `compile_time` is the time of the first (compiling) train step.
+    """
+    experiment, args = build_experiment(model_name, data_dir, bench_args)
+    get_inputs = MODELS[model_name][5]
+    device = torch.device(bench_args.device)
+    model = experiment.model.to(device)
+    model.train()
+
+    num_batches = bench_args.warmup + bench_args.model_batches
+    batches = list(itertools.islice(itertools.cycle(experiment.train_dataloader), num_batches))
+
+    eager = time_train_steps(experiment, batches, get_inputs, device, bench_args.warmup)
+
+    torch._dynamo.reset()
+    compile_model(model)
+    # `forward` is not compiled by `nn.Module.compile`, only the call of the module
+    inputs, _ = get_inputs(experiment, batches[0])
+    explanation = torch._dynamo.explain(model.forward)(*[x.to(device) for x in inputs])
+    break_reasons = []
+    for reason in explanation.break_reasons:
+        frame = reason.user_stack[-1] if reason.user_stack else None
+        location = f"{os.path.relpath(frame.filename)}:{frame.lineno}" if frame is not None else "unknown"
+        break_reasons.append(f"{location}: {reason.reason.splitlines()[0]}")
+    torch._dynamo.reset()
+
+    # the first call compiles, shapes of the next batches may recompile in the warmup
+    start_time = time.perf_counter()
+    time_train_steps(experiment, batches[:1], get_inputs, device, 0)
+    compile_time = time.perf_counter() - start_time
+    compiled = time_train_steps(experiment, batches, get_inputs, device, bench_args.warmup)
+
+    return {"batch_size": args.batch_size,
+            "graph_count": explanation.graph_count,
+            "graph_break_count": explanation.graph_break_count,
+            "break_reasons": sorted(set(break_reasons)),
+            "compile_time": compile_time,
+            "eager": eager,
+            "compiled": compiled,
+            "speedup": compiled["examples_per_sec"] / eager["examples_per_sec"]}
+
+def bench_inference(model_name, data_dir, bench_args):
+    """
+    Parity and latency of the exported models (TorchScript and ONNX Runtime) against eager, on a full batch and
+    on a single example, in eval mode on cpu.
+    """
+    experiment, args = build_experiment(model_name, data_dir, bench_args)
+    get_inputs = MODELS[model_name][5]
+    model = experiment.model.to("cpu")
+    model.eval()
+
+    batches = list(itertools.islice(experiment.train_dataloader, 2))
+    example_inputs, _ = get_inputs(experiment, batches[0])
+    inputs, _ = get_inputs(experiment, batches[-1])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        onnx_path = os.path.join(tmp_dir, f"{model_name}.onnx")
+        with quiet(bench_args.verbose):
+            export_onnx(model, tuple(example_inputs), onnx_path, seq_axes=SEQ_AXES.get(model_name))
+            predictors = {"eager": Predictor(model), "torchscript": trace_model(model, tuple(example_inputs))}
+        num_threads, thread_latencies = tune_num_threads(onnx_path, inputs)
+        predictors["onnxruntime"] = OrtPredictor(onnx_path, num_threads)
+
+        results = {"batch_size": inputs[0].size(0), "onnxruntime_num_threads": num_threads,
+                    "onnxruntime_thread_latency": thread_latencies, "max_abs_diff": {}, "latency": {}, "latency_1": {}}
+        with torch.no_grad():
+            expected = predictors["eager"](*inputs)
+            for name, predictor in predictors.items():
+                results["max_abs_diff"][name] = (predictor(*inputs) - expected).abs().max().item()
+                results["latency"][name] = time_predictor(predictor, inputs, bench_args.model_batches, bench_args.warmup)
+                results["latency_1"][name] = time_predictor(predictor, [x[:1] for x in inputs],
+                                                            bench_args.model_batches, bench_args.warmup)
+    for key in ["latency", "latency_1"]:
+        results[f"{key}_speedup"] = {name: results[key]["eager"] / val for name, val in results[key].items()}
+    return results
+
+def bench_quantize(model_name, data_dir, bench_args):
+    """
+    RMSE delta, latency and size gains of the int8 models, calibrated on `--warmup` batches and evaluated on the
+    next `--model_batches` ones.
+    """
+    experiment, args = build_experiment(model_name, data_dir, bench_args)
+    get_inputs = MODELS[model_name][5]
+    model = experiment.model.to("cpu")
+    model.eval()
+
+    num_batches = bench_args.warmup + bench_args.model_batches
+    batches = list(itertools.islice(itertools.cycle(experiment.train_dataloader), num_batches))
+    results, _ = compare_quantized(experiment, get_inputs, batches[:bench_args.warmup], batches[bench_args.warmup:])
+    return dict(batch_size=args.batch_size, engine=torch.backends.quantized.engine, **results)
+
+def main():
+    bench_args = parse_args()
+    sizes = bench_args.sizes.split(",")
+    model_names = bench_args.models.split(",")
+    stages = bench_args.stages.split(",")
+    for name in sizes:
+        assert name in SIZES, f"{name} is not predefined"
+    for name in model_names:
+        assert name in MODELS, f"{name} is not predefined"
+
+    torch.manual_seed(bench_args.seed)
+    np.random.seed(bench_args.seed)
+
+    report = {"env": get_env_info(bench_args), "results": {}}
+    for size in sizes:
+        size_dir = os.path.join(bench_args.work_dir, size)
+        size_results = {"corpus": dict(zip(["user_num", "item_num", "review_num"], SIZES[size])),
+                        "preprocess": {}, "collate": {}, "model": {}, "compile": {}, "inference": {}, "quantize": {}}
+        report["results"][size] = size_results
+
+        data_path = make_sized_corpus(size, size_dir, seed=bench_args.seed)
+        kinds = sorted(set(MODELS[name][4] for name in model_names))
+        for kind in kinds:
+            data_dir = os.path.join(size_dir, kind)
+            if "preprocess" in stages or not os.path.exists(os.path.join(data_dir, HEADER_NAME)):
+                timings = run_stage(size_results["preprocess"], kind, bench_preprocess, kind, data_path, data_dir, bench_args)
+                print(f"[{size}] preprocess {kind}: {timings}")
+
+        for name in model_names:
+            data_dir = os.path.join(size_dir, MODELS[name][4])
+            if "collate" in stages:
+                timings = run_stage(size_results["collate"], name, bench_collate, name, data_dir, bench_args)
+                print(f"[{size}] collate {name}: {timings}")
+            if "model" in stages:
+                timings = run_stage(size_results["model"], name, bench_model, name, data_dir, bench_args)
+                print(f"[{size}] model {name}: {timings}")
+            if "compile" in stages:
+                timings = run_stage(size_results["compile"], name, bench_compile, name, data_dir, bench_args)
+                print(f"[{size}] compile {name}: {timings}")
+            if "inference" in stages:
+                timings = run_stage(size_results["inference"], name, bench_inference, name, data_dir, bench_args)
+                print(f"[{size}] inference {name}: {timings}")
+            if "quantize" in stages:
+                timings = run_stage(size_results["quantize"], name, bench_quantize, name, data_dir, bench_args)
+                print(f"[{size}] quantize {name}: {timings}")
+
+    out_path = bench_args.out
+    if out_path is None:
+        out_path = os.path.join("benchmarks", "results", "{}_{}.json".format(
+            report["env"]["commit"], datetime.now().strftime("%m-%d_%H:%M:%S")))
+    if os.path.dirname(out_path) and not os.path.exists(os.path.dirname(out_path)):
+        os.makedirs(os.path.dirname(out_path))
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"write results to {out_path}")
+
+if __name__ == "__main__":
+    main()
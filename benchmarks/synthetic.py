@@ -0,0 +1,117 @@
+import os
+import json
+import gzip
+import argparse
+
+import numpy as np
+
+"""
+NOTE:
+    - Generate Amazon-like review corpora (same json fields as `reviews_*_5.json.gz`) without network access.
+    - Users, items and words follow Zipf-like popularity, every user and item has at least `min_reviews` reviews
+    like the 5-core datasets, so the preprocessing keeps most of them.
+"""
+
+# name: (user_num, item_num, review_num)
+SIZES = {
+    "tiny": (300, 150, 6000),
+    "small": (2000, 1000, 40000),
+    "medium": (10000, 5000, 200000),
+    "large": (40000, 20000, 800000),
+}
+
+COMMON_WORDS = ["good", "great", "love", "toy", "kids", "fun", "play", "price", "quality", "gift", "son", "daughter",
+                "bought", "old", "little", "nice", "recommend", "small", "big", "easy", "pieces", "set", "game",
+                "cute", "broke", "cheap", "color", "box", "batteries", "works", "perfect", "loves", "year", "time"]
+FILLER_WORDS = ["the", "a", "it", "is", "and", "this", "for", "my", "was", "to", "of", "with", "but", "very", "not"]
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "ba", "do", "fi", "gu", "ha", "je", "pa"]
+
+def make_vocab(vocab_size, rng):
+    words = list(COMMON_WORDS)
+    seen = set(words) | set(FILLER_WORDS)
+    while len(words) < vocab_size:
+        word = "".join(rng.choice(SYLLABLES, size=rng.integers(2, 5)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+def zipf_probs(n, exponent):
+    probs = 1. / np.arange(1, n+1) ** exponent
+    return probs / probs.sum()
+
+def make_corpus(path, user_num, item_num, review_num, vocab_size=20000, min_reviews=5, seed=20200616):
+    """
+    Write `review_num` reviews as gzipped json lines to `path`.
+    Args:
+        user_num, item_num: number of distinct reviewers and products.
+        vocab_size: number of distinct content words.
+        min_reviews: reviews guaranteed to each user and item.
+    """
+    assert review_num >= min_reviews * max(user_num, item_num)
+    rng = np.random.default_rng(seed)
+    words = np.array(make_vocab(vocab_size, rng))
+    word_probs = zipf_probs(len(words), 1.1)
+
+    # every user/item gets `min_reviews` reviews, the rest follows a long-tail popularity
+    users = np.concatenate([np.repeat(np.arange(user_num), min_reviews),
+                            rng.choice(user_num, size=review_num - user_num * min_reviews, p=zipf_probs(user_num, 0.6))])
+    items = np.concatenate([np.repeat(np.arange(item_num), min_reviews),
+                            rng.choice(item_num, size=review_num - item_num * min_reviews, p=zipf_probs(item_num, 0.8))])
+    items = rng.permutation(items)
+    ratings = rng.choice([1., 2., 3., 4., 5.], size=review_num, p=[0.05, 0.05, 0.1, 0.25, 0.55])
+
+    sent_nums = rng.integers(1, 8, size=review_num)
+    word_nums = rng.integers(3, 20, size=sent_nums.sum())
+    tokens = words[rng.choice(len(words), size=word_nums.sum(), p=word_probs)]
+    fillers = rng.choice(FILLER_WORDS, size=word_nums.sum())
+    tokens = np.where(rng.random(word_nums.sum()) < 0.3, fillers, tokens)
+    puncts = rng.choice([".", ".", "!", "?"], size=sent_nums.sum())
+
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    tok_start = 0
+    sent_start = 0
+    with gzip.open(path, "wt") as f:
+        for k in range(review_num):
+            sents = []
+            for j in range(sent_start, sent_start+sent_nums[k]):
+                sent = " ".join(tokens[tok_start:tok_start+word_nums[j]])
+                sents.append(sent.capitalize() + puncts[j])
+                tok_start += word_nums[j]
+            sent_start += sent_nums[k]
+
+            js_dict = {"reviewerID": "A{:07d}".format(users[k]),
+                        "asin": "B{:09d}".format(items[k]),
+                        "overall": float(ratings[k]),
+                        "reviewText": " ".join(sents),
+                        "unixReviewTime": 1300000000 + 3600 * k}
+            f.write(json.dumps(js_dict) + "\n")
+
+    return path
+
+def make_sized_corpus(size, out_dir, seed=20200616):
+    """
+    Generate (or reuse) the corpus of a predefined size in `out_dir`.
+    """
+    user_num, item_num, review_num = SIZES[size]
+    path = os.path.join(out_dir, f"reviews_synthetic_{size}.json.gz")
+    if not os.path.exists(path):
+        make_corpus(path, user_num, item_num, review_num, seed=seed)
+    return path
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="tiny", choices=list(SIZES))
+    parser.add_argument("--out_dir", default="./datasets/synthetic/")
+    parser.add_argument("--seed", default=20200616, type=int)
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    path = make_sized_corpus(args.size, args.out_dir, args.seed)
+    print(f"write {SIZES[args.size][2]} reviews to {path}")
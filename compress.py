@@ -0,0 +1,149 @@
+import os
+import copy
+import json
+import time
+import argparse
+import tempfile
+import itertools
+
+import numpy as np
+import torch
+
+from models.registry import MODELS
+from preprocess._meta import LazyMeta, RaggedArray
+from utils import CompressedEmbedding, get_word_embedding_names
+from export import load_experiment, build_dataloader, Predictor, evaluate_rmse
+
+"""
+NOTE:
+    - Compress the word embedding of a trained model for serving:
+    `python -m compress --model narre --ckpt <out_dir>/best_model.pt --data_dir <dest_dir> --modes fp16,int8,pq --out_dir <dir>`
+    writes `<dir>/<model>_<mode>.pt` for each mode, load them as any checkpoint with `export.load_experiment` (or
+    `python -m export`, `python -m quantize`), the `WordEmbedding` is replaced by a `CompressedEmbedding` at load time.
+    - The vocab is pruned to the ids which appear in the reviews (docs) of `--data_dir` and the special tokens: the
+    stop words, oov and truncated tokens never reach the model. Ids of a delta preprocessed later on the same
+    vocab which were pruned are mapped to the unk row.
+    - Modes, see `CompressedEmbedding`: "fp32" (pruning only), "fp16", "int8" (per row scale), "pq" (product quantization,
+    `--pq_subdim` floats per uint8 code).
+    - The compressed checkpoints only keep `args`, the weights and the configs of the compressed embeddings (no
+    optimizer), "original" is the fp32 model saved the same way. Reports per mode the kept rows, the bytes of the
+    word embeddings, the size of the checkpoint, its load time (`load_experiment`) and the RMSE on `--eval_set`.
+"""
+
+TOKEN_KEYS = ["user_reviews", "item_reviews", "user_docs", "item_docs"]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, help=", ".join(MODELS))
+    parser.add_argument("--ckpt", required=True, help="checkpoint written by `Experiment.save`")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--modes", default="fp16,int8,pq", help=", ".join(CompressedEmbedding.MODES))
+    parser.add_argument("--out_dir", default=None, help="default to a temporary directory")
+    parser.add_argument("--pq_subdim", default=4, type=int)
+    parser.add_argument("--pq_centroids", default=256, type=int)
+    parser.add_argument("--eval_set", default="valid")
+    parser.add_argument("--eval_batches", default=0, type=int, help="0 for all")
+    parser.add_argument("--report", default=None, help="json path of the report")
+
+    args = parser.parse_args()
+
+    return args
+
+def get_seen_ids(data_dir, chunk_size=1<<24):
+    """
+    Returns:
+        keep_ids: LongTensor, sorted ids of the vocab which appear in the token arrays of `data_dir` and the special tokens
+        unk_idx: int
+    """
+    meta = LazyMeta(data_dir)
+    indexlizer = meta["indexlizer"]
+    seen = np.zeros(meta["vocab_size"], dtype=bool)
+    seen[[indexlizer._token2id[tok] for tok in indexlizer._special_tokens]] = True
+    for key in TOKEN_KEYS:
+        if key not in meta:
+            continue
+        token_ids = meta[key]
+        token_ids = (token_ids.data if isinstance(token_ids, RaggedArray) else token_ids).reshape(-1)
+        # chunks of the memory-mapped array, `bincount` casts to int64
+        for start in range(0, len(token_ids), chunk_size):
+            seen |= np.bincount(token_ids[start:start+chunk_size], minlength=len(seen)) > 0
+    return torch.from_numpy(np.flatnonzero(seen)), indexlizer._token2id[indexlizer._unk_token]
+
+def compress_model(model, keep_ids, unk_idx, mode, pq_subdim=4, pq_centroids=256):
+    """
+    Returns:
+        a copy of `model` where every `WordEmbedding` is a `CompressedEmbedding`
+        configs: dict, module name -> `CompressedEmbedding.config()`, see `utils.replace_word_embeddings`
+    """
+    model = copy.deepcopy(model)
+    configs = {}
+    for name in get_word_embedding_names(model):
+        parent_name, _, child_name = name.rpartition(".")
+        embedding = model.get_submodule(name).embedding
+        padding_idx = embedding.padding_idx if embedding.padding_idx is not None else 0
+        compressed = CompressedEmbedding.from_weight(embedding.weight, keep_ids, unk_idx, mode, pq_subdim, pq_centroids, padding_idx)
+        setattr(model.get_submodule(parent_name), child_name, compressed)
+        configs[name] = compressed.config()
+    return model, configs
+
+def embedding_bytes(model):
+    """
+    Bytes of the word embeddings of `model`, compressed or not.
+    """
+    total = 0
+    for name in get_word_embedding_names(model) + [name for name, module in model.named_modules() if isinstance(module, CompressedEmbedding)]:
+        module = model.get_submodule(name)
+        total += sum(x.numel() * x.element_size() for x in itertools.chain(module.parameters(), module.buffers()))
+    return total
+
+def save_serving_ckpt(path, args, model, configs=None):
+    torch.save({"args": args, "model": model.state_dict(), "embeddings": configs or {}}, path)
+
+if __name__ == "__main__":
+    args = parse_args()
+    experiment, _ = load_experiment(args.model, args.ckpt, args.data_dir, args.eval_set)
+    ckpt_args = torch.load(args.ckpt, map_location="cpu", weights_only=False)["args"]
+    eval_loader = build_dataloader(args.model, experiment.args, args.eval_set)
+    eval_batches = list(itertools.islice(eval_loader, args.eval_batches or None))
+    get_inputs = MODELS[args.model][5]
+    keep_ids, unk_idx = get_seen_ids(args.data_dir)
+
+    out_dir = args.out_dir or tempfile.mkdtemp()
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    vocab_size = experiment.model.get_submodule(get_word_embedding_names(experiment.model)[0]).embedding.num_embeddings
+    print(f"keep {len(keep_ids)} of {vocab_size} vocab rows")
+
+    results = {}
+    for mode in ["original"] + args.modes.split(","):
+        if mode == "original":
+            model, configs = experiment.model, None
+        else:
+            start_time = time.perf_counter()
+            model, configs = compress_model(experiment.model, keep_ids, unk_idx, mode, args.pq_subdim, args.pq_centroids)
+            compress_time = time.perf_counter() - start_time
+        path = os.path.join(out_dir, f"{args.model}_{mode}.pt")
+        save_serving_ckpt(path, ckpt_args, model, configs)
+
+        start_time = time.perf_counter()
+        loaded_experiment, _ = load_experiment(args.model, path, args.data_dir, args.eval_set)
+        load_time = time.perf_counter() - start_time
+
+        results[mode] = {"rows": len(keep_ids) if mode != "original" else vocab_size,
+                        "embedding_bytes": embedding_bytes(loaded_experiment.model),
+                        "ckpt_bytes": os.path.getsize(path),
+                        "load_time": load_time,
+                        "rmse": evaluate_rmse(Predictor(loaded_experiment.model), eval_batches, loaded_experiment, get_inputs)}
+        if mode != "original":
+            results[mode]["compress_time"] = compress_time
+            results[mode]["rmse_delta"] = results[mode]["rmse"] - results["original"]["rmse"]
+            results[mode]["embedding_ratio"] = results[mode]["embedding_bytes"] / results["original"]["embedding_bytes"]
+        metrics = results[mode]
+        print(f"{mode}: {metrics['rows']} rows, embedding {metrics['embedding_bytes'] / 2**20:.2f}MB, "
+              f"checkpoint {metrics['ckpt_bytes'] / 2**20:.2f}MB, load {metrics['load_time']:.2f}s, rmse {metrics['rmse']:.4f}" +
+              (f", rmse delta {metrics['rmse_delta']:+.4f}, embedding {metrics['embedding_ratio']:.3f}x" if mode != "original" else ""))
+    print(f"write the checkpoints to {out_dir}")
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump({"model": args.model, "results": results}, f, indent=2)
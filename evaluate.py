@@ -0,0 +1,59 @@
+import json
+import time
+import argparse
+
+import torch
+
+from models.registry import MODELS
+from experiment import RatingMetrics
+from export import load_experiment
+
+"""
+NOTE:
+    - Evaluate one or several checkpoints of a model on the test set:
+    `python -m evaluate --model narre --ckpts <out_dir>/best_model.pt,<out_dir>/model_3.pt --data_dir <dest_dir>`
+    - The dataset of `--set_name` is loaded once and its dataloader is shared by the checkpoints (`load_experiment`
+    with `dataloader`), the checkpoints must be trained on the same preprocessed `--data_dir`.
+    - The predictions stay on `--device` until the end of the set (`RatingMetrics`), reports the RMSE, the MAE and
+    both per true rating of each checkpoint.
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, help=", ".join(MODELS))
+    parser.add_argument("--ckpts", required=True, help="comma separated checkpoints written by `Experiment.save`")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--set_name", default="test")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--report", default=None, help="json path of the report")
+
+    args = parser.parse_args()
+
+    return args
+
+def evaluate_checkpoints(model_name, ckpt_paths, data_dir, set_name="test", device="cpu"):
+    """
+    Returns:
+        results: dict, checkpoint path -> metrics of `RatingMetrics.compute` and the evaluation time
+    """
+    results = {}
+    dataloader = None
+    for path in ckpt_paths:
+        experiment, dataloader = load_experiment(model_name, path, data_dir, set_name, dataloader)
+        experiment.device = torch.device(device)
+        experiment.model.to(experiment.device)
+
+        start_time = time.perf_counter()
+        results[path] = experiment.evaluate(dataloader)
+        results[path]["time"] = time.perf_counter() - start_time
+    return results
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = evaluate_checkpoints(args.model, args.ckpts.split(","), args.data_dir, args.set_name, args.device)
+    for path, metrics in results.items():
+        print(f"{path}: {RatingMetrics.format(metrics)}, {metrics['count']} examples in {metrics['time']:.2f}s")
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump({"model": args.model, "set_name": args.set_name, "results": results}, f, indent=2)
@@ -1,11 +1,25 @@
 import os
 import sys 
 import json
+import math
+import copy
+import gzip
+import random
+import atexit
+import queue
+import threading
+import collections
+import concurrent.futures
 from abc import ABC, abstractmethod
 from datetime import datetime 
 
+import numpy as np
 import torch
 
+from samplers import LengthSortedBatchSampler
+from profiler import StepProfiler
+from utils import histogram_summary, split_histogram_summary
+
 # self.args.dataset
 # self.args.log_dir
 # self.args.use_pretrain
@@ -24,6 +38,12 @@ import torch
 # self.lr_decay
 # self.decay_patience
 # args.max_grad_norm
+# args.grad_accum_steps
+# args.lr_scaling
+# args.warmup_steps
+
+# self.args.keep_last_ckpts
+# self.args.resume_path
 class Args(object):
     pass
 
@@ -36,11 +56,310 @@ def parse_args(config):
 
     return args
 
+def copy_to_cpu(obj):
+    """
+    Detached CPU copy of every tensor in a (nested) state dict, so it can be serialized
+    while training keeps updating the original tensors.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return {key: copy_to_cpu(val) for key, val in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(val) for val in obj)
+    else:
+        return obj
+
+class AsyncCheckpointer(object):
+    """
+    Serialize checkpoints on a background thread.
+
+    Each checkpoint is written to a temporary file in the same directory and renamed atomically,
+    so an interrupted job never leaves a truncated checkpoint. Only the `keep_last` most recent
+    rolling checkpoints are kept, named ones (e.g. best_model.pt) are never removed.
+    """
+    def __init__(self, keep_last=3):
+        self.keep_last = keep_last
+        self._rolling_paths = []
+        self._error = None
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.wait)
+
+    def submit(self, state, path, rolling=False):
+        self._raise_error()
+        self._queue.put((state, path, rolling))
+
+    def wait(self):
+        """
+        Block until every submitted checkpoint is on disk.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def _run(self):
+        while True:
+            state, path, rolling = self._queue.get()
+            try:
+                self._write(state, path)
+                if rolling:
+                    self._remove_old(path)
+            except Exception as exc:
+                self._error = exc
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(state, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _remove_old(self, path):
+        if path in self._rolling_paths:
+            self._rolling_paths.remove(path)
+        self._rolling_paths.append(path)
+        while len(self._rolling_paths) > self.keep_last:
+            old_path = self._rolling_paths.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise IOError("failed to write checkpoint") from error
+
+class RatingMetrics(object):
+    """
+    Streaming metrics of the predicted ratings: the predictions of each batch are copied into buffers
+    preallocated on `device` and nothing is read back before `compute`, a single transfer to the host.
+    Args:
+        num_examples: int, size of the buffers, e.g. `len(dataloader.dataset)`
+        device: torch.device of the predictions
+        rating_values: list of the possible ratings, the errors are also reported per true rating
+    """
+    def __init__(self, num_examples, device, rating_values=(1, 2, 3, 4, 5)):
+        self.preds = torch.empty(num_examples, device=device)
+        self.targets = torch.empty(num_examples, device=device)
+        self.rating_values = torch.tensor(rating_values, dtype=torch.float, device=device)
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def update(self, preds, targets):
+        """
+        Args:
+            preds: [bz]
+            targets: [bz]
+        """
+        num = preds.numel()
+        assert self.count + num <= len(self.preds), "more predictions than the size of the buffers"
+        self.preds[self.count:self.count+num].copy_(preds.detach().view(-1))
+        self.targets[self.count:self.count+num].copy_(targets.view(-1))
+        self.count += num
+
+    def compute(self):
+        """
+        Returns:
+            metrics: dict, "count", "mse", "rmse", "mae", and "buckets": rating -> {"count", "rmse", "mae"} of the
+            examples whose true rating is `rating` (the closest of `rating_values`)
+        """
+        errors = (self.preds[:self.count] - self.targets[:self.count]).double()
+        buckets = (self.targets[:self.count].unsqueeze(1) - self.rating_values).abs().argmin(dim=1)
+        # count, squared error and absolute error summed per bucket
+        sums = errors.new_zeros(len(self.rating_values), 3).index_add_(0, buckets, torch.stack([torch.ones_like(errors), errors ** 2, errors.abs()], dim=1))
+        sums = torch.cat([sums.sum(dim=0, keepdim=True), sums]).cpu().tolist()
+
+        def summarize(count, square_error, abs_error):
+            return {"count": int(count), "rmse": math.sqrt(square_error / count), "mae": abs_error / count}
+
+        metrics = summarize(*sums[0]) if sums[0][0] > 0 else {"count": 0, "rmse": float("nan"), "mae": float("nan")}
+        metrics["mse"] = metrics["rmse"] ** 2
+        metrics["buckets"] = {rating: summarize(*bucket_sums) for rating, bucket_sums in zip(self.rating_values.tolist(), sums[1:])
+                                if bucket_sums[0] > 0}
+        return metrics
+
+    @staticmethod
+    def format(metrics):
+        return "rmse: {:.3f}, mae: {:.3f}, rmse by rating: {}".format(metrics["rmse"], metrics["mae"],
+                ", ".join("{:g}: {:.3f} ({})".format(rating, val["rmse"], val["count"]) for rating, val in metrics["buckets"].items()))
+
+class AsyncHistogramWriter(object):
+    """
+    TensorBoard histograms of large tensors (e.g. attention weights) without copying them to the host: `add`
+    reduces the values on their device (`utils.histogram_summary`, a few dozens of floats), the copy to the host is
+    asynchronous on cuda and a background thread waits for it and writes the histogram and the quantiles.
+    Args:
+        writer: tensorboardX `SummaryWriter`
+        num_bins: int, bins of the histograms over `value_range`
+        quantiles: list of float, written as the scalars `<tag>/q<percent>`
+    """
+    def __init__(self, writer, num_bins=50, value_range=(0., 1.), quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        self.writer = writer
+        self.num_bins = num_bins
+        self.value_range = value_range
+        self.quantiles = quantiles
+        self.bucket_limits = torch.linspace(value_range[0], value_range[1], num_bins + 1)[1:].tolist()
+        self._error = None
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.wait)
+
+    def add(self, tag, values, global_step, masks=None):
+        """
+        Args:
+            values: FloatTensor of any shape
+            masks: BoolTensor with the shape of `values`, False for the padding
+        """
+        self._raise_error()
+        summary = histogram_summary(values, masks, self.num_bins, self.value_range, self.quantiles)
+        event = None
+        if summary.is_cuda:
+            host_summary = torch.empty(summary.size(), dtype=summary.dtype, pin_memory=True)
+            host_summary.copy_(summary, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            summary = host_summary
+        self._queue.put((tag, summary, event, global_step))
+
+    def wait(self):
+        """
+        Block until every added histogram is written.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def _run(self):
+        while True:
+            tag, summary, event, global_step = self._queue.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                self._write(tag, summary, global_step)
+            except Exception as exc:
+                self._error = exc
+            finally:
+                self._queue.task_done()
+
+    def _write(self, tag, summary, global_step):
+        moments, quantile_values, counts = split_histogram_summary(summary, len(self.quantiles))
+        if moments["num"] == 0:
+            return
+        self.writer.add_histogram_raw(tag, moments["min"], moments["max"], int(moments["num"]), moments["sum"],
+                                      moments["sum_squares"], self.bucket_limits, counts, global_step=global_step)
+        for q, val in zip(self.quantiles, quantile_values):
+            self.writer.add_scalar("{}/q{:g}".format(tag, q * 100), val, global_step=global_step)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise IOError("failed to write histogram") from error
+
+def _init_eval_worker(experiment_cls, args, model, dataset_cls, set_name, batch_size, batch_sampler, device, num_threads):
+    global _eval_experiment, _eval_dataloader
+    torch.set_num_threads(num_threads)
+    # only the state used by `Experiment.evaluate`, no out directory nor optimizer
+    _eval_experiment = experiment_cls.__new__(experiment_cls)
+    _eval_experiment.args = args
+    _eval_experiment.device = torch.device(device)
+    _eval_experiment.model = model.to(_eval_experiment.device)
+
+    dataset = dataset_cls(args, set_name)
+    if batch_sampler is not None:
+        _eval_dataloader = torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn)
+    else:
+        _eval_dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=dataset.collate_fn)
+
+def _eval_worker(model_state):
+    # the snapshot has the keys of the training model, which may be wrapped by `DataParallel`
+    torch.nn.modules.utils.consume_prefix_in_state_dict_if_present(model_state, "module.")
+    _eval_experiment.model.load_state_dict(model_state)
+    return _eval_experiment.evaluate(_eval_dataloader)
+
+class AsyncEvaluator(object):
+    """
+    Evaluate snapshots of the weights on the validation set in a pool of worker processes while training goes on.
+
+    The model (its architecture, a compiled model runs eagerly) and the validation set are sent to the workers once,
+    each worker rebuilds the dataset and a dataloader in order. A snapshot is a CPU copy of the state dict, its
+    tensors go to the workers through shared memory, and it is kept until its result is collected so that the
+    evaluated weights can be saved. Results are collected in the order of the submissions.
+    Args:
+        experiment: Experiment, its model and `valid_dataloader`
+        num_workers: int, evaluations running at the same time
+        num_threads: int, intra-op threads of each worker
+    """
+    def __init__(self, experiment, num_workers=1, num_threads=1):
+        model = self._unwrap(experiment.model)
+        dataloader = experiment.valid_dataloader
+        batch_sampler = dataloader.batch_sampler if isinstance(dataloader.batch_sampler, LengthSortedBatchSampler) else None
+        self._pool = concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=torch.multiprocessing.get_context("spawn"),
+                        initializer=_init_eval_worker,
+                        initargs=(type(experiment), experiment.args, copy.deepcopy(model).to("cpu"), type(dataloader.dataset),
+                                dataloader.dataset.set_name, dataloader.batch_size or experiment.args.batch_size, batch_sampler,
+                                str(experiment.device), num_threads))
+        self._pending = collections.deque()
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def _unwrap(model):
+        return model.module if isinstance(model, torch.nn.DataParallel) else model
+
+    def submit(self, tag, model=None, model_state=None):
+        """
+        Snapshot the weights of `model` (or take the CPU state dict `model_state`) and queue their evaluation,
+        returns at once.
+        Args:
+            tag: returned with the result, e.g. the epoch
+        """
+        if model_state is None:
+            model_state = copy_to_cpu(model.state_dict())
+        self._pending.append((tag, self._pool.submit(_eval_worker, model_state), model_state))
+
+    def pending(self):
+        """
+        (tag, state dict) of the evaluations whose result is not collected yet, in the order of the submissions.
+        """
+        return [(tag, model_state) for tag, _, model_state in self._pending]
+
+    def collect(self, wait=False):
+        """
+        Yield (tag, metrics of `Experiment.evaluate`, state dict) of the finished evaluations, in the order of the
+        submissions. With `wait`, block until every submitted evaluation is done.
+        """
+        while self._pending and (wait or self._pending[0][1].done()):
+            tag, future, model_state = self._pending.popleft()
+            yield tag, future.result(), model_state
+
+    def num_pending(self):
+        return len(self._pending)
+
+    def shutdown(self):
+        """
+        Drop the evaluations not started yet and wait for the running ones.
+        """
+        self._pending.clear()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
 class Experiment(ABC):
     def __init__(self, args, dataloaders):
         self.args = args
         self.uid = datetime.now().strftime("%m-%d_%H:%M:%S")
         self.updates = 0
+        self.start_epoch = 0
+        self.checkpointer = AsyncCheckpointer(keep_last=self.args.keep_last_ckpts)
+        # built on the first `validate` with `args.async_eval`
+        self.evaluator = None
+        # gradient norm of the last update, see `optimize`
+        self.gnorm = 0.
 
         # model
         self.model_name = None 
@@ -57,9 +376,17 @@ class Experiment(ABC):
 
     def setup(self):
         """
-        Make directory for log files and saving models
+        Make directory for log files and saving models, build the step profiler
         """
         self._make_dir()
+        self.build_profiler()
+
+    def build_profiler(self):
+        """
+        `self.profiler`, a no-op unless `args.profile`, see `profiler.StepProfiler`.
+        """
+        self.profiler = StepProfiler(self.out_dir, self.args.profile, self.args.profile_idx, self.args.torch_profiler,
+                                    self.device, self.print_write_to_log)
 
     def _make_dir(self):
         """
@@ -67,7 +394,7 @@ class Experiment(ABC):
         """
         hyper_name = self.uid + "_" + self.args.model_name
         
-        out_dir = "./{}/{}/{}/{}".format(
+        out_dir = os.path.join(
             self.args.log_dir,
             self.args.dataset,
             self.args.model_name,
@@ -124,22 +451,220 @@ class Experiment(ABC):
         else:
             raise ValueError("not found model")
     
-    def save(self, name=None):
+    def save(self, name=None, epoch=None, blocking=False, model_state=None):
+        """
+        Snapshot the training state to CPU and hand it to the background checkpointer.
+        Args:
+            name: file name in `self.out_dir`. If None, a rolling checkpoint named by `self.updates`
+                is written and only the last `args.keep_last_ckpts` of them are kept.
+            epoch: last finished epoch, training resumes from the next one.
+            blocking: wait until the checkpoint is on disk.
+            model_state: state dict saved instead of the one of `self.model`, e.g. the snapshot evaluated by
+                `AsyncEvaluator`, the other states are the current ones. Such a checkpoint has no epoch, the
+                optimizer and RNG states do not match its weights, and `load` refuses to resume from it.
+        """
         if name is not None:
             if not name.endswith(".pt"):
                 name += ".pt"
             fn = os.path.join(self.out_dir, name)
         else:
             fn = os.path.join(self.out_dir, "{}_model.pt".format(self.updates))
+
+        scheduler = getattr(self, "scheduler", None)
+        rng_states = {"python": random.getstate(),
+                        "numpy": np.random.get_state(),
+                        "torch": torch.get_rng_state()}
+        if torch.cuda.is_available():
+            rng_states["cuda"] = torch.cuda.get_rng_state_all()
         
-        params = {"model": self.model.state_dict(),
-                    "optimizer": self.optimizer.state_dict(),
+        # the epochs whose validation is still running are evaluated again on resume, see `load`
+        pending_valid = self.evaluator.pending() if self.evaluator is not None and name is None else []
+        params = {"model": copy_to_cpu(model_state if model_state is not None else self.model.state_dict()),
+                    "optimizer": copy_to_cpu(self.optimizer.state_dict()),
+                    "scheduler": copy_to_cpu(scheduler.state_dict()) if scheduler is not None else None,
                     "updates": self.updates,
-                    "args": self.args}
-        torch.save(params, fn)
+                    "epoch": epoch if model_state is None else None,
+                    "best_rmse": self.best_rmse,
+                    "patience": self.patience,
+                    "pending_valid": pending_valid,
+                    "rng_states": rng_states,
+                    "args": dict(self.args.__dict__)}
+        self.checkpointer.submit(params, fn, rolling=name is None)
+        if blocking:
+            self.checkpointer.wait()
+
+        return fn
 
     def load(self, fn):
-        pass
+        """
+        Restore a checkpoint written by `save`, training continues after its epoch. The validations of the epochs
+        which were still running with `args.async_eval` are submitted again, `best_rmse` and patience are updated
+        by their results before the ones of the next epochs.
+        """
+        params = torch.load(fn, map_location="cpu", weights_only=False)
+        if params["epoch"] is None:
+            raise ValueError(f"{fn} was not saved at the end of an epoch, resume from a rolling checkpoint")
+
+        self.model.load_state_dict(params["model"])
+        self.optimizer.load_state_dict(params["optimizer"])
+        scheduler = getattr(self, "scheduler", None)
+        if scheduler is not None and params["scheduler"] is not None:
+            scheduler.load_state_dict(params["scheduler"])
+
+        self.updates = params["updates"]
+        self.start_epoch = params["epoch"] + 1
+        self.best_rmse = params["best_rmse"]
+        self.patience = params["patience"]
+
+        rng_states = params["rng_states"]
+        random.setstate(rng_states["python"])
+        np.random.set_state(rng_states["numpy"])
+        torch.set_rng_state(rng_states["torch"])
+        if torch.cuda.is_available() and "cuda" in rng_states:
+            torch.cuda.set_rng_state_all(rng_states["cuda"])
+
+        self.print_write_to_log("resume from {}, start epoch: {}, updates: {}, best rmse: {:.3f}".format(
+            fn, self.start_epoch, self.updates, self.best_rmse))
+
+        pending_valid = params.get("pending_valid", [])
+        if len(pending_valid) > 0:
+            self.evaluator = AsyncEvaluator(self, self.args.eval_workers)
+            for epoch, model_state in pending_valid:
+                self.evaluator.submit(epoch, model_state=model_state)
+            self.print_write_to_log("validate again epochs {}".format([epoch for epoch, _ in pending_valid]))
+
+    def optimize(self, loss, batch_idx, num_batches):
+        """
+        Backward of the loss of a batch, the gradients of `args.grad_accum_steps` consecutive batches are
+        accumulated before an update (clipped to `args.max_grad_norm`, lr of `update_lr`), the effective batch is
+        `grad_accum_steps` times the batch of the dataloader. The loss is divided by the number of batches of its
+        group so that the update follows the mean loss, the last group of an epoch may be shorter.
+        Args:
+            loss: the mean loss of the batch
+            batch_idx: int, index of the batch in the epoch
+            num_batches: int, batches of the epoch
+
+        Returns:
+            gnorm: gradient norm of the last update
+        """
+        accum_steps = self.args.grad_accum_steps
+        group_start = batch_idx - batch_idx % accum_steps
+        group_size = min(accum_steps, num_batches - group_start)
+        if batch_idx == group_start:
+            self.optimizer.zero_grad()
+        (loss / group_size).backward()
+        self.profiler.mark("backward")
+
+        if batch_idx + 1 == group_start + group_size:
+            self.gnorm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
+            self.update_lr()
+            self.optimizer.step()
+            self.updates += 1
+        self.profiler.mark("optimizer")
+        return self.gnorm
+
+    def update_lr(self):
+        """
+        Set the lr of the next update: the lr of the optimizer scaled with the number of accumulated batches
+        (`args.lr_scaling`: "none", "linear" or "sqrt") and warmed up linearly over the first `args.warmup_steps`
+        updates. Afterwards the lr is left to the scheduler of the model, if any. The scheduler takes precedence:
+        a group whose lr it changed during the warmup (e.g. `ReduceLROnPlateau` of SimpleSiamese) keeps that lr and
+        is not warmed up anymore. The unscaled lr and the last warmup lr are kept in the param groups, so they are
+        restored with the optimizer on resume.
+        """
+        accum_steps = self.args.grad_accum_steps
+        if self.args.lr_scaling == "none":
+            scale = 1.
+        elif self.args.lr_scaling == "linear":
+            scale = accum_steps
+        elif self.args.lr_scaling == "sqrt":
+            scale = math.sqrt(accum_steps)
+        else:
+            raise ValueError(f"{self.args.lr_scaling} is not predefined")
+        if self.updates > self.args.warmup_steps:
+            return
+
+        warmup = min(1., (self.updates + 1) / self.args.warmup_steps) if self.args.warmup_steps > 0 else 1.
+        # `MultipleOptimizer` of SimpleSiamese
+        for optimizer in getattr(self.optimizer, "optimizers", [self.optimizer]):
+            for group in optimizer.param_groups:
+                group.setdefault("unscaled_lr", group["lr"])
+                if "warmup_lr" in group and group["lr"] != group["warmup_lr"]:
+                    continue
+                group["lr"] = group["warmup_lr"] = group["unscaled_lr"] * scale * warmup
+
+    def validate(self, epoch):
+        """
+        Validate the weights at the end of `epoch`. Inline by `valid_one_epoch`, or with `args.async_eval` the
+        weights are handed to `args.eval_workers` evaluation processes (`AsyncEvaluator`) and training goes on,
+        the results which arrived since are applied by `valid_one_epoch(epoch, metrics, model_state)` in the order
+        of the epochs: `best_rmse`, patience and early stop lag behind the training by the pending evaluations.
+        Args:
+            epoch: last finished epoch of the weights
+        """
+        if not self.args.async_eval:
+            if self.evaluator is not None:
+                # the evaluations submitted again by `load`
+                self.wait_validation()
+                self.evaluator.shutdown()
+                self.evaluator = None
+            self.valid_one_epoch(epoch)
+            return
+        if self.evaluator is None:
+            self.evaluator = AsyncEvaluator(self, self.args.eval_workers)
+        self.evaluator.submit(epoch, self.model)
+        self._apply_valid_results(wait=False)
+
+    def wait_validation(self):
+        """
+        Apply the results of the pending evaluations of `validate`, at the end of the training.
+        """
+        if self.evaluator is not None:
+            self._apply_valid_results(wait=True)
+
+    def _apply_valid_results(self, wait):
+        for epoch, metrics, model_state in self.evaluator.collect(wait):
+            self.print_write_to_log("valid results of epoch {}:".format(epoch))
+            try:
+                self.valid_one_epoch(epoch, metrics, model_state)
+            except Exception:
+                # e.g. early stop, the later evaluations are not needed anymore
+                self.evaluator.shutdown()
+                raise
+
+    @abstractmethod
+    def forward_batch(self, batch):
+        """
+        Args:
+            batch: a batch of the dataloaders
+
+        Returns:
+            y_pred: [bz], predicted ratings of `self.model` on `self.device`
+            ratings: [bz]
+        """
+
+    def evaluate(self, dataloader):
+        """
+        Streaming evaluation of `self.model` on `dataloader`, see `RatingMetrics`.
+        """
+        self.model.eval()
+        metrics = RatingMetrics(len(dataloader.dataset), self.device)
+        with torch.no_grad():
+            for batch in dataloader:
+                y_pred, ratings = self.forward_batch(batch)
+                metrics.update(y_pred, ratings)
+        return metrics.compute()
+
+    def test(self, name="best_model.pt"):
+        """
+        Evaluate the checkpoint `name` of `self.out_dir` (default to the best one) on the test set.
+        """
+        self.checkpointer.wait()
+        params = torch.load(os.path.join(self.out_dir, name), map_location=self.device, weights_only=False)
+        self.model.load_state_dict(params["model"])
+        metrics = self.evaluate(self.test_dataloader)
+        self.print_write_to_log("test {}, {}".format(name, RatingMetrics.format(metrics)))
+        return metrics
 
     def update_stats(self, stats, set_name):
         """
@@ -0,0 +1,264 @@
+import os
+import time
+import inspect
+import argparse
+import importlib
+import itertools
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models.registry import MODELS
+from utils import replace_word_embeddings
+
+"""
+NOTE:
+    - Export a trained model for inference with TorchScript:
+    `python -m export --model narre --ckpt <out_dir>/best_model.pt --data_dir <dest_dir> --out narre.ts`
+    or ONNX: `python -m export --model narre --ckpt <out_dir>/best_model.pt --data_dir <dest_dir> --out narre.onnx --format onnx`
+    - The model is traced by `torch.jit.trace` in eval mode on a batch of `--set_name`, the config-string branches
+    and the loops over the kernel sizes are resolved at trace time, the `Seq2SeqEncoder` of AHN uses its masked LSTM.
+    The ONNX export goes through the same tracing (TorchScript-based exporter, `dynamo=False`), every input and the
+    output have a dynamic batch axis, the review axis of NARRE and SimpleSiamese and the document axis of DeepCoNN
+    and DualAtt (trimmed per batch by their `collate_fn`) are dynamic too (`SEQ_AXES`), the other axes are the
+    ones of the preprocessed `--data_dir`.
+    - The exported model is checked against the eager one on the next batches, it takes the same
+    inputs as the eager model (see `MODELS` of `models/registry.py`) and returns the predicted ratings,
+    load it with `torch.jit.load(path)` or `OrtPredictor(path)` (needs `onnxruntime`). The exporter drops the
+    inputs the graph does not use (e.g. the word masks of SimpleSiamese), `OrtPredictor` still takes all of them.
+    - `OrtPredictor` runs with `num_threads` intra-op threads, `--num_threads 0` picks the fastest thread count
+    on the check batch (`tune_num_threads`).
+"""
+
+# inputs of the models whose review axis (1) changes between batches, input name -> axis name
+REVIEW_AXES = {"narre": {"u_text": "u_rv_num", "i_text": "i_rv_num", "u_text_masks": "u_rv_num",
+                        "i_text_masks": "i_rv_num", "reuid": "u_rv_num", "reiid": "i_rv_num"},
+                "simple_siamese": {"u_revs": "u_rv_num", "i_revs": "i_rv_num", "u_rev_word_masks": "u_rv_num",
+                                "i_rev_word_masks": "i_rv_num", "u_rev_masks": "u_rv_num", "i_rev_masks": "i_rv_num"}}
+# inputs of the models whose document axis (1) changes between batches (`truncate_docs`), input name -> axis name
+DOC_AXES = {"deepconn_pp": {"u_revs": "u_doc_len", "i_revs": "i_doc_len", "u_rev_masks": "u_doc_len",
+                            "i_rev_masks": "i_doc_len"},
+            "dual_att": {"u_docs": "u_doc_len", "i_docs": "i_doc_len"}}
+SEQ_AXES = {**REVIEW_AXES, **DOC_AXES}
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, help=", ".join(MODELS))
+    parser.add_argument("--ckpt", required=True, help="checkpoint written by `Experiment.save`")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--format", default="torchscript", choices=["torchscript", "onnx"])
+    parser.add_argument("--opset_version", default=17, type=int)
+    parser.add_argument("--num_threads", default=0, type=int, help="threads of onnxruntime, 0 to tune")
+    parser.add_argument("--set_name", default="valid")
+    parser.add_argument("--check_batches", default=2, type=int)
+    parser.add_argument("--atol", default=1e-4, type=float)
+
+    args = parser.parse_args()
+
+    return args
+
+def build_dataloader(model_name, args, set_name):
+    """
+    DataLoader of `set_name` in order (no shuffle), with the Dataset of `model_name`.
+    """
+    module_name, _, dataset_name, _, _, _ = MODELS[model_name]
+    dataset = getattr(importlib.import_module(module_name), dataset_name)(args, set_name)
+    return torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False, collate_fn=dataset.collate_fn)
+
+def load_experiment(model_name, ckpt_path, data_dir, set_name, dataloader=None):
+    """
+    Rebuild the experiment of a checkpoint on `data_dir` and load its weights, the word embeddings of a
+    checkpoint written by `compress.py` are replaced by their `CompressedEmbedding` first.
+    Args:
+        dataloader: the dataloader of `set_name` returned by a former call, reused instead of loading the dataset again
+
+    Returns:
+        experiment, dataloader of `set_name`
+    """
+    module_name, experiment_name, _, config_path, _, _ = MODELS[model_name]
+    module = importlib.import_module(module_name)
+    params = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+
+    # the keys added to the config after the checkpoint was written keep their default
+    args = module.parse_args(config_path)
+    for name, val in params["args"].items():
+        setattr(args, name, val)
+    args.data_dir = data_dir
+    args.use_pretrain = False
+    args.parallel = False
+    args.compile = False
+    # the exported models take the padded reviews
+    args.ragged_reviews = False
+    args.log = False
+    args.resume_path = None
+
+    if dataloader is None:
+        dataloader = build_dataloader(model_name, args, set_name)
+    experiment = getattr(module, experiment_name)(args, {"train": dataloader, "valid": dataloader, "test": None})
+    replace_word_embeddings(experiment.model, params.get("embeddings", {}))
+    experiment.model.load_state_dict(params["model"])
+    experiment.model.to("cpu")
+    experiment.model.eval()
+    experiment.device = torch.device("cpu")
+    return experiment, dataloader
+
+class Predictor(nn.Module):
+    """
+    Keep the predicted ratings only, the models also return attention weights (or None).
+    """
+    def __init__(self, model):
+        super(Predictor, self).__init__()
+        self.model = model
+        # same mode as `model`, `torch.onnx.export` restores the mode of the exported module recursively
+        self.train(model.training)
+
+    def forward(self, *inputs):
+        outputs = self.model(*inputs)
+        return outputs[0] if isinstance(outputs, tuple) else outputs
+
+def trace_model(model, example_inputs):
+    """
+    Args:
+        model: nn.Module in eval mode
+        example_inputs: tuple of tensors, the positional inputs of `model`
+
+    Returns:
+        traced_model: torch.jit.ScriptModule, returns the predicted ratings [bz]
+    """
+    with torch.no_grad():
+        return torch.jit.trace(Predictor(model), example_inputs, check_trace=False)
+
+def get_input_names(model, num_inputs):
+    """
+    Names of the first `num_inputs` arguments of `model.forward`, e.g. ["u_text", "i_text", ...] for NARRE.
+    """
+    return list(inspect.signature(model.forward).parameters)[:num_inputs]
+
+def export_onnx(model, example_inputs, path, opset_version=17, seq_axes=None):
+    """
+    Args:
+        model: nn.Module in eval mode
+        example_inputs: tuple of tensors, the positional inputs of `model`
+        path: str, the ONNX file to write
+        seq_axes: dict, input name -> name of its dynamic axis 1, see `SEQ_AXES`
+
+    Returns:
+        input_names: list of str, the inputs of the ONNX graph, in the order of `example_inputs`
+    """
+    input_names = get_input_names(model, len(example_inputs))
+    dynamic_axes = {name: {0: "batch"} for name in input_names + ["ratings"]}
+    for name, axis_name in (seq_axes or {}).items():
+        dynamic_axes[name][1] = axis_name
+    with torch.no_grad():
+        torch.onnx.export(Predictor(model), example_inputs, path, input_names=input_names, output_names=["ratings"],
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+    # the exporter drops the inputs the graph does not use, keep all the names to map the positional inputs
+    import onnx
+    model_proto = onnx.load(path)
+    onnx.helper.set_model_props(model_proto, {"input_names": ",".join(input_names)})
+    onnx.save(model_proto, path)
+    return input_names
+
+class OrtPredictor(object):
+    """
+    CPU inference of an exported ONNX model with onnxruntime, called like the eager model.
+    Args:
+        path: str, file written by `export_onnx`
+        num_threads: int, intra-op threads, default to the number of threads of torch
+    """
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort
+
+        self.path = path
+        self.num_threads = num_threads if num_threads is not None else torch.get_num_threads()
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.num_threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.graph_input_names = [x.name for x in self.session.get_inputs()]
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.input_names = metadata["input_names"].split(",") if "input_names" in metadata else self.graph_input_names
+
+    def __call__(self, *inputs):
+        """
+        Args:
+            inputs: tensors (or np.ndarray), the positional inputs of the eager model
+
+        Returns:
+            ratings: FloatTensor with shape of [bz]
+        """
+        assert len(inputs) == len(self.input_names), f"expect inputs {self.input_names}"
+        feeds = {name: x.numpy() if isinstance(x, torch.Tensor) else np.asarray(x) for name, x in zip(self.input_names, inputs)
+                if name in self.graph_input_names}
+        return torch.from_numpy(self.session.run(None, feeds)[0])
+
+def time_predictor(predictor, inputs, repeats=10, warmup=2):
+    """
+    Returns:
+        median latency in seconds of `predictor(*inputs)`
+    """
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start_time = time.perf_counter()
+            predictor(*inputs)
+            if i >= warmup:
+                times.append(time.perf_counter() - start_time)
+    return float(np.median(times))
+
+def evaluate_rmse(predictor, batches, experiment, get_inputs):
+    squared_errors = []
+    with torch.no_grad():
+        for batch in batches:
+            inputs, ratings = get_inputs(experiment, batch)
+            squared_errors.append(((predictor(*inputs) - ratings.float()) ** 2).numpy())
+    return float(np.sqrt(np.concatenate(squared_errors).mean()))
+
+def tune_num_threads(path, inputs, candidates=None, repeats=10):
+    """
+    Pick the intra-op thread count of `OrtPredictor(path)` with the lowest latency on `inputs`.
+    Args:
+        candidates: list of int, default to the powers of 2 up to the number of cpus
+
+    Returns:
+        num_threads: int
+        latencies: dict, num_threads -> median latency in seconds
+    """
+    if candidates is None:
+        num_cpus = os.cpu_count() or 1
+        candidates = sorted(set([2 ** k for k in range(num_cpus.bit_length()) if 2 ** k <= num_cpus] + [num_cpus]))
+    latencies = {num_threads: time_predictor(OrtPredictor(path, num_threads), inputs, repeats) for num_threads in candidates}
+    return min(latencies, key=latencies.get), latencies
+
+if __name__ == "__main__":
+    args = parse_args()
+    experiment, dataloader = load_experiment(args.model, args.ckpt, args.data_dir, args.set_name)
+    get_inputs = MODELS[args.model][5]
+    batches = list(itertools.islice(dataloader, args.check_batches + 1))
+
+    example_inputs, _ = get_inputs(experiment, batches[0])
+    if args.format == "torchscript":
+        traced_model = trace_model(experiment.model, tuple(example_inputs))
+        traced_model.save(args.out)
+        predictor = torch.jit.load(args.out)
+    else:
+        export_onnx(experiment.model, tuple(example_inputs), args.out, args.opset_version, SEQ_AXES.get(args.model))
+        num_threads = args.num_threads
+        if num_threads == 0:
+            num_threads, latencies = tune_num_threads(args.out, example_inputs)
+            print("onnxruntime latency per thread count: " + ", ".join(f"{k}: {v * 1000:.1f}ms" for k, v in latencies.items()))
+        predictor = OrtPredictor(args.out, num_threads)
+        print(f"onnxruntime with {num_threads} threads")
+
+    for batch in batches[1:]:
+        inputs, _ = get_inputs(experiment, batch)
+        with torch.no_grad():
+            diff = (predictor(*inputs) - Predictor(experiment.model)(*inputs)).abs().max().item()
+        print(f"batch of {inputs[0].size(0)}: max abs diff {diff:.2e}")
+        assert diff <= args.atol, "the exported model does not match the eager model"
+    print(f"write the {args.format} {args.model} to {args.out}")
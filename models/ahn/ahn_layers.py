@@ -6,7 +6,7 @@ import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import numpy as np
 
-from utils import masked_softmax, attention_weighted_sum
+from utils import masked_softmax, attention_weighted_sum, pack_rows
 # ======== Modules for Utils ==============
 class VariationalDropout(torch.nn.Dropout):
     """
@@ -303,7 +303,16 @@ class Seq2SeqEncoder(nn.Module):
         """
         if self.dropout:
             sequences_batch = self.dropout(sequences_batch)
+        if torch.jit.is_tracing():
+            return self._masked_forward(sequences_batch, sequences_lengths)
+        return self._packed_forward(sequences_batch, sequences_lengths)
 
+    @torch.compiler.disable
+    def _packed_forward(self, sequences_batch, sequences_lengths):
+        """
+        NOTE: runs eagerly under torch.compile (a graph break), `pack_padded_sequence` can not be compiled and the
+        `_masked_forward` would keep the activations of every padded (often empty) sentence for the backward.
+        """
         seq_lengths_clamped = torch.clamp(sequences_lengths, min=1, max=1000) 
         packed_batch = nn.utils.rnn.pack_padded_sequence(sequences_batch, seq_lengths_clamped, batch_first=True, enforce_sorted=False)
         outputs, _ = self._encoder(packed_batch)
@@ -313,6 +322,54 @@ class Seq2SeqEncoder(nn.Module):
 
         return outputs
 
+    def _masked_forward(self, sequences_batch, sequences_lengths):
+        """
+        Same as `_packed_forward` but without `pack_padded_sequence`, which the tracer does not support, used for the
+        export: each direction runs `torch.lstm` over the padded batch, the backward one over the sequences reversed
+        within their lengths, and the padded positions are zeroed.
+        Only the non-empty sequences go through the LSTM (most of the padded sentences of AHN are empty), plus the
+        first one so the LSTM never gets an empty batch.
+        NOTE: the outputs keep the `seq_len` of the inputs, the packed forward truncates them to the longest
+        sequence of the batch, the `max` over the words of AHN only differs if no sentence of the batch has `seq_len` words.
+        """
+        assert self.rnn_type is nn.LSTM
+        seq_len = sequences_batch.size(1)
+        nonempty_idxs, restoration_idxs = pack_rows(sequences_lengths > 0)
+
+        outputs = self._masked_lstm(sequences_batch.index_select(0, nonempty_idxs), sequences_lengths.index_select(0, nonempty_idxs))
+        outputs = outputs.index_select(0, restoration_idxs) #[bz, seq_len, hidden_dim]
+
+        positions = torch.arange(seq_len, device=sequences_batch.device).unsqueeze(0) #[1, seq_len]
+        valid_masks = positions < sequences_lengths.unsqueeze(1) #[bz, seq_len]
+        return torch.masked_fill(outputs, ~valid_masks.unsqueeze(2), 0.)
+
+    def _masked_lstm(self, sequences_batch, sequences_lengths):
+        bz, seq_len, _ = list(sequences_batch.size())
+        lengths = sequences_lengths.unsqueeze(1) #[bz, 1]
+        positions = torch.arange(seq_len, device=sequences_batch.device).unsqueeze(0) #[1, seq_len]
+        valid_masks = positions < lengths #[bz, seq_len]
+        reversed_idxs = torch.where(valid_masks, lengths - 1 - positions, positions).unsqueeze(2) #[bz, seq_len, 1]
+
+        def reverse(inputs):
+            return inputs.gather(1, reversed_idxs.expand(-1, -1, inputs.size(2)))
+
+        num_directions = 2 if self.bidirectional else 1
+        num_weights = 4 if self.bias else 2
+        flat_weights = self._encoder._flat_weights
+        outputs = sequences_batch
+        for layer in range(self.num_layers):
+            direction_outputs = []
+            for direction in range(num_directions):
+                start = (layer * num_directions + direction) * num_weights
+                inputs = outputs if direction == 0 else reverse(outputs)
+                hiddens = inputs.new_zeros(1, bz, self.hidden_size)
+                direction_output, _, _ = torch.lstm(inputs, (hiddens, hiddens), flat_weights[start:start+num_weights],
+                                                    self.bias, 1, 0., self.training, False, True)
+                direction_outputs.append(direction_output if direction == 0 else reverse(direction_output))
+            outputs = torch.cat(direction_outputs, dim=2)
+
+        return outputs
+
 
 # ============== Modules for Feature Enhancements ===============
 class Embedding(nn.Module):
@@ -628,26 +685,14 @@ class UnbalancedCoAttentionAggregator(nn.Module):
         item_all_sent_inputs = item_sent_inputs.view(bz, ir_num*is_num, in_features)
         item_all_sent_inputs = item_all_sent_inputs * item_all_sent_weights.unsqueeze(-1)
 
-        chunks_of_user_sent_inputs = torch.chunk(user_sent_inputs, dim=1, chunks=ur_num)
-        chunks_of_user_sent_masks = torch.chunk(user_sent_masks, dim=1, chunks=ur_num)
-        user_review_outputs = []
-        user_sent_weights = []
-        for user_sent_inputs_pr, user_sent_masks_pr in zip(chunks_of_user_sent_inputs, chunks_of_user_sent_masks):
-            user_sent_inputs_pr = user_sent_inputs_pr.squeeze(1) #[bz, us_num, in_features]
-            user_sent_masks_pr = user_sent_masks_pr.squeeze(1) #[bz, us_num]
-            
-            ui_similarity_score_pr =  self.bilinear(user_sent_inputs_pr, item_all_sent_inputs) #[bz, us_num, ir_num*is_num]
-            user_sent_scores_pr, _ = torch.max(ui_similarity_score_pr, dim=2) #[bz, us_num]
-            user_sent_weights_pr = masked_softmax(user_sent_scores_pr, user_sent_masks_pr)
-            
-            user_review_output_pr = attention_weighted_sum(user_sent_weights_pr, user_sent_inputs_pr)
-            user_review_output_pr = user_review_output_pr.unsqueeze(1) # NOTE: dirty implementation, [bz, 1, out_features]
-            user_sent_weights_pr = user_sent_weights_pr.unsqueeze(1) # [bz, 1, us_num]
-            user_review_outputs.append(user_review_output_pr) # list of [bz, 1, in_features]
-            user_sent_weights.append(user_sent_weights_pr)
-        #print("user review outputs element", user_review_outputs[0].shape)
-        user_review_outputs = torch.cat(user_review_outputs, dim=1)
-        user_sent_weights = torch.cat(user_sent_weights, dim=1)
+        # all the reviews of the user at once
+        ui_similarity_scores = self.bilinear(user_sent_inputs.view(bz, ur_num*us_num, in_features), item_all_sent_inputs) #[bz, ur_num*us_num, ir_num*is_num]
+        user_sent_scores, _ = torch.max(ui_similarity_scores, dim=2)
+        user_sent_weights = masked_softmax(user_sent_scores.view(bz, ur_num, us_num), user_sent_masks) #[bz, ur_num, us_num]
+
+        user_review_outputs = attention_weighted_sum(user_sent_weights.view(bz*ur_num, us_num),
+                                                    user_sent_inputs.view(bz*ur_num, us_num, in_features))
+        user_review_outputs = user_review_outputs.view(bz, ur_num, in_features)
 
         if debug:
             print("UnbalancedCoAttentionAggregator: ")
@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.nn.functional as F 
 
 from .utils import masked_tensor
+from utils import masked_max_pool1d
 
 class WordEmbedding(nn.Module):
     def __init__(self, vocab_size, embedding_dim, pretrained_embeddings=None, padding_idx=0, freeze_embeddings=False):
@@ -78,18 +79,22 @@ class HierPooling(nn.Module):
         else:
             self.proj_layer = None
     
-    def forward(self, inputs):
+    def forward(self, inputs, input_masks=None):
         """
         NOTE: use N x C x L format
         Args:
             inputs: [bz, in_features, seq_len]
+            input_masks: [bz, seq_len], if given, only windows starting at a valid position are pooled.
         
         Returns:
             outputs: [bz, out_features]
         """
         inputs = F.avg_pool1d(inputs, self.kernel_size, stride=1)
-        seq_len = inputs.size(2)
-        outputs = F.max_pool1d(inputs, seq_len).squeeze(2)
+        if input_masks is not None:
+            outputs = masked_max_pool1d(inputs, input_masks).squeeze(2)
+        else:
+            seq_len = inputs.size(2)
+            outputs = F.max_pool1d(inputs, seq_len).squeeze(2)
         assert outputs.dim() == 2
 
         if self.proj_layer is not None:
@@ -98,15 +103,19 @@ class HierPooling(nn.Module):
         return outputs
 
 class NgramFeat(nn.Module):
+    """
+    NOTE: `seq_len` is only the maximum length, the pooling is masked so inputs can be
+    truncated to the longest sequence of the batch.
+    """
     def __init__(self, kernel_sizes, in_features, out_features, seq_len, dropout=0., arch="CNN"):
         super().__init__()
 
         self.arch = arch
+        self.seq_len = seq_len
         if arch == "CNN":
             print("use CNN archiecture for Ngram.")
             self.feature_layer = nn.Sequential(MyConv1d(kernel_sizes, in_features, out_features),
-                                                nn.ReLU(),
-                                                nn.MaxPool1d(seq_len))
+                                                nn.ReLU())
         elif arch == "HierPooling":
             print("use HierPooling arch for Ngram.")
             assert len(kernel_sizes) == 1
@@ -130,7 +139,12 @@ class NgramFeat(nn.Module):
         """
         inputs = masked_tensor(inputs, input_masks)
         inputs = inputs.transpose(1,2) #[bz, feat, seq_len]
-        outputs = self.feature_layer(inputs)
+        if self.arch == "CNN":
+            outputs = self.feature_layer(inputs) #[bz, out_features, seq_len]
+            outputs = masked_max_pool1d(outputs, input_masks) #[bz, out_features, 1]
+        else:
+            hier_pooling, activation = self.feature_layer
+            outputs = activation(hier_pooling(inputs, input_masks))
         outputs = outputs.contiguous()
         
         return outputs
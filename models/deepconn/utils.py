@@ -1,6 +1,8 @@
 import torch
 import torch.nn.functional as F 
 
+from utils import masked_mean_pool1d
+
 def masked_softmax(input_scores, input_masks):
     """
     Args:
@@ -27,21 +29,8 @@ def masked_colwise_mean(inputs, input_masks):
     Returns:
         outputs: [bz, row, 1]
     """
-    """
-    assert input_scores.dim() == input_masks.dim()
-    input_scores = input_scores.sum(dim=-1, keepdim=True) #[bz, row, 1]
-
-    int_masks = input_masks.float() 
-    input_lenghts = int_masks.sum(dim=-1, keepdim=True) #[bz, 1, 1]
-
-    return input_scores / (input_lenghts + 1.)
-    """
-    assert input_masks.dim() == 3
-   
-    float_masks = input_masks.float() #[bz, 1, seq_len]
-    input_lengths = float_masks.sum(dim=2, keepdim=True) + 1e-8  #[bz, 1, 1]
-    sum_inputs = (inputs * float_masks).sum(dim=2, keepdim=True) #[bz, hdim, 1]
-    return sum_inputs / input_lengths
+    assert input_masks.dim() == 3 and input_masks.size(1) == 1
+    return masked_mean_pool1d(inputs, input_masks.squeeze(1))
     
 
 
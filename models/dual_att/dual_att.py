@@ -37,21 +37,23 @@ class DualAtt(nn.Module):
     def forward(self, u_docs, i_docs):
         """
         Args: 
-            u_docs: [bz, doc_len]
-            i_docs: [bz, doc_len]
+            u_docs: [bz, u_doc_len], u_doc_len <= doc_len
+            i_docs: [bz, i_doc_len], i_doc_len <= doc_len
         Returns:
             ratings: [bz]
         """
-        user_input = self.word_embeddings(u_docs)
-        item_input = self.word_embeddings(i_docs)
-        u_local_out = self.u_local_atten(user_input)
-        u_global_out_1, u_global_out_2, u_global_out_3 = self.u_global_atten(user_input)
+        u_masks = u_docs.ne(0)
+        i_masks = i_docs.ne(0)
+        user_input = torch.masked_fill(self.word_embeddings(u_docs), ~u_masks.unsqueeze(-1), 0.)
+        item_input = torch.masked_fill(self.word_embeddings(i_docs), ~i_masks.unsqueeze(-1), 0.)
+        u_local_out = self.u_local_atten(user_input, u_masks)
+        u_global_out_1, u_global_out_2, u_global_out_3 = self.u_global_atten(user_input, u_masks)
         u_feat = torch.cat((u_local_out,u_global_out_1, u_global_out_2, u_global_out_3), 1)
         u_feat = u_feat.view(u_feat.size(0), -1) #[bz, feat_size]
         u_feat = self.fc(u_feat) # [bz, hidden_size_2]
 
-        i_local_out = self.i_local_atten(item_input)
-        i_global_out_1, i_global_out_2, i_global_out_3 = self.i_global_atten(item_input)
+        i_local_out = self.i_local_atten(item_input, i_masks)
+        i_global_out_1, i_global_out_2, i_global_out_3 = self.i_global_atten(item_input, i_masks)
         i_feat = torch.cat((i_local_out, i_global_out_1, i_global_out_2, i_global_out_3), 1)
         i_feat = i_feat.view(i_feat.size(0), -1)
         i_feat = self.fc(i_feat)
@@ -2,6 +2,7 @@ import torch.nn as nn
 import torch 
 import torch.nn.functional as  F
 
+from utils import masked_max_pool1d
 
 
 
@@ -23,6 +24,10 @@ class WordEmbedding(nn.Module):
         return out
 
 class LocalAttention(nn.Module):
+    """
+    NOTE: `doc_len` is only the maximum length, the max pooling is masked so any
+    document length up to `doc_len` is accepted.
+    """
     def __init__(self, doc_len, window_size, out_size, emb_size=100):
         super(LocalAttention, self).__init__()
         self.window_size = window_size
@@ -36,19 +41,20 @@ class LocalAttention(nn.Module):
                         nn.Sigmoid())
         self.conv = nn.Sequential(
                         nn.Conv1d(emb_size, out_size, kernel_size=1),
-                        nn.Tanh(),
-                        nn.MaxPool1d(doc_len))
+                        nn.Tanh())
 
 
-    def forward(self, x):
+    def forward(self, x, x_masks):
         """
         Args:
-            x: torch.Tensor with shape of [bz, doc_len, emb_size]
+            x: torch.Tensor with shape of [bz, seq_len, emb_size], seq_len <= doc_len
+            x_masks: BoolTensor with shape of [bz, seq_len]
         """
         x = x.permute(0,2,1).contiguous()
         score = self.attn(x)
-        out = torch.mul(score, x) #[bz, emb_size, doc_len]
-        out = self.conv(out) #[bz, out_size, 1]
+        out = torch.mul(score, x) #[bz, emb_size, seq_len]
+        out = self.conv(out) #[bz, out_size, seq_len]
+        out = masked_max_pool1d(out, x_masks) #[bz, out_size, 1]
 
         return out
 
@@ -56,6 +62,8 @@ class GlobalAttention(nn.Module):
     def __init__(self, doc_len, out_size, emb_size=100):
         """
         Note: we hard encode the window size [2, 3, 4]
+        Note: the attention convolution spans `doc_len` positions, a shorter input only meets its
+            first `seq_len` taps; the remaining taps would see zeroed padding anyway.
         """
         super(GlobalAttention, self).__init__()
         self.doc_len = doc_len
@@ -67,24 +75,33 @@ class GlobalAttention(nn.Module):
                         nn.Sigmoid())
         self.conv1 = nn.Sequential(
                         nn.Conv1d(emb_size, out_size, kernel_size=2),
-                        nn.Tanh(),
-                        nn.MaxPool1d(doc_len-1))
+                        nn.Tanh())
         self.conv2 = nn.Sequential(
                         nn.Conv1d(emb_size, out_size, kernel_size=3),
-                        nn.Tanh(),
-                        nn.MaxPool1d(doc_len-2))
+                        nn.Tanh())
         self.conv3 = nn.Sequential(
                         nn.Conv1d(emb_size, out_size, kernel_size=4),
-                        nn.Tanh(),
-                        nn.MaxPool1d(doc_len-3))
+                        nn.Tanh())
 
-    def forward(self, x):
+    def forward(self, x, x_masks):
+        """
+        Args:
+            x: torch.Tensor with shape of [bz, seq_len, emb_size], 4 <= seq_len <= doc_len
+            x_masks: BoolTensor with shape of [bz, seq_len]
+        """
+        seq_len = x.size(1)
+        assert seq_len <= self.doc_len
         x = x.permute(0,2,1).contiguous()
-        score = self.attn(x)
-        out = torch.mul(score, x) #[bz, emb_size, doc_len]
-        out_1 = self.conv1(out)
-        out_2 = self.conv2(out)
-        out_3 = self.conv3(out) #[bz, out_size, 1]
+        attn_conv = self.attn[0]
+        # the convolution spans the whole input: a dot product with the first `seq_len` taps, sliced by
+        # the traced size of `x` so the exported models keep a dynamic document length
+        attn_weight = attn_conv.weight[:, :, :x.size(2)] #[1, emb_size, seq_len]
+        score = torch.sigmoid(torch.sum(x * attn_weight, dim=(1, 2), keepdim=True) + attn_conv.bias) #[bz, 1, 1]
+        out = torch.mul(score, x) #[bz, emb_size, seq_len]
+        # pool over the windows starting at a valid position
+        out_1 = masked_max_pool1d(self.conv1(out), x_masks)
+        out_2 = masked_max_pool1d(self.conv2(out), x_masks)
+        out_3 = masked_max_pool1d(self.conv3(out), x_masks) #[bz, out_size, 1]
 
         return (out_1, out_2, out_3)
 
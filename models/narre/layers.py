@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.nn.functional as F 
 
 from .utils import masked_tensor, masked_softmax, attention_weighted_sum, get_mask, masked_colwise_mean
+from utils import masked_mean_pool1d
 
 """
 Not use bias when computing WordScore Layer
@@ -69,14 +70,7 @@ class MaskedAvgPooling1d(nn.Module):
         Returns: 
             outputs: [bz, hdim, 1]
         """
-        assert input_masks.dim() == 2
-        float_masks = input_masks.unsqueeze(1).float() #[bz, 1, seq_len]
-        input_lengths = float_masks.sum(dim=2, keepdim=True) + 1e-8  #[bz, 1, 1]
-        #print("inputs: ", inputs)
-        #print("input_lengths: ", input_lengths)
-        sum_inputs = (inputs * float_masks).sum(dim=2, keepdim=True) #[bz, hdim, 1]
-        #print(sum_inputs)
-        return sum_inputs / input_lengths
+        return masked_mean_pool1d(inputs, input_masks)
 
 class HierPooling(nn.Module):
     """
@@ -358,7 +352,7 @@ class MaxAvgPooling1d(nn.Module):
         inputs = inputs.transpose(1,2)
 
         avg_feat = self.masked_avgpool_1d(inputs, masks) #[bz, hidden_dim, 1]
-        max_feat = self.max_pool1d(inputs, seq_len) #[bz, hidden_dim, 1]
+        max_feat = F.max_pool1d(inputs, seq_len) #[bz, hidden_dim, 1]
 
         return torch.cat([avg_feat, max_feat], dim=1).view(bz, 2*hdim)
 
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 
 from .layers import NgramFeat
 from .utils import masked_tensor
+from utils import pack_rows, unpack_rows
 
 class WordEmbedding(nn.Module):
     def __init__(self, vocab_size, embedding_dim, pretrained_embeddings=None, padding_idx=0, freeze_embeddings=False):
@@ -37,11 +38,12 @@ class LinearAttention(nn.Module):
 
         self.dropout = nn.Dropout(p=dropout)
 
-    def forward(self, feat, other_id):
+    def forward(self, feat, other_id, masks=None):
         """
         Args:
             feat: [bz, dnum, hidden_dim]
             other_id: [bz, dnum]
+            masks: [bz, dnum], the padded reviews (False) get a zero score
 
         Returns:
             out: [bz, hidden_dim]
@@ -55,7 +57,10 @@ class LinearAttention(nn.Module):
         att_logits = F.relu(feat @ self.W_rv + other_ebd @ self.W_id + self.b_1) @ self.h + self.b_2
 
 
-        att_scores = att_logits.exp() / (att_logits.exp().sum(dim=1, keepdim=True) + 1e-8)
+        att_exps = att_logits.exp()
+        if masks is not None:
+            att_exps = att_exps * masks.unsqueeze(-1).to(att_exps.dtype)
+        att_scores = att_exps / (att_exps.sum(dim=1, keepdim=True) + 1e-8)
 
         out = torch.sum(torch.mul(att_scores, feat), dim=1) #[bz, hidden_dim]
 
@@ -140,13 +145,16 @@ class NARRE(nn.Module):
     def __init__(self, user_size, item_size, vocab_size,
                 kernel_sizes, hidden_dim, embedding_dim, att_dim, latent_dim,
                 max_doc_num, max_doc_len, dropout, word_padding_idx,
-                user_padding_idx, item_padding_idx, pretrained_embeddings, arch):
+                user_padding_idx, item_padding_idx, pretrained_embeddings, arch, mask_padded_reviews=False):
         super(NARRE, self).__init__()
 
         self.embedding_dim = embedding_dim
         self.hiddem_dim = hidden_dim
         self.doc_num = max_doc_num 
         self.doc_len = max_doc_len
+        # False: the padded reviews get the feature of an all padding review and an attention weight, as in the
+        # original NARRE, the outputs depend on the number of padded reviews
+        self.mask_padded_reviews = mask_padded_reviews
 
         self.word_embeddings =  WordEmbedding(vocab_size, embedding_dim, pretrained_embeddings=pretrained_embeddings)
 
@@ -162,27 +170,58 @@ class NARRE(nn.Module):
         self.fm = FM(user_size, item_size, latent_dim, dropout, user_padding_idx=user_padding_idx,
                     item_padding_idx=item_padding_idx)
 
-    def forward(self, u_text, i_text, u_text_masks, i_text_masks, u_id, i_id, reuid, reiid):
-        u_text = self.word_embeddings(u_text)
-        i_text = self.word_embeddings(i_text)
+    def encode_reviews(self, text, text_masks):
+        """
+        Only the non-empty reviews go through the embedding and the ngram layer, packed in a single batch.
+        Args:
+            text: [bz, rv_num, rv_len], `rv_num` may be smaller than `max_doc_num` with `mask_padded_reviews`
+                (see `collate_fn`)
+            text_masks: [bz, rv_num, rv_len]
 
-        # get each doc feature 
-        u_text = u_text.view(-1, self.doc_len, self.embedding_dim)
-        i_text = i_text.view(-1, self.doc_len, self.embedding_dim) 
-        u_text_masks = u_text_masks.view(-1, self.doc_len)
-        i_text_masks = i_text_masks.view(-1, self.doc_len)
+        Returns:
+            feat: [bz, rv_num, hidden_dim], for the empty reviews 0 with `mask_padded_reviews`, else the feature
+                of an all padding review
+            rev_masks: [bz, rv_num]
+        """
+        bz, rv_num, rv_len = list(text.size())
+        rev_masks = text_masks.any(dim=-1)
+        packed_idxs, restoration_idxs = pack_rows(rev_masks.view(-1))
+
+        text = self.word_embeddings(text.view(-1, rv_len).index_select(0, packed_idxs))
+        text_masks = text_masks.view(-1, rv_len).index_select(0, packed_idxs)
+        feat = self.ngram(text, text_masks).view(-1, self.hiddem_dim) #[num_packed+1, hidden_dim]
+        feat = unpack_rows(feat, restoration_idxs, rev_masks.view(-1))
+        if not self.mask_padded_reviews:
+            # computed once instead of for each empty review
+            empty_feat = self.ngram(self.word_embeddings(packed_idxs.new_zeros(1, rv_len)), text_masks.new_zeros(1, rv_len))
+            feat = torch.where(rev_masks.view(-1, 1), feat, empty_feat.view(1, self.hiddem_dim))
 
-        u_feat = self.ngram(u_text, u_text_masks)
-        i_feat = self.ngram(i_text, i_text_masks)
+        return feat.view(bz, rv_num, self.hiddem_dim), rev_masks
 
-        u_feat = u_feat.view(-1, self.doc_num, self.hiddem_dim)
-        i_feat = i_feat.view(-1, self.doc_num, self.hiddem_dim)
-        u_text_masks = u_text_masks.view(-1, self.doc_num)
-        i_text_masks = i_text_masks.view(-1, self.doc_num)
+    def forward(self, u_text, i_text, u_text_masks, i_text_masks, u_id, i_id, reuid, reiid):
+        """
+        Args:
+            u_text: [bz, u_rv_num, rv_len]
+            i_text: [bz, i_rv_num, rv_len]
+            u_text_masks: [bz, u_rv_num, rv_len]
+            i_text_masks: [bz, i_rv_num, rv_len]
+            u_id, i_id: [bz]
+            reuid: [bz, u_rv_num]
+            reiid: [bz, i_rv_num]
 
+        Returns:
+            pred: [bz]
+            u_att_scores: [bz, u_rv_num, 1]
+            i_att_scores: [bz, i_rv_num, 1]
+        """
+        # get each review feature
+        u_feat, u_rev_masks = self.encode_reviews(u_text, u_text_masks)
+        i_feat, i_rev_masks = self.encode_reviews(i_text, i_text_masks)
 
-        u_feat, u_att_scores = self.user_att(u_feat, reuid)
-        i_feat, i_att_scores = self.item_att(i_feat, reiid)
+        if not self.mask_padded_reviews:
+            u_rev_masks, i_rev_masks = None, None
+        u_feat, u_att_scores = self.user_att(u_feat, reuid, u_rev_masks)
+        i_feat, i_att_scores = self.item_att(i_feat, reiid, i_rev_masks)
 
         u_feat = self.user_feat(u_feat, u_id)
         i_feat = self.item_feat(i_feat, i_id)
@@ -190,5 +229,3 @@ class NARRE(nn.Module):
         pred = self.fm(u_feat, i_feat, u_id, i_id)
 
         return pred.view(-1), u_att_scores, i_att_scores
-
-
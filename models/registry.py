@@ -0,0 +1,42 @@
+"""
+NOTE:
+    - Registry of the models, shared by the tools which rebuild a model from its name (`export.py`, `quantize.py`,
+    `compress.py`, `evaluate.py`) and by the benchmarks.
+    - `MODELS[name]`: trainer module, experiment class, dataset class, default config (relative to the repository
+    root), preprocessing pipeline ("word", "sent" or "doc"), batch -> (model inputs, ratings).
+"""
+
+def narre_inputs(experiment, batch):
+    u_text, i_text, u_rv_masks, i_rv_masks, u_id, i_id, reuid, reiid, label = batch
+    return (u_text, i_text, u_rv_masks, i_rv_masks, u_id, i_id, reuid, reiid), label
+
+def ahn_inputs(experiment, batch):
+    u_text, i_text, u_id, i_id, _, _, label = batch
+    inputs = (u_text, i_text, experiment.get_sent_mask(u_text), experiment.get_sent_mask(i_text),
+                experiment.get_sent_lengths(u_text), experiment.get_sent_lengths(i_text),
+                experiment.get_review_mask(u_text), experiment.get_review_mask(i_text), u_id, i_id)
+    return inputs, label
+
+def deepconn_inputs(experiment, batch):
+    u_docs, i_docs, u_doc_word_masks, i_doc_word_masks, u_ids, i_ids, ratings = batch
+    return (u_docs, i_docs, u_doc_word_masks, i_doc_word_masks, u_ids, i_ids), ratings
+
+def dual_att_inputs(experiment, batch):
+    u_docs, i_docs, ratings = batch
+    return (u_docs, i_docs), ratings
+
+def simple_siamese_inputs(experiment, batch):
+    return tuple(batch[:8]), batch[8]
+
+MODELS = {
+    "narre": ("trainer.train_narre", "NarreExperiment", "NarreDataset", "models/narre/default_narre.json",
+                "word", narre_inputs),
+    "ahn": ("trainer.train_ahn", "AhnExperiment", "AhnDataset", "models/ahn/default_ahn.json",
+                "sent", ahn_inputs),
+    "deepconn_pp": ("trainer.train_deepconn_pp", "DeepCoNNExperiment", "DeepCoNNDataset", "models/deepconn/default_deepconn_pp.json",
+                "doc", deepconn_inputs),
+    "dual_att": ("trainer.train_dual_att", "DualAttExperiment", "DualAttDataset", "models/dual_att/default_dual_att.json",
+                "doc", dual_att_inputs),
+    "simple_siamese": ("trainer.train_simple_siamese", "NarreExperiment", "NarreDataset", "models/simple_siamese/defalut_simple_train.json",
+                "word", simple_siamese_inputs),
+}
@@ -3,6 +3,7 @@ import torch
 import torch.nn.functional as  F
 
 from .utils import masked_tensor
+from utils import masked_mean_pool1d, segment_softmax, segment_sum
 
 class NodeDropout(torch.nn.Dropout):
     def forward(self, input_tensor):
@@ -100,14 +101,7 @@ class MaskedAvgPooling1d(nn.Module):
         Returns: 
             outputs: [bz, hdim, 1]
         """
-        assert input_masks.dim() == 2
-        float_masks = input_masks.unsqueeze(1).float() #[bz, 1, seq_len]
-        input_lengths = float_masks.sum(dim=2, keepdim=True) + 1e-8  #[bz, 1, 1]
-        #print("inputs: ", inputs)
-        #print("input_lengths: ", input_lengths)
-        sum_inputs = (inputs * float_masks).sum(dim=2, keepdim=True) #[bz, hdim, 1]
-        #print(sum_inputs)
-        return sum_inputs / input_lengths
+        return masked_mean_pool1d(inputs, input_masks)
 
 class TanhNgramFeat(nn.Module):
     def __init__(self, kernel_sizes, in_feature, out_feature_per_kernel, seq_len, mode="MAX_AVG"):
@@ -196,6 +190,20 @@ class AddictiveAttention(nn.Module):
 
         return outptus, att_scores
 
+    def forward_ragged(self, inputs, offsets):
+        """
+        Args:
+            inputs: [num_rows, hdim], the rows of all the examples
+            offsets: [bz+1], the rows of example k are `inputs[offsets[k]:offsets[k+1]]`
+
+        Returns:
+            outputs: [bz, hdim], 0 for the examples without rows
+            att_scores: [num_rows]
+        """
+        att_scores = segment_softmax(self.inner_product(self.proj_layer(inputs)).squeeze(-1), offsets)
+
+        return segment_sum(att_scores.unsqueeze(-1) * inputs, offsets), att_scores
+
 
 class RepByRatMask(nn.Module):
     def __init__(self, hidden_dim, latent_dim, num_type_of_rating=5):
@@ -4,16 +4,18 @@ import torch.nn.functional as F
 
 from .layers import WordEmbedding, MaskedAvgPooling1d, AddictiveAttention, LastFeat, FM, VariationalDropout, FMWithoutUIBias, NodeDropout
 from .utils import get_rev_mask
+from utils import pack_rows, unpack_rows, embedding_bag_mean
 
 class SimpleSiamese(nn.Module):
     def __init__(self, embedding_dim, latent_dim,
                 vocab_size, user_size, item_size,
                 pretrained_embeddings, freeze_embeddings, 
-                dropout, word_dropout, review_dropout, use_ui_bias, latent_transform):
+                dropout, word_dropout, review_dropout, use_ui_bias, latent_transform, embedding_bag=False):
         super().__init__() 
         self.use_ui_bias = use_ui_bias
         self.embedding_dim = embedding_dim
         self.latent_transform = latent_transform
+        self.embedding_bag = embedding_bag
 
         self.word_embedding = WordEmbedding(vocab_size, embedding_dim, pretrained_embeddings=pretrained_embeddings,
                                             freeze_embeddings=freeze_embeddings, padding_idx=0)      
@@ -35,15 +37,43 @@ class SimpleSiamese(nn.Module):
         else:
             self.fm = FMWithoutUIBias(user_size, item_size, latent_dim, dropout, user_padding_idx=0, item_padding_idx=0)
 
+    def encode_reviews(self, revs, rev_word_masks, rev_masks):
+        """
+        Only the non-empty reviews go through the embedding and the pooling, packed in a single batch. With
+        `embedding_bag` the mean of the word embeddings of each review is computed by `F.embedding_bag`, the
+        [num_reviews, rv_len, embedding_dim] embeddings are not materialized.
+        Args:
+            revs: [bz, rv_num, rv_len]
+            rev_word_masks: [bz, rv_num, rv_len]
+            rev_masks: [bz, rv_num]
+
+        Returns:
+            revs: [bz, rv_num, embedding_dim], 0 for the empty reviews
+        """
+        bz, rv_num, rv_len = list(revs.size())
+        rev_masks = rev_masks.view(-1)
+        packed_idxs, restoration_idxs = pack_rows(rev_masks)
+
+        packed_revs = revs.view(-1, rv_len).index_select(0, packed_idxs)
+        if self.embedding_bag:
+            # the variational dropout mask is shared by the words of a review, it commutes with their mean
+            packed_revs = self.var_dropout(embedding_bag_mean(self.word_embedding, packed_revs).unsqueeze(1))
+        else:
+            packed_revs = self.var_dropout(self.word_embedding(packed_revs)).transpose(1,2)
+            packed_revs = self.masked_pooling_1d(packed_revs, rev_word_masks.view(-1, rv_len).index_select(0, packed_idxs))
+        revs = unpack_rows(packed_revs.view(-1, self.embedding_dim), restoration_idxs, rev_masks)
+
+        return revs.view(bz, rv_num, self.embedding_dim)
+
     def forward(self, u_revs, i_revs, u_rev_word_masks, i_rev_word_masks, u_rev_masks, i_rev_masks, u_ids, i_ids):
         """
         Args:
-            u_revs: [bz, rv_num, rv_len]
-            i_revs:
-            u_rev_word_masks: [bz, rv_num, rv_len]
+            u_revs: [bz, u_rv_num, rv_len], `u_rv_num` may change between batches (see `collate_fn`)
+            i_revs: [bz, i_rv_num, rv_len]
+            u_rev_word_masks: [bz, u_rv_num, rv_len]
             i_rev_word_masks
-            u_rev_masks: [bz, rv_num]
-            i_rev_masks: [bz, rv_num]
+            u_rev_masks: [bz, u_rv_num]
+            i_rev_masks: [bz, i_rv_num]
             u_ids: [bz]
             i_ids: [bz]
         
@@ -52,16 +82,11 @@ class SimpleSiamese(nn.Module):
             u_rev_scores: [bz, rv_num]
             i_rev_scores: [bz, ]
         """
-        bz, u_rv_num, rv_len = list(u_revs.size())
-        bz, i_rv_num, rv_len = list(i_revs.size())
-
-        # each review representation
-        u_revs = self.var_dropout(self.word_embedding(u_revs).view(bz*u_rv_num, rv_len, self.embedding_dim)).transpose(1,2)
-        i_revs = self.var_dropout(self.word_embedding(i_revs).view(bz*i_rv_num, rv_len, self.embedding_dim)).transpose(1,2)
+        bz = u_revs.size(0)
 
-        # avg pooling 
-        u_revs = self.masked_pooling_1d(u_revs, u_rev_word_masks.view(bz*u_rv_num, rv_len)).view(bz, u_rv_num, self.embedding_dim)
-        i_revs = self.masked_pooling_1d(i_revs, i_rev_word_masks.view(bz*i_rv_num, rv_len)).view(bz, i_rv_num, self.embedding_dim)
+        # each review representation, avg pooling
+        u_revs = self.encode_reviews(u_revs, u_rev_word_masks, u_rev_masks)
+        i_revs = self.encode_reviews(i_revs, i_rev_word_masks, i_rev_masks)
 
         if self.latent_transform:
             u_revs = self.latent_transform_layer(u_revs)
@@ -85,4 +110,47 @@ class SimpleSiamese(nn.Module):
         else:
             out_logits = self.fm(u_feat, i_feat)
 
-        return out_logits.view(bz), None, None
\ No newline at end of file
+        return out_logits.view(bz), None, None
+
+    def forward_ragged(self, u_reviews, i_reviews, u_ids, i_ids):
+        """
+        Same as `forward` on the reviews without padding, the review embeddings are averaged by `F.embedding_bag`
+        and the attention is a softmax within the reviews of each example.
+        Args:
+            u_reviews: RaggedReviews (`utils.RaggedReviews`) with bz examples, word level
+            i_reviews: RaggedReviews with bz examples
+            u_ids: [bz]
+            i_ids: [bz]
+
+        Returns:
+            out_logits: [bz]
+        """
+        bz = u_ids.size(0)
+
+        u_rev_feat = self.encode_ragged_reviews(u_reviews)
+        i_rev_feat = self.encode_ragged_reviews(i_reviews)
+
+        u_feat = self.user_last_feat_layer(u_rev_feat, u_ids)
+        i_feat = self.item_last_feat_layer(i_rev_feat, i_ids) #[bz, hdim]
+
+        if self.use_ui_bias:
+            out_logits = self.fm(u_feat, i_feat, u_ids, i_ids)
+        else:
+            out_logits = self.fm(u_feat, i_feat)
+
+        return out_logits.view(bz), None, None
+
+    def encode_ragged_reviews(self, reviews):
+        """
+        Returns:
+            rev_feat: [bz, hdim], 0 for the examples without reviews
+        """
+        # the variational dropout mask is shared by the words of a review, it commutes with their mean
+        revs = self.var_dropout(embedding_bag_mean(self.word_embedding, reviews.tokens, reviews.token_offsets).unsqueeze(1)).squeeze(1)
+
+        if self.latent_transform:
+            revs = self.latent_transform_layer(revs)
+        revs = self.review_dropout(revs.unsqueeze(0)).squeeze(0) #[num_reviews, hdim]
+
+        rev_feat, _ = self.review_att_layer.forward_ragged(revs, reviews.review_offsets)
+        return rev_feat
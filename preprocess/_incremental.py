@@ -0,0 +1,137 @@
+import os
+import json
+import gzip
+import pickle
+import hashlib
+
+import pandas as pd
+
+"""
+NOTE:
+    - Helpers shared by the `divide_and_create_example_*` scripts.
+    - Incremental mode (`--delta_path`): a delta of new reviews is appended to an already preprocessed `dest_dir`,
+    new reviews are indexed with the frozen vocab of the meta and only the new interactions become examples,
+    so the cost is proportional to the delta instead of the corpus: the reviews are appended to the npy files of
+    the meta (`_meta.append_reviews`), the examples to their pickle (`append_examples`), only `meta.json` and
+    `id_maps.pkl` are rewritten.
+    - The digest of every applied delta is kept in `meta.json` (`"deltas"`), applying the same delta to the same set
+    again is skipped (`is_applied_delta`).
+"""
+
+def read_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def write_pickle(path, data):
+    with open(path, "wb") as f:
+        pickle.dump(data, f)
+
+def read_examples(path):
+    """
+    Examples of a `*_exmaples.pkl`: the list written by the full preprocessing, followed by the lists appended by
+    the deltas (one pickle each).
+    """
+    examples = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                examples.extend(pickle.load(f))
+            except EOFError:
+                return examples
+
+def delta_digest(path, chunk_size=1<<20):
+    """
+    sha1 of the content of the delta file `path`.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_applied_delta(meta, set_name, digest):
+    """
+    Whether the delta with `digest` was already appended to `set_name`, else record it in `meta["deltas"]`,
+    written to `meta.json` with the other statistics at the end of the delta.
+    """
+    deltas = meta.setdefault("deltas", [])
+    if [set_name, digest] in deltas:
+        return True
+    deltas.append([set_name, digest])
+    return False
+
+def read_reviews(path):
+    """
+    Read an Amazon review dump (gzipped json lines) into a DataFrame with columns
+    `user_id`, `item_id`, `rating`, `review`, `time` (raw ids).
+    """
+    f = gzip.open(path)
+
+    users = []
+    items = []
+    ratings = []
+    reviews = []
+    times = []
+
+    for line in f:
+        js_dict = json.loads(line)
+        if str(js_dict['reviewerID'])=='unknown':
+            print("unknown user")
+            continue
+        if str(js_dict['asin'])=='unknown':
+            print("unknown item")
+            continue
+
+        users.append(js_dict["reviewerID"])
+        items.append(js_dict["asin"])
+        ratings.append(js_dict["overall"])
+        reviews.append(js_dict["reviewText"])
+        times.append(js_dict["unixReviewTime"])
+
+    df = pd.DataFrame({"user_id": pd.Series(users, dtype=object),
+                        "item_id": pd.Series(items, dtype=object),
+                        "rating": pd.Series(ratings, dtype=float),
+                        "review": pd.Series(reviews, dtype=object),
+                        "time": pd.Series(times, dtype="int64")})
+    return df
+
+def write_id_maps(dest_dir, user2id, item2id):
+    write_pickle(os.path.join(dest_dir, "id_maps.pkl"), {"user2id": user2id, "item2id": item2id})
+
+def map_delta_ids(delta_df, meta, dest_dir):
+    """
+    Numerize the raw ids of `delta_df` with the ids of the full preprocessing, unseen users and items
+    get new ids after the existing ones. `meta["user_num"]`, `meta["item_num"]` and `id_maps.pkl` are updated.
+    """
+    path = os.path.join(dest_dir, "id_maps.pkl")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, rerun the full preprocessing once before appending deltas.")
+    id_maps = read_pickle(path)
+    user2id, item2id = id_maps["user2id"], id_maps["item2id"]
+
+    # ids start at 1, "<pad>" is 0
+    for user in delta_df.user_id.unique():
+        if user not in user2id:
+            user2id[user] = len(user2id)
+    for item in delta_df.item_id.unique():
+        if item not in item2id:
+            item2id[item] = len(item2id)
+    print(f"new users: {len(user2id) - meta['user_num']}, new items: {len(item2id) - meta['item_num']}")
+
+    delta_df = delta_df.sort_values(by=["user_id", "time"]).reset_index(drop=True)
+    delta_df["user_id"] = delta_df["user_id"].map(user2id)
+    delta_df["item_id"] = delta_df["item_id"].map(item2id)
+    meta["user_num"] = max(meta["user_num"], len(user2id))
+    meta["item_num"] = max(meta["item_num"], len(item2id))
+
+    write_id_maps(dest_dir, user2id, item2id)
+    return delta_df
+
+def append_examples(dest_dir, set_name, examples):
+    """
+    Append `examples` to the end of `<set_name>_exmaples.pkl` as one more pickle, see `read_examples`.
+    """
+    path = os.path.join(dest_dir, f"{set_name}_exmaples.pkl")
+    with open(path, "ab") as f:
+        pickle.dump(examples, f)
+    print(f"append {len(examples)} examples to {path}")
@@ -0,0 +1,269 @@
+import os
+import json
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+from preprocess._incremental import read_pickle, write_pickle
+
+"""
+NOTE:
+    - Meta of a preprocessed `dest_dir` is split into components instead of a single `meta.pkl`:
+        `meta.json`: statistics (`user_num`, `item_num`, `rv_num`, ..., `vocab_size`), a few hundred bytes.
+        `indexlizer.pkl`: the `Indexlizer` (vocab, tokenizer), only needed for pretrained embeddings, decoding and deltas.
+        `{user,item}_reviews.npy`, `{user,item}_rids.npy`, `{user,item}_offsets.npy`: the reviews of every user (item)
+        as one flat int32 array, rows `offsets[k]:offsets[k+1]` belong to id k.
+        `{user,item}_delta_ids.npy`: the reviews of the deltas are appended after these rows (`append_reviews`),
+        the id of each appended row.
+        any other array of meta, e.g. `{user,item}_docs.npy` of the doc pipeline.
+    - `LazyMeta` reads `meta.json` only, other components are loaded (arrays memory-mapped) on first access,
+    so the start up of a Dataset or a DataLoader worker does not scale with the corpus.
+    - A delta only appends to the npy files in place (`append_npy`, the npy header is rewritten with the new
+    shape) and rewrites `meta.json`, its cost does not depend on the corpus.
+    - Convert an old `meta.pkl`: `python -m preprocess._meta --dest_dir <dest_dir>`
+"""
+
+HEADER_NAME = "meta.json"
+INDEXLIZER_NAME = "indexlizer.pkl"
+RAGGED_KEYS = ["user_reviews", "user_rids", "item_reviews", "item_rids"]
+
+class RaggedArray(object):
+    """
+    Read-only id -> rows mapping over a flat array, replaces the dict of lists `meta["user_reviews"]` etc.
+    Args:
+        data: np.ndarray with shape of [num_rows, ...]
+        offsets: np.ndarray with shape of [num_ids+1], rows of id k are `data[offsets[k]:offsets[k+1]]`
+        delta_ids: None or np.ndarray with shape of [num_rows - offsets[-1]], id of each row appended after
+            `offsets[-1]`, they follow the rows of `offsets` of their id, in order
+        num_ids: int, default to `len(offsets) - 1`, more when the deltas added ids
+    """
+    def __init__(self, data, offsets, delta_ids=None, num_ids=None):
+        self.data = data
+        self.offsets = offsets
+        self.num_ids = max(len(offsets) - 1, num_ids or 0)
+
+        self.delta_rows = None
+        if delta_ids is not None and len(delta_ids) > 0:
+            delta_ids = np.asarray(delta_ids, dtype=np.int64)
+            self.num_ids = max(self.num_ids, int(delta_ids.max()) + 1)
+            self.delta_rows = np.argsort(delta_ids, kind="stable") + int(offsets[-1])
+            self.delta_offsets = np.zeros(self.num_ids+1, dtype=np.int64)
+            np.cumsum(np.bincount(delta_ids, minlength=self.num_ids), out=self.delta_offsets[1:])
+
+    @classmethod
+    def from_dict(cls, id2rows, num_ids, dtype=np.int32):
+        lengths = np.array([len(id2rows.get(idx, [])) for idx in range(num_ids)], dtype=np.int64)
+        offsets = np.zeros(num_ids+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = np.asarray([row for idx in range(num_ids) for row in id2rows.get(idx, [])], dtype=dtype)
+        return cls(data, offsets)
+
+    def to_dict(self):
+        """
+        Returns:
+            id2rows: defaultdict(list), id -> list of rows (nested lists), ids without rows are absent.
+        """
+        return defaultdict(list, {idx: rows.tolist() for idx, rows in self.items()})
+
+    def __len__(self):
+        return self.num_ids
+
+    def rows(self, idx):
+        """
+        Returns:
+            rows: np.ndarray of int64, the rows of `data` of id `idx`, in order
+        """
+        rows = np.arange(self.offsets[idx], self.offsets[idx+1]) if idx < len(self.offsets) - 1 else np.zeros(0, dtype=np.int64)
+        if self.delta_rows is not None:
+            rows = np.concatenate([rows, self.delta_rows[self.delta_offsets[idx]:self.delta_offsets[idx+1]]])
+        return rows
+
+    def __getitem__(self, idx):
+        if self.delta_rows is None or self.delta_offsets[idx+1] == self.delta_offsets[idx]:
+            if idx >= len(self.offsets) - 1:
+                return self.data[:0]
+            return self.data[self.offsets[idx]:self.offsets[idx+1]]
+        return self.data[self.rows(idx)]
+
+    def __contains__(self, idx):
+        return 0 <= idx < len(self) and len(self.rows(idx)) > 0
+
+    def keys(self):
+        return [idx for idx in range(len(self)) if idx in self]
+
+    def items(self):
+        return [(idx, self[idx]) for idx in self.keys()]
+
+def to_builtin(val):
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+def write_meta(dest_dir, meta):
+    """
+    Write the components of `meta` (dict returned by `create_meta`) to `dest_dir`.
+    """
+    for key, val in meta.items():
+        if key == "indexlizer":
+            write_pickle(os.path.join(dest_dir, INDEXLIZER_NAME), val.freeze())
+        elif key in RAGGED_KEYS:
+            side = key.split("_")[0]
+            ragged = val if isinstance(val, RaggedArray) else RaggedArray.from_dict(val, int(meta[f"{side}_num"]))
+            np.save(os.path.join(dest_dir, f"{key}.npy"), ragged.data)
+            np.save(os.path.join(dest_dir, f"{side}_offsets.npy"), ragged.offsets)
+            # rows appended by former deltas are in `data` now
+            path = os.path.join(dest_dir, f"{side}_delta_ids.npy")
+            if os.path.exists(path):
+                os.remove(path)
+        elif isinstance(val, np.ndarray):
+            np.save(os.path.join(dest_dir, f"{key}.npy"), val)
+    write_header(dest_dir, meta)
+
+def write_header(dest_dir, meta):
+    """
+    Write the statistics of `meta` (every value but the indexlizer, the reviews and the arrays) to `meta.json`.
+    """
+    header = {}
+    for key, val in meta.items():
+        if key == "indexlizer":
+            header["vocab_size"] = len(val._vocab)
+        elif key not in RAGGED_KEYS and not isinstance(val, np.ndarray):
+            header[key] = to_builtin(val)
+
+    with open(os.path.join(dest_dir, HEADER_NAME), "w") as f:
+        json.dump(header, f, indent=2)
+
+def append_npy(path, rows):
+    """
+    Append `rows` to the array of the npy file `path` along its first axis, in place: the rows are written at the
+    end of the data and the npy header is rewritten with the new shape (numpy pads it for the first axis to grow).
+    The file is created if it does not exist.
+    """
+    if not os.path.exists(path):
+        np.save(path, rows)
+        return
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        header_len = f.tell()
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        if fortran_order or rows.shape[1:] != tuple(shape[1:]):
+            raise ValueError(f"cannot append rows with shape of {rows.shape} to {path} with shape of {shape}")
+
+        f.seek(header_len + int(np.prod(shape)) * dtype.itemsize)
+        f.write(rows.tobytes())
+        f.truncate()
+        f.seek(0)
+        write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+        write_header(f, {"shape": (shape[0] + len(rows),) + tuple(shape[1:]), "fortran_order": False,
+                        "descr": np.lib.format.dtype_to_descr(dtype)})
+        assert f.tell() == header_len, f"the npy header of {path} has no room for the new shape"
+
+def append_reviews(dest_dir, users, items, reviews):
+    """
+    Incremental mode: append the indexed reviews of a delta to the reviews of their user and item in `dest_dir`,
+    the other rows are not read nor rewritten.
+    Args:
+        users, items: list of int with length N
+        reviews: list with length N of the indexed reviews (same shape as the rows of `user_reviews`)
+    """
+    if len(reviews) == 0:
+        return
+    users = np.asarray(users, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int64)
+    reviews = np.asarray(reviews)
+    for side, ids, rids in [("user", users, items), ("item", items, users)]:
+        append_npy(os.path.join(dest_dir, f"{side}_reviews.npy"), reviews)
+        append_npy(os.path.join(dest_dir, f"{side}_rids.npy"), rids)
+        append_npy(os.path.join(dest_dir, f"{side}_delta_ids.npy"), ids)
+
+class LazyMeta(object):
+    """
+    Dict-like, read-only view of the meta of `data_dir`, each component is loaded on first access.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        path = os.path.join(data_dir, HEADER_NAME)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found, rerun the preprocessing or convert meta.pkl with "
+                                    f"`python -m preprocess._meta --dest_dir {data_dir}`.")
+        with open(path, "r") as f:
+            self.header = json.load(f)
+        self._components = {}
+
+    def __contains__(self, key):
+        return key in self.header or key == "indexlizer" or os.path.exists(os.path.join(self.data_dir, f"{key}.npy"))
+
+    def __getitem__(self, key):
+        if key in self.header:
+            return self.header[key]
+        if key not in self._components:
+            self._components[key] = self._load(key)
+        return self._components[key]
+
+    def _load(self, key):
+        if key == "indexlizer":
+            return read_pickle(os.path.join(self.data_dir, INDEXLIZER_NAME))
+        path = os.path.join(self.data_dir, f"{key}.npy")
+        if not os.path.exists(path):
+            raise KeyError(key)
+        data = np.load(path, mmap_mode="r")
+        if key in RAGGED_KEYS:
+            side = key.split("_")[0]
+            delta_ids = self[f"{side}_delta_ids"] if f"{side}_delta_ids" in self else None
+            return RaggedArray(data, self[f"{side}_offsets"], delta_ids, self[f"{side}_num"])
+        return data
+
+class RaggedLists(dict):
+    """
+    id -> list of rows (nested lists) of a `RaggedArray`, the rows of an id are read on its first access, as the
+    `defaultdict(list)` of `create_meta` an id without rows is added on access.
+    """
+    def __init__(self, ragged):
+        super(RaggedLists, self).__init__()
+        self.ragged = ragged
+
+    def __missing__(self, idx):
+        self[idx] = self.ragged[idx].tolist() if idx < len(self.ragged) else []
+        return self[idx]
+
+    def __contains__(self, idx):
+        return super(RaggedLists, self).__contains__(idx) or idx in self.ragged
+
+def read_meta(dest_dir):
+    """
+    Meta of `dest_dir` as `create_meta` returns it, for the incremental preprocessing which only reads and extends
+    the reviews of the ids of the delta: the reviews (rids) are `RaggedLists`, any other array is memory-mapped
+    for update in place (`mmap_mode="r+"`).
+    """
+    lazy_meta = LazyMeta(dest_dir)
+    meta = dict(lazy_meta.header)
+    meta["indexlizer"] = lazy_meta["indexlizer"]
+    for name in sorted(os.listdir(dest_dir)):
+        key, ext = os.path.splitext(name)
+        if ext != ".npy" or key.endswith("_offsets") or key.endswith("_delta_ids"):
+            continue
+        if key in RAGGED_KEYS:
+            meta[key] = RaggedLists(lazy_meta[key])
+        else:
+            meta[key] = np.load(os.path.join(dest_dir, name), mmap_mode="r+")
+    return meta
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dest_dir", required=True, help="directory with a `meta.pkl` to convert")
+
+    args = parser.parse_args()
+
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    # the preprocessor of the pickled `Indexlizer` is `clean_str` of the script that wrote it
+    from preprocess.divide_and_create_example_word import clean_str
+
+    meta = read_pickle(os.path.join(args.dest_dir, "meta.pkl"))
+    write_meta(args.dest_dir, meta)
+    print(f"write {', '.join(sorted(os.listdir(args.dest_dir)))} to {args.dest_dir}")
@@ -1,17 +1,198 @@
+import re
+import copy
+from itertools import chain
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
-from nltk.tokenize import sent_tokenize
+
+_SENT_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+_SENT_SPLITTERS = {}
+
+def regex_sent_tokenize(text):
+    """
+    Split after ".", "!" or "?" followed by whitespace. Much faster than Punkt, but it also splits
+    after abbreviations like "Mr." and does not split run-on sentences without a space after the period.
+    """
+    return [sent for sent in _SENT_BOUNDARY.split(text.strip()) if sent]
+
+def get_sent_splitter(name="punkt"):
+    """
+    Return a `str -> list of str` sentence splitter, cached per process so the Punkt model is
+    loaded only once (and once per worker of `Indexlizer.transform2sent`).
+    Support:
+        - "punkt": NLTK Punkt english model, same as `nltk.tokenize.sent_tokenize`.
+        - "regex": `regex_sent_tokenize`.
+    """
+    if name not in _SENT_SPLITTERS:
+        if name == "punkt":
+            try:
+                from nltk.tokenize import PunktTokenizer
+                punkt = PunktTokenizer("english")
+            except ImportError:
+                # nltk < 3.8.2
+                import nltk
+                punkt = nltk.data.load("tokenizers/punkt/english.pickle")
+            _SENT_SPLITTERS[name] = punkt.tokenize
+        elif name == "regex":
+            _SENT_SPLITTERS[name] = regex_sent_tokenize
+        else:
+            raise ValueError(f"{name} is not predefined")
+    return _SENT_SPLITTERS[name]
+
+# code of the lookup table for tokens that are dropped (stop words)
+DROP_ID = -1
+
+def _make_clean_str_table():
+    """
+    `bytes.translate` table of the byte-level path of `Indexlizer.encode`, equivalent to `clean_str` of the
+    preprocessing scripts followed by `str.split`: [A-Za-z0-9] are kept in lower case, any other byte (incl. the
+    bytes of non-ascii chars) becomes a space. The null byte is kept, it separates the joined strings.
+    """
+    table = bytearray(b" " * 256)
+    for char in b"abcdefghijklmnopqrstuvwxyz0123456789":
+        table[char] = char
+    for char in b"ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+        table[char] = char + 32
+    table[0] = 0
+    return bytes(table)
+
+CLEAN_STR_TABLE = _make_clean_str_table()
+
+# the bytes of a token are the key of the byte-level lookup, longer tokens go through `_get_lookup`
+_MAX_KEY_LEN = 16
+_BYTE_MASKS = np.array([(1 << (8 * k)) - 1 for k in range(9)], dtype=np.uint64)
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+def _hash_slots(keys0, keys1, table_size):
+    """
+    Home slots of the 16 bytes keys `(keys0, keys1)` in an open addressing table of `table_size` (power of 2) slots.
+    """
+    hashes = (keys0 ^ (keys1 * np.uint64(_HASH_MULTIPLIER))) * np.uint64(_HASH_MULTIPLIER)
+    return (hashes >> np.uint64(64 - table_size.bit_length() + 1)).astype(np.int64)
+
+def _build_hash_table(keys0, keys1, codes, missing_code):
+    """
+    Open addressing (linear probing) table of the distinct non-zero keys `(keys0, keys1)`, filled with numpy: at each
+    round the pending keys whose slot is free are placed (one per slot), the others move to the next slot.
+
+    Returns:
+        table_keys0, table_keys1: np.ndarray of uint64, keys of each slot, 0 for an empty slot
+        table_codes: np.ndarray of int32, code of each slot, `missing_code` for an empty slot
+    """
+    # load factor under 1/4, the probe sequences are short
+    table_size = 1 << max(4 * len(keys0), 16).bit_length()
+    table_keys0 = np.zeros(table_size, dtype=np.uint64)
+    table_keys1 = np.zeros(table_size, dtype=np.uint64)
+    table_codes = np.full(table_size, missing_code, dtype=np.int32)
+
+    slots = _hash_slots(keys0, keys1, table_size)
+    pending = np.arange(len(keys0))
+    while len(pending) > 0:
+        free = table_keys0[slots[pending]] == 0
+        _, first = np.unique(slots[pending[free]], return_index=True)
+        placed = pending[free][first]
+        table_keys0[slots[placed]] = keys0[placed]
+        table_keys1[slots[placed]] = keys1[placed]
+        table_codes[slots[placed]] = codes[placed]
+
+        is_placed = np.zeros(len(keys0), dtype=bool)
+        is_placed[placed] = True
+        pending = pending[~is_placed[pending]]
+        slots[pending] = (slots[pending] + 1) & (table_size - 1)
+    return table_keys0, table_keys1, table_codes
+
+def _probe_hash_table(table, keys0, keys1):
+    """
+    Look up the keys `(keys0, keys1)` in the table of `_build_hash_table`, missing keys get the code of an empty slot.
+    """
+    table_keys0, table_keys1, table_codes = table
+    slots = _hash_slots(keys0, keys1, len(table_keys0))
+    slot_keys0 = table_keys0[slots]
+    found = (slot_keys0 == keys0) & (table_keys1[slots] == keys1)
+    # empty slot: missing key, the code of the slot is the missing code
+    codes = table_codes[slots]
+
+    pending = np.flatnonzero(~found & (slot_keys0 != 0))
+    while len(pending) > 0:
+        slots[pending] = (slots[pending] + 1) & (len(table_keys0) - 1)
+        slot_keys0 = table_keys0[slots[pending]]
+        found = (slot_keys0 == keys0[pending]) & (table_keys1[slots[pending]] == keys1[pending])
+        empty = slot_keys0 == 0
+        done = pending[found | empty]
+        codes[done] = table_codes[slots[done]]
+        pending = pending[~(found | empty)]
+    return codes
+
+# state of the worker processes of `Indexlizer.transform2sent`
+_worker_indexlizer = None
+
+def _init_sent_worker(indexlizer, lookup):
+    # only installs the state, an error here makes `Pool` respawn the workers forever: the sentence splitter is
+    # checked in the parent by `transform2sent`
+    global _worker_indexlizer
+    _worker_indexlizer = indexlizer
+    _worker_indexlizer._lookup = lookup
+
+def _transform2sent_worker(reviews):
+    return _worker_indexlizer._transform2sent_shard(reviews)
+
+class LengthHistogram():
+    """
+    Counts of each length, replaces the list of every review (sentence) length kept for statistics.
+    """
+    def __init__(self):
+        self._counts = []
+
+    def append(self, length):
+        if length >= len(self._counts):
+            self._counts.extend([0] * (length + 1 - len(self._counts)))
+        self._counts[length] += 1
+
+    def extend(self, lengths):
+        counts = np.bincount(np.asarray(lengths, dtype=np.int64)) if len(lengths) > 0 else []
+        if len(counts) > len(self._counts):
+            self._counts.extend([0] * (len(counts) - len(self._counts)))
+        for length, count in enumerate(counts):
+            self._counts[length] += int(count)
+
+    @property
+    def counts(self):
+        return np.array(self._counts, dtype=np.int64)
+
+    def __len__(self):
+        return sum(self._counts)
+
+    def quantile(self, q):
+        """
+        Same as `np.quantile(lengths, q)` (linear interpolation) on the lengths counted so far.
+        """
+        cum_counts = np.cumsum(self.counts)
+        positions = np.asarray(q, dtype=np.float64) * (cum_counts[-1] - 1)
+        lower = np.searchsorted(cum_counts, np.floor(positions), side="right")
+        upper = np.searchsorted(cum_counts, np.ceil(positions), side="right")
+        return lower + (upper - lower) * (positions - np.floor(positions))
 
 class Vocab():
-    def __init__(self, special_tokens, list_of_str, preprocessor=None, tokenizer=None, stop_words=None, max_size=50000):
+    def __init__(self, special_tokens, list_of_str, preprocessor=None, tokenizer=None, stop_words=None, max_size=50000,
+                keep_corpus=False):
+        """
+        Args:
+            keep_corpus: keep `list_of_str` and the tokenized corpus after `build` (build time only, e.g. to inspect them),
+                otherwise `build` calls `freeze` right away.
+        """
         self.special_tokens = special_tokens
         self.list_of_str = list_of_str
         self._preprocessor = preprocessor
         self._tokenizer = tokenizer
         self._stop_words = stop_words
         self._max_size = max_size
+        self._keep_corpus = keep_corpus
+        self.frozen = False
         
         self._token2id = {}
-        self._id2token = {}
+        self._id2token = []
         self._token_freqs = {}
 
         self._oov = set()
@@ -20,7 +201,7 @@ class Vocab():
             for tok in special_tokens:
                 cur_id = self.__len__()
                 self._token2id[tok] = cur_id 
-                self._id2token[cur_id] = tok 
+                self._id2token.append(tok)
                 
     def _build_from_list_of_str(self):
         list_of_str = self.list_of_str
@@ -56,32 +237,75 @@ class Vocab():
         self._oov = ranked_tokens[self._max_size:]
         print(f"oov size: {len(self._oov)}")
 
-        for tok in tqdm(self._token_freqs):
-            if tok in self._oov or tok in self._stop_words:
+        # tokens ranked after `max_size` are the oov ones
+        for tok in tqdm(ranked_tokens[:self._max_size]):
+            if tok in self._stop_words:
                 continue
             if tok not in self._token2id:
                 cur_id = self.__len__()
                 self._token2id[tok] = cur_id
-                self._id2token[cur_id] = tok 
+                self._id2token.append(tok)
                     
     def get_list_of_tokens(self):
+        if self.frozen:
+            raise ValueError("the tokenized corpus is dropped by `freeze`, build with `keep_corpus=True`")
         return self._list_of_tokens                      
         
     def build(self):
         self._build_from_list_of_str()
+        if not self._keep_corpus:
+            self.freeze()
+
+    def freeze(self):
+        """
+        Drop everything that scales with the corpus, only what indexing and decoding need is kept:
+            `_id2token`: list of tokens, `_token2id`: token -> id
+            `_oov`: set of the oov tokens that are also stop words, the other oov tokens map to unk like unseen tokens
+            `_token_freqs`: np.ndarray with shape of [len(vocab)], frequency of each id, `oov_size`, `oov_freq` for the rest
+        """
+        if self.frozen:
+            return self
+        oov_freqs = [self._token_freqs[tok] for tok in self._oov]
+        self.oov_size = len(oov_freqs)
+        self.oov_freq = sum(oov_freqs)
+        self._token_freqs = np.array([self._token_freqs.get(tok, 0) for tok in self._id2token], dtype=np.int64)
+        self._oov = {tok for tok in self._oov if tok in self._stop_words}
+
+        self.list_of_str = None
+        self._list_of_tokens = None
+        self.frozen = True
+        return self
+
+    def __getstate__(self):
+        # `_token2id` is rebuilt from `_id2token` when unpickled
+        state = self.__dict__.copy()
+        if self.frozen:
+            del state["_token2id"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "_token2id" not in state:
+            self._token2id = {tok: idx for idx, tok in enumerate(self._id2token)}
         
     def __len__(self):
         return len(self._token2id)
 
 class Indexlizer():
     def __init__(self, list_of_str, special_tokens=["<pad>", "<unk>"], mode="sent", preprocessor=None, tokenizer=None, stop_words=[],
-                pad_token="<pad>", max_len=50, max_sent_num=10, max_word_num=20):
+                pad_token="<pad>", max_len=50, max_sent_num=10, max_word_num=20, sent_splitter="punkt", num_workers=1,
+                keep_corpus=False, byte_table=None):
         """
-
+        Args:
+            sent_splitter: "punkt" or "regex", see `get_sent_splitter`.
+            num_workers: number of processes used by `transform2sent`.
+            keep_corpus: keep `list_of_str` and the tokenized corpus of the vocab until `freeze`, see `Vocab`.
+            byte_table: `bytes.translate` table equivalent to `preprocessor` and `tokenizer` (token bytes are mapped 
+                above b" ", the rest to b" ", b"\0" is kept), enables the byte-level path of `encode`, e.g. `CLEAN_STR_TABLE`.
         """
         
         self._special_tokens = special_tokens
-        self._list_of_str = list_of_str
+        self._list_of_str = list_of_str if keep_corpus else None
         self._mode = mode
         self._preprocessor = preprocessor 
         self._tokenizer = tokenizer
@@ -89,26 +313,210 @@ class Indexlizer():
         self._max_len = max_len
         self._max_sent_num = max_sent_num
         self._max_word_num = max_word_num
+        self._sent_splitter = sent_splitter
+        self._num_workers = num_workers
+        self._byte_table = byte_table
 
         assert self._mode == "sent" or self._mode == "word"
 
         self._pad_token = special_tokens[0]
         self._unk_token = special_tokens[1]
         
-        self._vocab = Vocab(self._special_tokens, self._list_of_str, self._preprocessor, self._tokenizer,
-                            self._stop_words)
+        self._vocab = Vocab(self._special_tokens, list_of_str, self._preprocessor, self._tokenizer,
+                            self._stop_words, keep_corpus=keep_corpus)
         self._vocab.build()
         
         self._token2id = self._vocab._token2id
         self._id2token = self._vocab._id2token
+        self._lookup = None
+        self._byte_lookup = None
         
+        # statistics of the transformed reviews
         if self._mode == "word":
-            self.review_lengths = []
+            self.review_lengths = LengthHistogram()
         else:
-            self.sent_nums = []
-            self.word_nums = []
+            self.sent_nums = LengthHistogram()
+            self.word_nums = LengthHistogram()
         
         assert pad_token == self._id2token[0]
+
+    def freeze(self):
+        """
+        Drop the corpus kept with `keep_corpus=True`, called before the indexlizer is persisted.
+        """
+        self._list_of_str = None
+        self._vocab.freeze()
+        return self
+
+    def __getstate__(self):
+        # the lookup tables are the ones of the vocab
+        state = self.__dict__.copy()
+        state["_lookup"] = None
+        state["_byte_lookup"] = None
+        if self._vocab is not None:
+            del state["_token2id"], state["_id2token"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._vocab is not None:
+            self._token2id = self._vocab._token2id
+            self._id2token = self._vocab._id2token
+        # indexlizers pickled before the lookup tables
+        for name in ["_lookup", "_byte_lookup", "_byte_table"]:
+            if name not in state:
+                setattr(self, name, None)
+
+    def _get_lookup(self):
+        """
+        Single lookup table where the oov tokens and the stop words are folded in, built once:
+        a token maps to its id, to `DROP_ID` for a stop word, to the unk id for an oov or unseen token.
+
+        Returns:
+            tokens: pd.Index of the tokens of the table, backed by a native hash table
+            codes: np.ndarray of int32 with shape of [len(tokens)+1], the last code (unk) is the one of
+                the tokens missing from the table (`get_indexer` returns -1)
+        """
+        if self._lookup is None:
+            oov = set(self._vocab._oov)
+            codes = dict(self._token2id)
+            for tok in (self._vocab._stop_words or []):
+                # an oov stop word maps to unk
+                if tok not in oov:
+                    codes[tok] = DROP_ID
+            tokens = pd.Index(list(codes), dtype=object)
+            codes = np.array(list(codes.values()) + [self._token2id[self._unk_token]], dtype=np.int32)
+            self._lookup = (tokens, codes)
+        return self._lookup
+
+    def _get_byte_lookup(self):
+        """
+        Same table as `_get_lookup`, keyed by the bytes of the tokens, built once.
+
+        Returns:
+            hash table of `_build_hash_table`, the key of a token is its (null padded) bytes read as two little-endian
+            uint64 words, missing tokens get the unk code
+        """
+        if self._byte_lookup is None:
+            tokens, codes = self._get_lookup()
+            keys0, keys1, key_codes = [], [], []
+            for tok, code in zip(tokens, codes):
+                tok_bytes = tok.encode("utf-8")
+                # the other tokens can not come out of the byte table
+                if len(tok_bytes) <= _MAX_KEY_LEN and tok_bytes.translate(self._byte_table) == tok_bytes and tok_bytes.isalnum():
+                    tok_bytes = tok_bytes.ljust(_MAX_KEY_LEN, b"\0")
+                    keys0.append(int.from_bytes(tok_bytes[:8], "little"))
+                    keys1.append(int.from_bytes(tok_bytes[8:], "little"))
+                    key_codes.append(code)
+            self._byte_lookup = _build_hash_table(np.array(keys0, dtype=np.uint64), np.array(keys1, dtype=np.uint64),
+                                                    np.array(key_codes, dtype=np.int32), codes[-1])
+        return self._byte_lookup
+
+    def _encode_bytes(self, list_of_str):
+        """
+        Byte-level version of `_encode_tokens(self._list_of_str_to_list_of_tokens(list_of_str))`: the strings
+        are joined, translated by `byte_table` and the tokens are located and looked up with numpy, no str object
+        is created per token.
+
+        Returns:
+            same as `_encode_tokens`, None if a string contains a null char
+        """
+        text = "\0".join(list_of_str).encode("utf-8")
+        if text.count(b"\0") != max(len(list_of_str) - 1, 0):
+            return None
+        text = text.translate(self._byte_table) + bytes(_MAX_KEY_LEN)
+        chars = np.frombuffer(text, dtype=np.uint8)
+
+        # token bytes are mapped above b" "
+        is_token = np.concatenate([[False], chars > 32, [False]])
+        bounds = np.flatnonzero(is_token[1:] != is_token[:-1])
+        starts, ends = bounds[0::2], bounds[1::2]
+        lengths = ends - starts
+        # first token of every string but the first one
+        first_tokens = np.searchsorted(starts, np.flatnonzero(chars == 0)[:len(list_of_str)-1])
+
+        # 8 bytes words starting at each byte, the bytes after the end of a token are masked
+        words = np.ndarray(shape=(len(chars) - 8,), dtype="<u8", buffer=text, strides=(1,))
+        keys0 = words[starts] & _BYTE_MASKS[np.minimum(lengths, 8)]
+        keys1 = np.zeros_like(keys0)
+        long_keys = np.flatnonzero(lengths > 8)
+        keys1[long_keys] = words[starts[long_keys] + 8] & _BYTE_MASKS[np.minimum(lengths[long_keys] - 8, 8)]
+        token_ids = _probe_hash_table(self._get_byte_lookup(), keys0, keys1)
+
+        fallback = lengths > _MAX_KEY_LEN
+        if fallback.any():
+            tokens, codes = self._get_lookup()
+            fallback = np.flatnonzero(fallback)
+            long_tokens = [text[start:end].decode("utf-8") for start, end in zip(starts[fallback], ends[fallback])]
+            token_ids[fallback] = codes[tokens.get_indexer(long_tokens)]
+
+        keep = token_ids != DROP_ID
+        num_kept = np.concatenate([[0], np.cumsum(keep)])
+        seq_bounds = num_kept[np.concatenate([[0], first_tokens, [len(starts)]])]
+        return token_ids[keep], np.diff(seq_bounds) if len(list_of_str) > 0 else np.zeros(0, dtype=np.int64)
+
+    def _tokenize_and_encode(self, list_of_str):
+        """
+        Returns:
+            same as `_encode_tokens`, through the byte-level path if there is a `byte_table`
+        """
+        if self._byte_table is not None:
+            encoded = self._encode_bytes(list_of_str)
+            if encoded is not None:
+                return encoded
+        return self._encode_tokens(self._list_of_str_to_list_of_tokens(list_of_str))
+
+    def _encode_tokens(self, list_of_tokens):
+        """
+        Look up every token of `list_of_tokens` at once, stop words are dropped.
+        Args:
+            list_of_tokens: list of list of str
+
+        Returns:
+            token_ids: np.ndarray of int32 with shape of [num_kept_tokens], ids of all sequences concatenated
+            lengths: np.ndarray of int64 with shape of [len(list_of_tokens)], number of ids of each sequence
+        """
+        tokens, codes = self._get_lookup()
+        num_tokens = np.fromiter(map(len, list_of_tokens), dtype=np.int64, count=len(list_of_tokens))
+        token_ids = codes[tokens.get_indexer(list(chain.from_iterable(list_of_tokens)))]
+
+        keep = token_ids != DROP_ID
+        seq_idxs = np.repeat(np.arange(len(list_of_tokens)), num_tokens)[keep]
+        lengths = np.bincount(seq_idxs, minlength=len(list_of_tokens))
+        return token_ids[keep], lengths
+
+    def _pad_flat(self, token_ids, lengths, max_len):
+        """
+        Args:
+            token_ids, lengths: output of `_encode_tokens`
+
+        Returns:
+            padded_ids: np.ndarray of int32 with shape of [len(lengths), max_len]
+        """
+        pad_id = self._token2id[self._pad_token]
+        seq_idxs = np.repeat(np.arange(len(lengths)), lengths)
+        positions = np.arange(len(token_ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+        padded_ids = np.full((len(lengths), max_len), pad_id, dtype=np.int32)
+        in_range = positions < max_len
+        padded_ids[seq_idxs[in_range], positions[in_range]] = token_ids[in_range]
+        return padded_ids
+
+    def encode(self, reviews, max_len=None):
+        """
+        Bulk version of `transform`, no statistics are recorded.
+        Args:
+            reviews: list of str
+            max_len: default to `max_len` of the indexlizer
+
+        Returns:
+            review_ids: np.ndarray of int32 with shape of [len(reviews), max_len], padded and truncated
+            lengths: np.ndarray of int64 with shape of [len(reviews)], number of ids of each review before truncation
+        """
+        assert self._mode == "word"
+        max_len = self._max_len if max_len is None else max_len
+        token_ids, lengths = self._tokenize_and_encode(reviews)
+        return self._pad_flat(token_ids, lengths, max_len), lengths
     
     def _pad_and_truncate_sequence(self, x, max_len):
         if len(x) > max_len:
@@ -144,6 +552,7 @@ class Indexlizer():
                                                 [[], [], ..., []]
                                             ]
         """
+        sent_tokenize = get_sent_splitter(self._sent_splitter)
         sents_of_reviews = []
         for rev in reviews:
             sents_of_reviews.append(sent_tokenize(rev))          
@@ -158,7 +567,7 @@ class Indexlizer():
             if tokid == pad_id:
                 continue
             else:
-                tok = self._id2token[tokid] if tokid in self._id2token else self._unk_token
+                tok = self._id2token[tokid] if 0 <= tokid < len(self._id2token) else self._unk_token
                 out_tokens.append(tok)
         return out_tokens
 
@@ -179,75 +588,74 @@ class Indexlizer():
             sents_reviews_ids: 3d array of token_ids. It is a 2d list with shape of (`len(reviews)`, max_sent_num, max_word_num)
         """
         assert self._mode == "sent"
-        sents_of_reviews = self._reviews_to_sents(reviews) # 3d list
 
-        unk_id = self._token2id[self._unk_token]
-        pad_id = self._token2id[self._pad_token]
-        # transform `list of str` to `dict(str, int)` to speed up 
-        oov = {w:i for i, w in enumerate(self._vocab._oov)}
-        sws = {w: i for i, w in enumerate(self._vocab._stop_words)}
+        if self._num_workers > 1 and len(reviews) > 0:
+            # e.g. a missing Punkt model raises here and not in the workers
+            get_sent_splitter(self._sent_splitter)
+            # several shards per worker to balance the load, results keep the order of `reviews`
+            shard_size = max(1, len(reviews) // (self._num_workers * 8))
+            shards = [reviews[i:i+shard_size] for i in range(0, len(reviews), shard_size)]
+            with Pool(self._num_workers, initializer=_init_sent_worker, initargs=(self._worker_copy(), self._get_lookup())) as pool:
+                outputs = list(tqdm(pool.imap(_transform2sent_worker, shards), total=len(shards)))
+        else:
+            outputs = [self._transform2sent_shard(reviews)]
 
         sents_reviews_ids = []
-        for sents_pre_review in tqdm(sents_of_reviews):
-            sents_pre_review = sents_pre_review[:self._max_sent_num]
-            self.sent_nums.append(len(sents_pre_review))
-            stoks_pre_review = self._list_of_str_to_list_of_tokens(sents_pre_review)[:self._max_sent_num]
-
-            sent_ids = []
-            for tokens in stoks_pre_review:
-                token_ids = [] 
-                for tok in tokens:
-                    if tok in oov:
-                        token_ids.append(unk_id)
-                    elif tok in sws:
-                        continue
-                    elif tok in self._token2id:
-                        token_ids.append(self._token2id[tok])
-                    else:
-                        raise ValueError(f"{tok} not in oov, stopwords, vocab.")
-                self.word_nums.append(len(token_ids))
-                padded_token_ids = self._pad_and_truncate_sequence(token_ids, self._max_word_num)
-                sent_ids.append(padded_token_ids)
-            assert len(sent_ids) <= self._max_sent_num
-            # pad sents to sent_ids
-            sent_ids = sent_ids + (self._max_sent_num-len(sent_ids)) * [[pad_id] * self._max_word_num]
-            sents_reviews_ids.append(sent_ids)                    
+        for shard_ids, sent_nums, word_nums in outputs:
+            sents_reviews_ids.extend(shard_ids.tolist())
+            self.sent_nums.extend(sent_nums)
+            self.word_nums.extend(word_nums)
         
         return sents_reviews_ids
+
+    def _worker_copy(self):
+        """
+        Shallow copy without the corpus and the vocab, it is what gets pickled to each worker.
+        """
+        worker = copy.copy(self)
+        worker._list_of_str = None
+        worker._vocab = None
+        worker._lookup = None
+        worker._byte_lookup = None
+        worker.sent_nums = LengthHistogram()
+        worker.word_nums = LengthHistogram()
+        return worker
+
+    def _transform2sent_shard(self, reviews):
+        """
+        Returns:
+            sents_reviews_ids: np.ndarray of int32 with shape of (`len(reviews)`, max_sent_num, max_word_num)
+            sent_nums, word_nums: statistics of the shard
+        """
+        sents_of_reviews = [sents[:self._max_sent_num] for sents in self._reviews_to_sents(reviews)] # 3d list
+        sent_nums = np.fromiter(map(len, sents_of_reviews), dtype=np.int64, count=len(sents_of_reviews))
+
+        # every sentence of the shard is looked up at once, then scattered to its (review, sent) row
+        token_ids, word_nums = self._tokenize_and_encode(list(chain.from_iterable(sents_of_reviews)))
+        sent_ids = self._pad_flat(token_ids, word_nums, self._max_word_num)
+
+        pad_id = self._token2id[self._pad_token]
+        sents_reviews_ids = np.full((len(reviews) * self._max_sent_num, self._max_word_num), pad_id, dtype=np.int32)
+        rows = np.arange(len(sent_ids)) - np.repeat(np.cumsum(sent_nums) - sent_nums, sent_nums) \
+                + np.repeat(np.arange(len(reviews)) * self._max_sent_num, sent_nums)
+        sents_reviews_ids[rows] = sent_ids
         
-    def transform(self, reviews):
+        return sents_reviews_ids.reshape(len(reviews), self._max_sent_num, self._max_word_num), sent_nums.tolist(), word_nums.tolist()
+        
+    def transform(self, reviews, pad=True):
         """
         Args:
             reviews: list of str
+            pad: pad and truncate each review to `max_len`, otherwise keep all token_ids.
         
         Returns:
             review_ids: list of list of token_ids 
         """
         assert self._mode == "word"
-        review_ids = []
-
-        list_of_tokens = self._list_of_str_to_list_of_tokens(reviews)
-        unk_id = self._token2id[self._unk_token]
-
-        # transform `list of str` to `dict(str, int)` to speed up 
-        oov = {w:i for i, w in enumerate(self._vocab._oov)}
-        sws = {w: i for i, w in enumerate(self._vocab._stop_words)}
-        
-        for tokens in list_of_tokens:
-            token_ids = [] 
-            for tok in tokens:
-                if tok in oov:
-                    token_ids.append(unk_id)
-                elif tok in sws:
-                    continue
-                elif tok in self._token2id:
-                    token_ids.append(self._token2id[tok])
-                else:
-                    raise ValueError(f"{tok} not in oov, stopwords, vocab.")
-
-            self.review_lengths.append(len(token_ids)) # statistics
-            padded_token_ids = self._pad_and_truncate_sequence(token_ids, self._max_len)
-         
-            review_ids.append(padded_token_ids)
-            
-        return review_ids
\ No newline at end of file
+        token_ids, lengths = self._tokenize_and_encode(reviews)
+        self.review_lengths.extend(lengths.tolist()) # statistics
+
+        if pad:
+            return self._pad_flat(token_ids, lengths, self._max_len).tolist()
+        offsets = np.cumsum(lengths) - lengths
+        return [token_ids[offset:offset+length].tolist() for offset, length in zip(offsets, lengths)]
@@ -1,17 +1,21 @@
 import json 
 import argparse
 from collections import defaultdict
+from itertools import chain, islice
 import os
 import pickle
 import gzip
 import re
+import sys
 
 import pandas as pd
 from tqdm import tqdm
 import numpy as np
 
-from preprocess._tokenizer import Vocab, Indexlizer
+from preprocess._tokenizer import Vocab, Indexlizer, CLEAN_STR_TABLE
 from preprocess._stop_words import ENGLISH_STOP_WORDS
+from preprocess._incremental import read_reviews, write_id_maps, map_delta_ids, append_examples, delta_digest, is_applied_delta
+from preprocess._meta import read_meta, write_meta, write_header, append_npy
 
 
 """
@@ -45,6 +49,8 @@ def parse_args():
     parser.add_argument("--rv_num_keep_prob", default=0.9, type=float)
     parser.add_argument("--max_doc_len", default=500, type=int)
     parser.add_argument("--random_shuffle", default=False)
+    parser.add_argument("--delta_path", default=None, help="append the reviews of this dump to `dest_dir` instead of a full run")
+    parser.add_argument("--delta_set", default="train", choices=["train", "valid", "test"])
 
     args = parser.parse_args() 
 
@@ -67,34 +73,7 @@ def split_data(args):
     path = args.data_path
     dest_dir = args.dest_dir
 
-    f = gzip.open(path)
-
-    users = [] 
-    items = [] 
-    ratings = [] 
-    reviews = [] 
-    times = []
-
-    for line in f:
-        js_dict = json.loads(line)
-        if str(js_dict['reviewerID'])=='unknown':
-            print("unknown user")
-            continue
-        if str(js_dict['asin'])=='unknown':
-            print("unknown item")
-            continue
-
-        users.append(js_dict["reviewerID"])
-        items.append(js_dict["asin"])
-        ratings.append(js_dict["overall"])
-        reviews.append(js_dict["reviewText"])
-        times.append(js_dict["unixReviewTime"])
-
-    df = pd.DataFrame({"user_id": pd.Series(users),
-                        "item_id": pd.Series(items),
-                        "rating": pd.Series(ratings),
-                        "review": pd.Series(reviews),
-                        "time": pd.Series(times)})
+    df = read_reviews(path)
 
     # sort df by `user_id` and `time`  and split
     df = df.sort_values(by=["user_id", "time"]).reset_index(drop=True)
@@ -174,6 +153,7 @@ def split_data(args):
     print(f"user2id: {list(user2id.items())[:10]}, item2id: {list(item2id.items())[:10]}")
     user2id["<pad>"] = 0 
     item2id["<pad>"] = 0
+    write_id_maps(args.dest_dir, user2id, item2id)
     print(f"user2id: {list(user2id.items())[:10]}, item2id: {list(item2id.items())[:10]}")
 
     train_df["user_id"] = train_df["user_id"].apply(lambda x: user2id[x])
@@ -196,42 +176,34 @@ def create_meta(df, args):
     # statistics
     reviews = list(df.review)
     indexlizer = Indexlizer(reviews, special_tokens=["<pad>", "<unk>", "<sep>"], preprocessor=clean_str, mode="word",
-                        stop_words=ENGLISH_STOP_WORDS, max_len=args.max_doc_len)
-    #indexlized_reviews = indexlizer.transform(reviews)
-    #df["idxed_review"] = indexlized_reviews
+                        stop_words=ENGLISH_STOP_WORDS, max_len=args.max_doc_len, byte_table=CLEAN_STR_TABLE)
     meta["user_num"] = df.user_id.max() + 1
     meta["item_num"] = df.item_id.max() + 1 # 加上 pad_idx 0, 并且考虑了空隙
     print(df.user_id.max(), df.item_id.max())
 
     # create meta for reviews and rids
-    user_docs = {}
-    item_docs = {}
+    user_reviews = defaultdict(list)
+    item_reviews = defaultdict(list)
     
-    # first: form giant document
+    # first: indexlize every review once, each review is followed by the separator
     train_users = list(df["user_id"])
     train_items = list(df["item_id"])
-    train_reviews = list(df["review"])
+    idxed_reviews = indexlizer.transform(reviews, pad=False)
+    sep_id = indexlizer._token2id["<sep>"]
 
-    for user, item, review in zip(train_users, train_items, train_reviews):
-        if user not in user_docs:
-            user_docs[user] = review + " <sep> "
-        else:
-            user_docs[user] += review + " <sep> "
-        if item not in item_docs:
-            item_docs[item] = review + " <sep> "
-        else:
-            item_docs[item] += review + " <sep> "
-    
-    # second: indexlize giant document
-    for user, doc in tqdm(user_docs.items()):
-        idxed_doc = indexlizer.transform([doc])[0]
-        user_docs[user] = idxed_doc
-    for item, doc in tqdm(item_docs.items()):
-        idxed_doc = indexlizer.transform([doc])[0]
-        item_docs[item] = idxed_doc
+    for user, item, review in zip(train_users, train_items, idxed_reviews):
+        review.append(sep_id)
+        user_reviews[user].append(review)
+        item_reviews[item].append(review)
     
-    meta["user_docs"] = user_docs
-    meta["item_docs"] = item_docs
+    # second: form giant document by joining the ids, stop at `max_doc_len`
+    # dense [num, doc_len] arrays, row 0 (and ids without reviews) are all padding
+    meta["user_docs"] = np.zeros((meta["user_num"], args.max_doc_len), dtype=np.int32)
+    meta["item_docs"] = np.zeros((meta["item_num"], args.max_doc_len), dtype=np.int32)
+    for docs, id2reviews in [(meta["user_docs"], user_reviews), (meta["item_docs"], item_reviews)]:
+        for idx, idxed_revs in tqdm(id2reviews.items()):
+            doc = list(islice(chain.from_iterable(idxed_revs), args.max_doc_len))
+            docs[idx, :len(doc)] = doc
     meta["indexlizer"] = indexlizer
     meta["doc_len"] = args.max_doc_len
 
@@ -253,40 +225,85 @@ def create_meta(df, args):
     
 
 def create_examples(df, meta, set_name, args):
+    # only ids, the documents are gathered from `user_docs.npy`, `item_docs.npy` by the datasets
     examples = []
     for _, row in tqdm(df.iterrows()):
         uid = row.user_id 
         iid = row.item_id 
         rating = row.rating
-        u_doc = meta["user_docs"][uid]
-        i_doc = meta["item_docs"][iid]
 
-        exp = [uid, iid, rating, u_doc, i_doc]
+        exp = [uid, iid, rating]
         examples.append(exp)
     
     return examples
 
+def update_meta(df, meta, args):
+    """
+    Incremental mode: index the new reviews with the frozen vocab and append them (each followed by
+    the separator) to the user/item documents of `meta`, documents stop at `doc_len`. The documents of
+    `args.dest_dir` are updated in place (memory-mapped by `read_meta`), only the rows of the ids of `df`.
+    """
+    indexlizer = meta["indexlizer"]
+    idxed_reviews = indexlizer.transform(list(df.review), pad=False)
+    sep_id = indexlizer._token2id["<sep>"]
+    doc_len = meta["doc_len"]
+
+    for name, ids, num in [("user_docs", list(df["user_id"]), meta["user_num"]), ("item_docs", list(df["item_id"]), meta["item_num"])]:
+        docs = meta[name]
+        if len(docs) < num:
+            path = os.path.join(args.dest_dir, f"{name}.npy")
+            append_npy(path, np.zeros((num - len(docs), doc_len), dtype=docs.dtype))
+            docs = np.load(path, mmap_mode="r+")
+        # padding is only at the end of a document
+        doc_lens = {idx: np.count_nonzero(docs[idx]) for idx in set(ids)}
+        for idx, review in zip(ids, idxed_reviews):
+            review = (review + [sep_id])[:doc_len - doc_lens[idx]]
+            docs[idx, doc_lens[idx]:doc_lens[idx]+len(review)] = review
+            doc_lens[idx] += len(review)
+        docs.flush()
+        meta[name] = docs
+
+    return meta
+
 if __name__ == "__main__":
     args = parse_args()
 
     if not os.path.exists(args.dest_dir):
         os.makedirs(args.dest_dir)
 
-    train_df, valid_df, test_df = split_data(args)
-    meta = create_meta(train_df, args)
-
-    train_examples = create_examples(train_df, meta, "train", args)
-    valid_examples = create_examples(valid_df, meta, "valid", args)
-    test_examples = create_examples(test_df, meta, "test", args)
-
-    # print meta 
-    for k, v in meta.items():
-        if isinstance(v, dict):
-            print(k)
+    if args.delta_path is not None:
+        meta = read_meta(args.dest_dir)
+        if is_applied_delta(meta, args.delta_set, delta_digest(args.delta_path)):
+            print(f"{args.delta_path} is already appended to {args.delta_set}, skip")
+            sys.exit()
+        delta_df = map_delta_ids(read_reviews(args.delta_path), meta, args.dest_dir)
+        # only training interactions extend the documents, valid/test reviews must stay unseen
+        if args.delta_set == "train":
+            meta = update_meta(delta_df, meta, args)
         else:
-            print(k, v)
-
-    write_pickle(os.path.join(args.dest_dir, "meta.pkl"), meta)
-    write_pickle(os.path.join(args.dest_dir, "train_exmaples.pkl"), train_examples)
-    write_pickle(os.path.join(args.dest_dir, "valid_exmaples.pkl"), valid_examples)
-    write_pickle(os.path.join(args.dest_dir, "test_exmaples.pkl"), test_examples)
+            # users and items without training reviews have no document
+            delta_df = delta_df[(delta_df.user_id < len(meta["user_docs"])) & (delta_df.item_id < len(meta["item_docs"]))]
+        delta_examples = create_examples(delta_df, meta, args.delta_set, args)
+
+        append_examples(args.dest_dir, args.delta_set, delta_examples)
+        # the reviews (documents) are already appended (updated) in place
+        write_header(args.dest_dir, meta)
+    else:
+        train_df, valid_df, test_df = split_data(args)
+        meta = create_meta(train_df, args)
+
+        train_examples = create_examples(train_df, meta, "train", args)
+        valid_examples = create_examples(valid_df, meta, "valid", args)
+        test_examples = create_examples(test_df, meta, "test", args)
+
+        # print meta 
+        for k, v in meta.items():
+            if isinstance(v, dict):
+                print(k)
+            else:
+                print(k, v)
+
+        write_meta(args.dest_dir, meta)
+        write_pickle(os.path.join(args.dest_dir, "train_exmaples.pkl"), train_examples)
+        write_pickle(os.path.join(args.dest_dir, "valid_exmaples.pkl"), valid_examples)
+        write_pickle(os.path.join(args.dest_dir, "test_exmaples.pkl"), test_examples)
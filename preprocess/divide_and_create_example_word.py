@@ -5,13 +5,16 @@ import os
 import pickle
 import gzip
 import re
+import sys
 
 import pandas as pd
 from tqdm import tqdm
 import numpy as np
 
-from preprocess._tokenizer import Vocab, Indexlizer
+from preprocess._tokenizer import Vocab, Indexlizer, CLEAN_STR_TABLE
 from preprocess._stop_words import ENGLISH_STOP_WORDS
+from preprocess._incremental import read_reviews, write_id_maps, map_delta_ids, append_examples, delta_digest, is_applied_delta
+from preprocess._meta import read_meta, write_meta, write_header, append_reviews
 
 
 def clean_str(string):
@@ -41,6 +44,8 @@ def parse_args():
     parser.add_argument("--rv_num_keep_prob", default=0.9, type=float)
     parser.add_argument("--max_rv_len", default=60, type=int)
     parser.add_argument("--random_shuffle", default=False)
+    parser.add_argument("--delta_path", default=None, help="append the reviews of this dump to `dest_dir` instead of a full run")
+    parser.add_argument("--delta_set", default="train", choices=["train", "valid", "test"])
 
     args = parser.parse_args() 
 
@@ -63,34 +68,7 @@ def split_data(args):
     path = args.data_path
     dest_dir = args.dest_dir
 
-    f = gzip.open(path)
-
-    users = [] 
-    items = [] 
-    ratings = [] 
-    reviews = [] 
-    times = []
-
-    for line in f:
-        js_dict = json.loads(line)
-        if str(js_dict['reviewerID'])=='unknown':
-            print("unknown user")
-            continue
-        if str(js_dict['asin'])=='unknown':
-            print("unknown item")
-            continue
-
-        users.append(js_dict["reviewerID"])
-        items.append(js_dict["asin"])
-        ratings.append(js_dict["overall"])
-        reviews.append(js_dict["reviewText"])
-        times.append(js_dict["unixReviewTime"])
-
-    df = pd.DataFrame({"user_id": pd.Series(users),
-                        "item_id": pd.Series(items),
-                        "rating": pd.Series(ratings),
-                        "review": pd.Series(reviews),
-                        "time": pd.Series(times)})
+    df = read_reviews(path)
 
     # sort df by `user_id` and `time`  and split
     df = df.sort_values(by=["user_id", "time"]).reset_index(drop=True)
@@ -170,6 +148,7 @@ def split_data(args):
     print(f"user2id: {list(user2id.items())[:10]}, item2id: {list(item2id.items())[:10]}")
     user2id["<pad>"] = 0 
     item2id["<pad>"] = 0
+    write_id_maps(args.dest_dir, user2id, item2id)
     print(f"user2id: {list(user2id.items())[:10]}, item2id: {list(item2id.items())[:10]}")
 
     train_df["user_id"] = train_df["user_id"].apply(lambda x: user2id[x])
@@ -192,10 +171,10 @@ def create_meta(df, args):
     # statistics
     reviews = list(df.review)
     indexlizer = Indexlizer(reviews, special_tokens=["<pad>", "<unk>"], preprocessor=clean_str, mode="word",
-                        stop_words=ENGLISH_STOP_WORDS, max_len=args.max_rv_len)
+                        stop_words=ENGLISH_STOP_WORDS, max_len=args.max_rv_len, byte_table=CLEAN_STR_TABLE)
     indexlized_reviews = indexlizer.transform(reviews)
     df["idxed_review"] = indexlized_reviews
-    print("review length: 0.5, 0.7, 0.9, 0.95: {}".format(np.quantile(indexlizer.review_lengths, [0.5, 0.7, 0.9, 0.95])))
+    print("review length: 0.5, 0.7, 0.9, 0.95: {}".format(indexlizer.review_lengths.quantile([0.5, 0.7, 0.9, 0.95])))
 
     ur_nums = np.array(df.groupby("user_id")["review"].agg(["count"]))
     ir_nums = np.array(df.groupby("item_id")["review"].agg(["count"]))
@@ -248,6 +227,22 @@ def create_meta(df, args):
 
     return meta 
     
+def update_meta(df, meta, args):
+    """
+    Incremental mode: index the new reviews with the frozen vocab and append them to the
+    per-user and per-item stores of `meta` and of `args.dest_dir`. `rv_num` and the other statistics are kept.
+    """
+    indexlizer = meta["indexlizer"]
+    df["idxed_review"] = indexlizer.transform(list(df.review))
+
+    for user, item, review in zip(list(df["user_id"]), list(df["item_id"]), list(df["idxed_review"])):
+        meta["user_reviews"][user].append(review)
+        meta["item_reviews"][item].append(review)
+        meta["user_rids"][user].append(item)
+        meta["item_rids"][item].append(user)
+    append_reviews(args.dest_dir, list(df["user_id"]), list(df["item_id"]), list(df["idxed_review"]))
+
+    return meta
 
 def create_examples(df, meta, set_name, args):
     if set_name == "train":
@@ -335,21 +330,36 @@ if __name__ == "__main__":
     if not os.path.exists(args.dest_dir):
         os.makedirs(args.dest_dir)
 
-    train_df, valid_df, test_df = split_data(args)
-    meta = create_meta(train_df, args)
-
-    train_examples = create_examples(train_df, meta, "train", args)
-    valid_examples = create_examples(valid_df, meta, "valid", args)
-    test_examples = create_examples(test_df, meta, "test", args)
-
-    # print meta 
-    for k, v in meta.items():
-        if isinstance(v, dict):
-            print(k)
-        else:
-            print(k, v)
-
-    write_pickle(os.path.join(args.dest_dir, "meta.pkl"), meta)
-    write_pickle(os.path.join(args.dest_dir, "train_exmaples.pkl"), train_examples)
-    write_pickle(os.path.join(args.dest_dir, "valid_exmaples.pkl"), valid_examples)
-    write_pickle(os.path.join(args.dest_dir, "test_exmaples.pkl"), test_examples)
+    if args.delta_path is not None:
+        meta = read_meta(args.dest_dir)
+        if is_applied_delta(meta, args.delta_set, delta_digest(args.delta_path)):
+            print(f"{args.delta_path} is already appended to {args.delta_set}, skip")
+            sys.exit()
+        delta_df = map_delta_ids(read_reviews(args.delta_path), meta, args.dest_dir)
+        # only training interactions extend the review stores, valid/test reviews must stay unseen
+        if args.delta_set == "train":
+            meta = update_meta(delta_df, meta, args)
+        delta_examples = create_examples(delta_df, meta, args.delta_set, args)
+
+        append_examples(args.dest_dir, args.delta_set, delta_examples)
+        # the reviews (documents) are already appended (updated) in place
+        write_header(args.dest_dir, meta)
+    else:
+        train_df, valid_df, test_df = split_data(args)
+        meta = create_meta(train_df, args)
+
+        train_examples = create_examples(train_df, meta, "train", args)
+        valid_examples = create_examples(valid_df, meta, "valid", args)
+        test_examples = create_examples(test_df, meta, "test", args)
+
+        # print meta 
+        for k, v in meta.items():
+            if isinstance(v, dict):
+                print(k)
+            else:
+                print(k, v)
+
+        write_meta(args.dest_dir, meta)
+        write_pickle(os.path.join(args.dest_dir, "train_exmaples.pkl"), train_examples)
+        write_pickle(os.path.join(args.dest_dir, "valid_exmaples.pkl"), valid_examples)
+        write_pickle(os.path.join(args.dest_dir, "test_exmaples.pkl"), test_examples)
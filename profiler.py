@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+from collections import defaultdict
+
+import torch
+
+"""
+NOTE:
+    - Enable with `"profile": true` in the config of a model. Each training step is split into the phases of
+    `StepProfiler.PHASES`, the trainers mark the end of each phase:
+        for i, batch in enumerate(self.profiler.wrap(self.train_dataloader)):   # "data": waiting for the batch
+            ...to(self.device);            self.profiler.mark("h2d")
+            y_pred = self.model(...);      self.profiler.mark("forward")
+            self.optimize(loss, i, ...)    # marks "backward" and "optimizer"
+            ...log;                        self.profiler.step(batch_size)    # "logging", ends the step
+    - Every step is a line of `<out_dir>/profile.jsonl` (seconds per phase, samples/sec, peak RSS), every
+    `"profile_idx"` steps the means go to TensorBoard (tensorboardX, `profile/*` scalars) and to the log. A large
+    "data" share means the job is input-bound (more workers, `sort_by_length`...), otherwise compute-bound.
+    - On cuda the phases end with a `torch.cuda.synchronize()`, the kernels are counted in the phase which launched
+    them and not in the next one which syncs (e.g. `loss.item()`), at the cost of the overlap of the host and the device.
+    - `"torch_profiler": [wait, warmup, active]` also traces `active` steps with `torch.profiler` after
+    `wait + warmup` steps, the trace is written to `<out_dir>/torch_profiler` (TensorBoard profiler plugin or
+    chrome://tracing).
+"""
+
+def get_peak_rss_mb():
+    """
+    Peak resident set size of the process in MB.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+
+class StepProfiler(object):
+    """
+    Wall time of the phases of the training steps, see the NOTE of the module.
+    Args:
+        out_dir: str, directory of `profile.jsonl`, the TensorBoard events and the torch.profiler trace
+        enabled: bool, every call is a no-op when False
+        log_idx: int, number of steps averaged in a TensorBoard point and a log line
+        torch_profiler: None or [wait, warmup, active], the steps traced by `torch.profiler`
+        device: torch.device of the model
+        log_func: called with the log line of each `log_idx` steps
+    """
+    PHASES = ["data", "h2d", "forward", "backward", "optimizer", "logging"]
+
+    def __init__(self, out_dir, enabled=False, log_idx=100, torch_profiler=None, device=None, log_func=print):
+        self.enabled = enabled
+        if not self.enabled:
+            return
+        from tensorboardX import SummaryWriter
+
+        self.log_idx = log_idx
+        self.log_func = log_func
+        self.synchronize = device is not None and torch.device(device).type == "cuda"
+        self.writer = SummaryWriter(log_dir=out_dir)
+        self.trace_file = open(os.path.join(out_dir, "profile.jsonl"), "a")
+
+        self.num_steps = 0
+        self._times = defaultdict(float)
+        self._window = defaultdict(float)
+        self._last = time.perf_counter()
+
+        self.torch_profiler = None
+        if torch_profiler is not None:
+            wait, warmup, active = torch_profiler
+            self.torch_profiler = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(os.path.join(out_dir, "torch_profiler")),
+                record_shapes=True, profile_memory=True)
+            self.torch_profiler.start()
+        atexit.register(self.close)
+
+    def wrap(self, dataloader):
+        """
+        Iterate `dataloader`, the time spent waiting for each batch is the "data" phase.
+        """
+        if not self.enabled:
+            return dataloader
+        return self._wrap(dataloader)
+
+    def _wrap(self, dataloader):
+        iterator = iter(dataloader)
+        while True:
+            self._last = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.mark("data")
+            yield batch
+
+    def mark(self, phase):
+        """
+        End `phase`, it lasted since the end of the former phase.
+        """
+        if not self.enabled:
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self._times[phase] += now - self._last
+        self._last = now
+
+    def step(self, num_samples, global_step=None):
+        """
+        End the "logging" phase and the step, write its record.
+        Args:
+            num_samples: int, examples of the batch
+            global_step: int, default to the number of profiled steps
+        """
+        if not self.enabled:
+            return
+        self.mark("logging")
+        self.num_steps += 1
+        global_step = global_step if global_step is not None else self.num_steps
+
+        record = {"step": global_step}
+        record.update({phase: self._times[phase] for phase in self.PHASES})
+        record["total"] = sum(record[phase] for phase in self.PHASES)
+        record["samples"] = num_samples
+        record["samples_per_sec"] = num_samples / max(record["total"], 1e-9)
+        record["peak_rss_mb"] = get_peak_rss_mb()
+        if self.synchronize:
+            record["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        self.trace_file.write(json.dumps(record) + "\n")
+
+        for key in self.PHASES + ["total", "samples"]:
+            self._window[key] += record[key]
+        self._window["steps"] += 1
+        self._times.clear()
+
+        if self._window["steps"] >= self.log_idx:
+            self._write_window(global_step, record)
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def _write_window(self, global_step, record):
+        window, self._window = self._window, defaultdict(float)
+        total = max(window["total"], 1e-9)
+        for phase in self.PHASES:
+            self.writer.add_scalar(f"profile/{phase}_ms", window[phase] / window["steps"] * 1000, global_step=global_step)
+        self.writer.add_scalar("profile/data_fraction", window["data"] / total, global_step=global_step)
+        self.writer.add_scalar("profile/samples_per_sec", window["samples"] / total, global_step=global_step)
+        self.writer.add_scalar("profile/peak_rss_mb", record["peak_rss_mb"], global_step=global_step)
+        self.trace_file.flush()
+
+        self.log_func("profile: " + ", ".join("{}: {:.1f}ms ({:.0%})".format(phase, window[phase] / window["steps"] * 1000, window[phase] / total)
+                        for phase in self.PHASES) + ", samples/sec: {:.1f}, peak rss: {:.0f}MB".format(window["samples"] / total, record["peak_rss_mb"]))
+
+    def close(self):
+        if not self.enabled or self.trace_file.closed:
+            return
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+        self.trace_file.close()
+        self.writer.close()
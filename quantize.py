@@ -0,0 +1,208 @@
+import io
+import copy
+import json
+import argparse
+import warnings
+import itertools
+
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized as nnq
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, quantize_dynamic
+
+from models.registry import MODELS
+from export import load_experiment, build_dataloader, Predictor, time_predictor, evaluate_rmse
+
+"""
+NOTE:
+    - Post-training int8 quantization of a trained model for CPU inference:
+    `python -m quantize --model dual_att --ckpt <out_dir>/best_model.pt --data_dir <dest_dir> --out dual_att_int8.pt`
+    - "dynamic": `nn.Linear` and `nn.LSTM` get int8 weights, the activations are quantized on the fly per batch.
+    - "static": in addition, the `nn.Conv1d` called by the model get int8 weights and activations, the scales of
+    the activations are calibrated on the first `--calib_batches` batches of `--set_name`. Each conv quantizes its input
+    and dequantizes its output (`StaticQuantConv1d`), the rest of the model stays fp32. Convs whose weight is used
+    directly (e.g. the global attention of D-ATT slices it) are not called as modules and stay fp32.
+    - Reports the RMSE on `--eval_set` (all batches, or the first `--eval_batches`, must not be the calibration
+    set), the latency of a batch and the size of the serialized weights of fp32, dynamic and static, and the
+    deltas to fp32.
+    - The statically quantized model is saved as its state dict and the names of its int8 convs (`--out`), load it on
+    top of the fp32 model of the checkpoint with `load_quantized(experiment.model, path)`. It runs eagerly, the
+    traced/ONNX export (`export.py`) is for fp32 models.
+    - The embeddings stay fp32, they are most of the size of the models.
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, help=", ".join(MODELS))
+    parser.add_argument("--ckpt", required=True, help="checkpoint written by `Experiment.save`")
+    parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--out", default=None, help="path of the statically quantized model")
+    parser.add_argument("--set_name", default="valid", help="calibration set")
+    parser.add_argument("--eval_set", default="test", help="evaluation set, not the calibration set")
+    parser.add_argument("--calib_batches", default=8, type=int)
+    parser.add_argument("--eval_batches", default=0, type=int, help="0 for all")
+    parser.add_argument("--engine", default=torch.backends.quantized.engine, choices=torch.backends.quantized.supported_engines)
+    parser.add_argument("--report", default=None, help="json path of the report")
+
+    args = parser.parse_args()
+    if args.eval_set == args.set_name:
+        parser.error("--eval_set must differ from the calibration --set_name, the RMSE delta would be optimistic")
+
+    return args
+
+class StaticQuantConv1d(nn.Module):
+    """
+    int8 `conv` between the quantization of its input and the dequantization of its output, replaced by the
+    quantized modules on `convert`.
+    """
+    def __init__(self, conv):
+        super(StaticQuantConv1d, self).__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, inputs):
+        return self.dequant(self.conv(self.quant(inputs)))
+
+def called_modules(model, module_type, run):
+    """
+    Names of the modules of `module_type` which are called as modules during `run()`.
+    """
+    names = []
+    handles = [module.register_forward_hook(lambda mod, inputs, outputs, name=name: names.append(name))
+                for name, module in model.named_modules() if type(module) is module_type]
+    try:
+        run()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return sorted(set(names))
+
+def quantize_dynamic_int8(model):
+    """
+    Returns:
+        a copy of `model` with int8 `nn.Linear` and `nn.LSTM`
+    """
+    return quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8, inplace=False)
+
+def wrap_convs(model, conv_names, qconfig):
+    """
+    Replace the `nn.Conv1d` of `model` named `conv_names` by `StaticQuantConv1d` in place.
+    """
+    for name in conv_names:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name)
+        wrapper = StaticQuantConv1d(getattr(parent, child_name))
+        wrapper.qconfig = qconfig
+        setattr(parent, child_name, wrapper)
+    return model
+
+def get_quantized_conv_names(model):
+    return [name[:-len(".conv")] for name, module in model.named_modules() if isinstance(module, nnq.Conv1d)]
+
+def quantize_static_int8(model, calib_inputs, engine=None):
+    """
+    Args:
+        model: nn.Module in eval mode
+        calib_inputs: list of tuples of tensors, the positional inputs of `model` for the calibration
+
+    Returns:
+        a copy of `model` with int8 `nn.Conv1d` (statically) and int8 `nn.Linear`, `nn.LSTM` (dynamically)
+    """
+    engine = engine or torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model)
+
+    def run():
+        with torch.no_grad():
+            model(*calib_inputs[0])
+
+    wrap_convs(model, called_modules(model, nn.Conv1d, run), get_default_qconfig(engine))
+    prepare(model, inplace=True)
+    with torch.no_grad():
+        for inputs in calib_inputs:
+            model(*inputs)
+    convert(model, inplace=True)
+    return quantize_dynamic_int8(model)
+
+def save_quantized(model, path, engine=None):
+    torch.save({"conv_names": get_quantized_conv_names(model),
+                "engine": engine or torch.backends.quantized.engine,
+                "model": model.state_dict()}, path)
+
+def load_quantized(model, path):
+    """
+    Args:
+        model: the fp32 model the quantized one was made of, e.g. `load_experiment(...)[0].model`
+        path: str, file written by `save_quantized`
+
+    Returns:
+        a copy of `model` with the int8 modules and weights of `path`
+    """
+    params = torch.load(path, map_location="cpu", weights_only=False)
+    torch.backends.quantized.engine = params["engine"]
+    model = wrap_convs(copy.deepcopy(model), params["conv_names"], get_default_qconfig(params["engine"]))
+    with warnings.catch_warnings():
+        # the observers are not run, their scales are overwritten by the state dict
+        warnings.simplefilter("ignore")
+        prepare(model, inplace=True)
+        convert(model, inplace=True)
+    model = quantize_dynamic_int8(model)
+    model.load_state_dict(params["model"])
+    return model
+
+def model_bytes(model):
+    """
+    Size of the serialized `state_dict` (packed int8 weights for the quantized modules).
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+def compare_quantized(experiment, get_inputs, calib_batches, eval_batches, engine=None):
+    """
+    RMSE, latency of a batch and size of fp32, dynamic int8 and static int8 `experiment.model`.
+    Returns:
+        results: dict, variant -> metrics, the quantized variants also have the deltas to fp32
+        models: dict, variant -> model
+    """
+    model = experiment.model
+    calib_inputs = [tuple(get_inputs(experiment, batch)[0]) for batch in calib_batches]
+    models = {"fp32": model,
+              "dynamic": quantize_dynamic_int8(model),
+              "static": quantize_static_int8(model, calib_inputs, engine)}
+
+    latency_inputs = get_inputs(experiment, eval_batches[0])[0]
+    results = {}
+    for name, variant in models.items():
+        predictor = Predictor(variant)
+        results[name] = {"rmse": evaluate_rmse(predictor, eval_batches, experiment, get_inputs),
+                        "latency": time_predictor(predictor, latency_inputs),
+                        "model_bytes": model_bytes(variant)}
+        if name != "fp32":
+            results[name]["rmse_delta"] = results[name]["rmse"] - results["fp32"]["rmse"]
+            results[name]["speedup"] = results["fp32"]["latency"] / results[name]["latency"]
+            results[name]["size_ratio"] = results[name]["model_bytes"] / results["fp32"]["model_bytes"]
+    return results, models
+
+if __name__ == "__main__":
+    args = parse_args()
+    experiment, calib_loader = load_experiment(args.model, args.ckpt, args.data_dir, args.set_name)
+    eval_loader = build_dataloader(args.model, experiment.args, args.eval_set)
+    get_inputs = MODELS[args.model][5]
+    calib_batches = list(itertools.islice(calib_loader, args.calib_batches))
+    eval_batches = list(itertools.islice(eval_loader, args.eval_batches or None))
+
+    results, models = compare_quantized(experiment, get_inputs, calib_batches, eval_batches, args.engine)
+    for name, metrics in results.items():
+        print(f"{name}: rmse {metrics['rmse']:.4f}, latency {metrics['latency'] * 1000:.1f}ms, "
+              f"{metrics['model_bytes'] / 2**20:.2f}MB" +
+              (f", rmse delta {metrics['rmse_delta']:+.4f}, speedup {metrics['speedup']:.2f}x, "
+               f"size {metrics['size_ratio']:.2f}x" if name != "fp32" else ""))
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump({"model": args.model, "engine": args.engine, "results": results}, f, indent=2)
+    if args.out is not None:
+        save_quantized(models["static"], args.out, args.engine)
+        print(f"write the int8 {args.model} to {args.out}")
@@ -0,0 +1,141 @@
+import random
+
+import numpy as np
+import torch
+
+
+class LengthSortedBatchSampler(torch.utils.data.Sampler):
+    """
+    Group examples with similar lengths into the same batch, so that a collate function which
+    pads to the longest example of the batch (instead of the global maximum) wastes few positions.
+
+    For training, the example indices are shuffled and cut into pools of `batch_size * pool_size`
+    examples, each pool is sorted by length and chunked into batches, then the order of batches is
+    shuffled again. Without shuffling, the whole set is sorted once.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, pool_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+
+    def __iter__(self):
+        num_examples = len(self.lengths)
+        if self.shuffle:
+            indices = np.random.permutation(num_examples)
+            pool_len = self.batch_size * self.pool_size
+        else:
+            indices = np.arange(num_examples)
+            pool_len = num_examples
+
+        batches = []
+        for start in range(0, num_examples, pool_len):
+            pool = indices[start:start+pool_len]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            for b_start in range(0, len(pool), self.batch_size):
+                batches.append(pool[b_start:b_start+self.batch_size].tolist())
+
+        if self.shuffle:
+            random.shuffle(batches)
+
+        return iter(batches)
+
+    def __len__(self):
+        num_examples = len(self.lengths)
+        if not self.shuffle:
+            return (num_examples + self.batch_size - 1) // self.batch_size
+
+        pool_len = self.batch_size * self.pool_size
+        num_full_pools, rest = divmod(num_examples, pool_len)
+        return num_full_pools * self.pool_size + (rest + self.batch_size - 1) // self.batch_size
+
+
+class NegativeSampler(object):
+    """
+    Draw negative examples for a batch of anchor items with NumPy, an example of the anchor item
+    itself is never returned.
+
+    Examples are grouped by item once: the examples of `self.items[k]` are
+    `self.order[self.offsets[k]:self.offsets[k+1]]`, which is also the exclusion set of anchor `k`.
+    A draw picks an item from the cumulative item distribution with the anchor's interval cut out,
+    then one of its examples uniformly, so no rejection loop is needed.
+
+    Support:
+        - "uniform": every example of another item is equally likely.
+        - "popularity": an item is drawn with probability proportional to `count ** alpha`
+            (alpha=1 is "uniform", alpha=0 is uniform over items).
+        - "in_batch": reuse other rows of the batch, see `sample_in_batch`.
+    """
+    def __init__(self, example_items, mode="uniform", alpha=0.75):
+        self.mode = mode
+        self.alpha = alpha
+
+        example_items = np.asarray(example_items, dtype=np.int64)
+        self.order = np.argsort(example_items, kind="stable")
+        self.items, self.counts = np.unique(example_items, return_counts=True)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+        if mode == "uniform" or mode == "in_batch":
+            item_weights = self.counts.astype(np.float64)
+        elif mode == "popularity":
+            item_weights = self.counts.astype(np.float64) ** alpha
+        else:
+            raise ValueError(f"{mode} is not predefined")
+        self.cum_weights = np.cumsum(item_weights)
+        self.item_weights = item_weights
+
+        self._rng = None
+        self._rng_seed = None
+
+    @property
+    def rng(self):
+        # DataLoader workers are forked with the same NumPy state, reseed from the per-worker torch seed.
+        seed = torch.initial_seed()
+        if self._rng is None or self._rng_seed != seed:
+            self._rng = np.random.default_rng(seed)
+            self._rng_seed = seed
+        return self._rng
+
+    def sample(self, anchor_items):
+        """
+        Args:
+            anchor_items: array-like with shape of [bz]
+
+        Returns:
+            neg_indices: np.ndarray with shape of [bz], indices of examples with a different item.
+        """
+        anchor_items = np.asarray(anchor_items, dtype=np.int64)
+        num_items = len(self.items)
+
+        # interval of the anchor item in the cumulative weights (empty if the item has no example)
+        anchor_pos = np.searchsorted(self.items, anchor_items)
+        anchor_pos = np.minimum(anchor_pos, num_items - 1)
+        is_known = self.items[anchor_pos] == anchor_items
+        anchor_width = np.where(is_known, self.item_weights[anchor_pos], 0.)
+        anchor_start = self.cum_weights[anchor_pos] - self.item_weights[anchor_pos]
+
+        draws = self.rng.random(len(anchor_items)) * (self.cum_weights[-1] - anchor_width)
+        draws = np.where(draws >= anchor_start, draws + anchor_width, draws)
+        item_pos = np.searchsorted(self.cum_weights, draws, side="right")
+        item_pos = np.minimum(item_pos, num_items - 1)
+
+        within = (self.rng.random(len(item_pos)) * self.counts[item_pos]).astype(np.int64)
+        return self.order[self.offsets[item_pos] + within]
+
+    def sample_in_batch(self, anchor_items):
+        """
+        For each row, pick uniformly another row of the same batch whose item differs.
+        Args:
+            anchor_items: array-like with shape of [bz]
+
+        Returns:
+            neg_rows: np.ndarray with shape of [bz], row indices in the batch, -1 if every row
+                of the batch shares the anchor item.
+        """
+        anchor_items = np.asarray(anchor_items, dtype=np.int64)
+        candidates = anchor_items[None, :] != anchor_items[:, None] #[bz, bz]
+        scores = np.where(candidates, self.rng.random(candidates.shape), -1.)
+        neg_rows = np.argmax(scores, axis=1)
+        neg_rows[~candidates.any(axis=1)] = -1
+
+        return neg_rows
@@ -0,0 +1,113 @@
+import os
+import importlib
+
+import torch
+import torch.nn as nn
+
+from experiment import Args, Experiment
+from models.registry import MODELS
+from preprocess._meta import write_meta
+
+"""
+NOTE:
+    - Helpers shared by the tests, e.g. `TinyExperiment`: an `Experiment` on a linear model and random batches,
+    without dataset nor log files.
+    - `preprocess_corpus` runs the stages of a preprocessing script in process, `load_model_args` reads the default
+    config of a model for a preprocessed directory.
+"""
+
+# small settings of the preprocessing scripts, the regex sentence splitter does not need punkt
+PREPROCESSORS = {
+    "word": ("preprocess.divide_and_create_example_word", {"rv_num_keep_prob": 0.9, "max_rv_len": 60, "random_shuffle": False}),
+    "sent": ("preprocess.divide_and_create_example_sent", {"rv_num_keep_prob": 0.9, "max_sent_num": 10, "max_word_num": 20,
+                                                            "random_shuffle": False, "sent_splitter": "regex", "num_workers": 1}),
+    "doc": ("preprocess.divide_and_create_example_doc", {"rv_num_keep_prob": 0.9, "max_doc_len": 500, "random_shuffle": False}),
+}
+
+def preprocess_corpus(kind, data_path, dest_dir):
+    """
+    Write the meta and the examples of the "word", "sent" or "doc" pipeline of `data_path` to `dest_dir`.
+    """
+    module_name, defaults = PREPROCESSORS[kind]
+    module = importlib.import_module(module_name)
+    args = Args()
+    args.data_path = data_path
+    args.dest_dir = dest_dir
+    for name, val in defaults.items():
+        setattr(args, name, val)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    train_df, valid_df, test_df = module.split_data(args)
+    meta = module.create_meta(train_df, args)
+    write_meta(dest_dir, meta)
+    for set_name, df in zip(["train", "valid", "test"], [train_df, valid_df, test_df]):
+        module.write_pickle(os.path.join(dest_dir, f"{set_name}_exmaples.pkl"), module.create_examples(df, meta, set_name, args))
+
+def load_model_args(model_name, data_dir, log_dir):
+    """
+    Returns:
+        module: the trainer module of `model_name`
+        args: its default config on `data_dir`, without log files, pretrained embeddings nor resume
+    """
+    module_name, _, _, config_path, _, _ = MODELS[model_name]
+    module = importlib.import_module(module_name)
+    args = module.parse_args(config_path)
+    args.data_dir = data_dir
+    args.log_dir = log_dir
+    args.log = False
+    args.stats = False
+    args.use_pretrain = False
+    args.parallel = False
+    args.compile = False
+    args.tensorboard = False
+    args.resume_path = None
+    return module, args
+
+def make_args(out_dir, **kwargs):
+    args = Args()
+    args.log_dir = out_dir
+    args.dataset = "tiny"
+    args.model_name = "Tiny"
+    args.log = False
+    args.lr = 0.1
+    args.max_grad_norm = 1e3
+    args.grad_accum_steps = 1
+    args.lr_scaling = "none"
+    args.warmup_steps = 0
+    args.keep_last_ckpts = 2
+    args.async_eval = False
+    args.eval_workers = 1
+    args.profile = False
+    args.profile_idx = 100
+    args.torch_profiler = None
+    args.resume_path = None
+    for name, val in kwargs.items():
+        setattr(args, name, val)
+    return args
+
+class TinyExperiment(Experiment):
+    """
+    Linear regression of the ratings with dropout, an Adam optimizer (with state) and a step lr scheduler.
+    """
+    def __init__(self, args, in_dim=4, dropout=0.2):
+        super(TinyExperiment, self).__init__(args, {"train": None, "valid": None, "test": None})
+        self.device = torch.device("cpu")
+        self.best_rmse = 1e3
+        self.patience = 0
+
+        self.setup()
+        self.model = nn.Sequential(nn.Dropout(dropout), nn.Linear(in_dim, 1))
+        self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.lr)
+        self.scheduler = torch.optim.lr_scheduler.StepLR(self.optimizer, step_size=1, gamma=0.5)
+
+    def forward_batch(self, batch):
+        inputs, ratings = batch
+        return self.model(inputs).view(-1), ratings
+
+    def train_step(self, batch, batch_idx=0, num_batches=1):
+        self.model.train()
+        y_pred, ratings = self.forward_batch(batch)
+        return self.optimize(((y_pred - ratings) ** 2).mean(), batch_idx, num_batches)
+
+def random_batch(bz=8, in_dim=4):
+    return torch.randn(bz, in_dim), torch.rand(bz) * 4 + 1
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from tests.helpers import make_args, TinyExperiment, random_batch
+
+"""
+NOTE:
+    - `Experiment.save` and `load`: a rolling checkpoint resumes the training exactly where it stopped, only the
+    last `keep_last_ckpts` rolling checkpoints are kept, and a checkpoint of a snapshot (`model_state`) is refused.
+"""
+
+def train_steps(experiment, num_steps):
+    # the batches and the dropout masks depend on the restored RNG states
+    for _ in range(num_steps):
+        experiment.train_step(random_batch())
+    experiment.scheduler.step()
+
+def assert_state_dicts_equal(state, other):
+    assert state.keys() == other.keys()
+    for key, val in state.items():
+        if isinstance(val, dict):
+            assert_state_dicts_equal(val, other[key])
+        elif torch.is_tensor(val):
+            assert torch.equal(val, other[key]), key
+        else:
+            assert val == other[key], key
+
+@pytest.fixture
+def experiment(tmp_path):
+    torch.manual_seed(0)
+    experiment = TinyExperiment(make_args(str(tmp_path)))
+    train_steps(experiment, 3)
+    experiment.best_rmse = 1.2
+    experiment.patience = 1
+    return experiment
+
+def test_resume_restores_states(experiment, tmp_path):
+    fn = experiment.save(epoch=4, blocking=True)
+    expected_rng = (np.random.rand(), torch.rand(1))
+
+    resumed = TinyExperiment(make_args(str(tmp_path)))
+    np.random.seed(1)
+    torch.manual_seed(1)
+    resumed.load(fn)
+
+    assert (resumed.updates, resumed.start_epoch) == (3, 5)
+    assert (resumed.best_rmse, resumed.patience) == (1.2, 1)
+    assert_state_dicts_equal(resumed.model.state_dict(), experiment.model.state_dict())
+    assert_state_dicts_equal(resumed.optimizer.state_dict(), experiment.optimizer.state_dict())
+    assert resumed.scheduler.state_dict() == experiment.scheduler.state_dict()
+    assert (np.random.rand(), torch.rand(1)) == expected_rng
+
+def test_resume_continues_training(experiment, tmp_path):
+    # built first, its initialization draws from the RNG
+    resumed = TinyExperiment(make_args(str(tmp_path)))
+    fn = experiment.save(epoch=0, blocking=True)
+    train_steps(experiment, 2)
+
+    # `load` rewinds the RNG states to the ones of the checkpoint, the resumed training draws the same batches
+    resumed.load(fn)
+    train_steps(resumed, 2)
+    assert resumed.updates == experiment.updates == 5
+    assert_state_dicts_equal(resumed.model.state_dict(), experiment.model.state_dict())
+    assert_state_dicts_equal(resumed.optimizer.state_dict(), experiment.optimizer.state_dict())
+
+def test_rolling_checkpoints_pruned(experiment):
+    best_fn = experiment.save("best_model", epoch=0)
+    rolling_fns = []
+    for _ in range(4):
+        train_steps(experiment, 1)
+        rolling_fns.append(experiment.save(epoch=0))
+        experiment.save("best_model", epoch=0)
+    experiment.checkpointer.wait()
+
+    keep_last = experiment.args.keep_last_ckpts
+    assert sorted(os.listdir(experiment.out_dir)) == sorted(["best_model.pt"] + [os.path.basename(fn) for fn in rolling_fns[-keep_last:]])
+    assert os.path.exists(best_fn)
+
+def test_load_rejects_snapshot(experiment, tmp_path):
+    model_state = {key: val.clone() for key, val in experiment.model.state_dict().items()}
+    fn = experiment.save("best_model", epoch=2, blocking=True, model_state=model_state)
+    assert torch.load(fn, weights_only=False)["epoch"] is None
+
+    resumed = TinyExperiment(make_args(str(tmp_path)))
+    with pytest.raises(ValueError, match="not saved at the end of an epoch"):
+        resumed.load(fn)
+
+class StubEvaluator(object):
+    def __init__(self, pending):
+        self._pending_valid = pending
+
+    def pending(self):
+        return self._pending_valid
+
+def test_pending_validations_saved(experiment):
+    model_state = {key: val.clone() for key, val in experiment.model.state_dict().items()}
+    experiment.evaluator = StubEvaluator([(2, model_state)])
+    rolling_fn = experiment.save(epoch=3)
+    best_fn = experiment.save("best_model", epoch=3)
+    experiment.checkpointer.wait()
+    experiment.evaluator = None
+
+    # only the rolling checkpoints resume the training
+    assert torch.load(best_fn, weights_only=False)["pending_valid"] == []
+    (epoch, saved_state), = torch.load(rolling_fn, weights_only=False)["pending_valid"]
+    assert epoch == 2
+    assert_state_dicts_equal(saved_state, model_state)
@@ -0,0 +1,101 @@
+import os
+import itertools
+
+import pytest
+import torch
+
+from models.registry import MODELS
+from benchmarks.synthetic import make_corpus
+from export import Predictor, trace_model, export_onnx, OrtPredictor, SEQ_AXES
+from tests.helpers import preprocess_corpus, load_model_args
+
+"""
+NOTE:
+    - Parity of the exported models (TorchScript and ONNX) with the eager ones on the batches of their `collate_fn`:
+    the models are exported on a first batch and checked on the next batches, whose review/document axis is
+    trimmed to a different length, and on batches of a single example.
+    - The word, sent and doc pipelines are run on a small synthetic corpus once per module.
+"""
+
+ATOL = 1e-4
+
+@pytest.fixture(scope="module")
+def work_dir(tmp_path_factory):
+    work_dir = str(tmp_path_factory.mktemp("export"))
+    data_path = make_corpus(os.path.join(work_dir, "reviews.json.gz"), user_num=60, item_num=30,
+                            review_num=600, vocab_size=500, seed=0)
+    for kind in ["word", "sent", "doc"]:
+        preprocess_corpus(kind, data_path, os.path.join(work_dir, kind))
+    return work_dir
+
+def build_experiment(model_name, work_dir):
+    """
+    Returns:
+        experiment: with random weights, in eval mode on cpu
+        dataset: the valid Dataset of `model_name`
+    """
+    module_name, experiment_name, dataset_name, _, kind, _ = MODELS[model_name]
+    module, args = load_model_args(model_name, os.path.join(work_dir, kind), os.path.join(work_dir, "logs"))
+    # the exported models take the padded reviews
+    args.ragged_reviews = False
+    if model_name == "narre":
+        # trim the review axis per batch, as SimpleSiamese does
+        args.mask_padded_reviews = True
+    dataset = getattr(module, dataset_name)(args, "valid")
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=16, shuffle=False, collate_fn=dataset.collate_fn)
+    experiment = getattr(module, experiment_name)(args, {"train": dataloader, "valid": dataloader, "test": None})
+    torch.manual_seed(0)
+    experiment.model.to("cpu")
+    experiment.model.eval()
+    experiment.device = torch.device("cpu")
+    return experiment, dataset
+
+def get_batches(experiment, dataset, num_batches=4):
+    """
+    The first batch of `dataset` to export the model on, then the next batches and single examples to check it.
+    """
+    batches = list(itertools.islice(experiment.train_dataloader, num_batches))
+    single_batches = [dataset.collate_fn([dataset[k]]) for k in range(0, len(dataset), max(len(dataset) // 3, 1))]
+    return batches[0], batches[1:] + single_batches
+
+def check_parity(predictor, model, batches, experiment, get_inputs):
+    model_name = experiment.args.model_name
+    shapes = set()
+    with torch.no_grad():
+        for batch in batches:
+            inputs, _ = get_inputs(experiment, batch)
+            shapes.add(tuple(inputs[0].shape))
+            expected = Predictor(model)(*inputs)
+            outputs = predictor(*inputs)
+            assert outputs.shape == expected.shape
+            torch.testing.assert_close(outputs, expected, atol=ATOL, rtol=1e-4,
+                                        msg=lambda msg: f"{model_name} on inputs of {inputs[0].shape}: {msg}")
+    return shapes
+
+@pytest.mark.parametrize("model_name", list(MODELS))
+def test_torchscript_parity(model_name, work_dir):
+    experiment, dataset = build_experiment(model_name, work_dir)
+    get_inputs = MODELS[model_name][5]
+    example_batch, batches = get_batches(experiment, dataset)
+
+    example_inputs, _ = get_inputs(experiment, example_batch)
+    traced_model = trace_model(experiment.model, tuple(example_inputs))
+    shapes = check_parity(traced_model, experiment.model, batches, experiment, get_inputs)
+
+    # the checked batches include a single example and other lengths than the traced batch
+    assert any(shape[0] == 1 for shape in shapes)
+    if model_name in SEQ_AXES:
+        assert any(shape[1] != example_inputs[0].size(1) for shape in shapes)
+
+@pytest.mark.parametrize("model_name", list(MODELS))
+def test_onnx_parity(model_name, work_dir, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    experiment, dataset = build_experiment(model_name, work_dir)
+    get_inputs = MODELS[model_name][5]
+    example_batch, batches = get_batches(experiment, dataset)
+
+    example_inputs, _ = get_inputs(experiment, example_batch)
+    path = str(tmp_path / f"{model_name}.onnx")
+    export_onnx(experiment.model, tuple(example_inputs), path, seq_axes=SEQ_AXES.get(model_name))
+    check_parity(OrtPredictor(path, num_threads=1), experiment.model, batches, experiment, get_inputs)
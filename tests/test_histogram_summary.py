@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+import torch
+
+from utils import histogram_summary, split_histogram_summary
+from experiment import AsyncHistogramWriter
+
+"""
+NOTE:
+    - `histogram_summary` against `torch.quantile` and `torch.histc` on the unmasked values, the quantiles are
+    exact up to the width of the sub bins when the values are dense enough.
+    - `AsyncHistogramWriter` writes through a stub of the tensorboardX `SummaryWriter`.
+"""
+
+def test_histogram_summary():
+    torch.manual_seed(0)
+    weights = torch.softmax(torch.randn(64, 200), dim=-1) * 20
+    masks = torch.rand(64, 200) > 0.3
+    quantiles = (0.05, 0.5, 0.95)
+    moments, quantile_values, counts = split_histogram_summary(histogram_summary(weights, masks, 20, quantiles=quantiles),
+                                                                len(quantiles))
+    kept = weights[masks]
+
+    assert moments["num"] == len(kept)
+    assert moments["min"] == pytest.approx(kept.min().item(), abs=1e-6)
+    assert moments["max"] == pytest.approx(kept.max().item(), abs=1e-6)
+    assert moments["sum"] == pytest.approx(kept.sum().item(), abs=1e-4)
+    assert moments["sum_squares"] == pytest.approx((kept ** 2).sum().item(), abs=1e-4)
+    torch.testing.assert_close(torch.tensor(quantile_values), torch.quantile(kept, torch.tensor(quantiles)),
+                                atol=1. / (20 * 20), rtol=0.)
+    assert counts == torch.histc(kept.clamp(0., 1.), bins=20, min=0., max=1.).tolist()
+
+class StubWriter(object):
+    def __init__(self, fail_tags=()):
+        self.histograms = []
+        self.scalars = []
+        self.fail_tags = fail_tags
+        self.thread_names = set()
+
+    def add_histogram_raw(self, tag, min, max, num, sum, sum_squares, bucket_limits, bucket_counts, global_step=None):
+        self.thread_names.add(threading.current_thread().name)
+        if tag in self.fail_tags:
+            raise RuntimeError(f"can not write {tag}")
+        self.histograms.append((tag, num, global_step, list(bucket_limits), list(bucket_counts)))
+
+    def add_scalar(self, tag, value, global_step=None):
+        self.scalars.append((tag, value, global_step))
+
+def test_async_writer_writes_after_wait():
+    writer = StubWriter()
+    hist_writer = AsyncHistogramWriter(writer, num_bins=10, quantiles=(0.5,))
+    values = torch.rand(4, 8)
+    masks = torch.ones(4, 8, dtype=torch.bool)
+    masks[0, 4:] = False
+    hist_writer.add("att", values, 3, masks)
+    hist_writer.wait()
+
+    assert len(writer.histograms) == 1
+    tag, num, global_step, bucket_limits, bucket_counts = writer.histograms[0]
+    assert (tag, num, global_step) == ("att", 28, 3)
+    assert len(bucket_limits) == len(bucket_counts) == 10 and sum(bucket_counts) == 28
+    assert [(tag, step) for tag, _, step in writer.scalars] == [("att/q50", 3)]
+    assert threading.current_thread().name not in writer.thread_names
+
+def test_async_writer_skips_empty():
+    writer = StubWriter()
+    hist_writer = AsyncHistogramWriter(writer)
+    hist_writer.add("att", torch.rand(2, 5), 0, torch.zeros(2, 5, dtype=torch.bool))
+    hist_writer.wait()
+
+    assert writer.histograms == [] and writer.scalars == []
+
+def test_async_writer_error_resurfaces_on_next_add():
+    writer = StubWriter(fail_tags=("bad",))
+    hist_writer = AsyncHistogramWriter(writer)
+    hist_writer.add("bad", torch.rand(3), 0)
+    # let the background thread fail without raising from `wait`
+    hist_writer._queue.join()
+
+    with pytest.raises(IOError, match="failed to write histogram"):
+        hist_writer.add("good", torch.rand(3), 1)
+    # the error is raised once, the writer keeps working
+    hist_writer.add("good", torch.rand(3), 2)
+    hist_writer.wait()
+    assert [(tag, step) for tag, _, step, _, _ in writer.histograms] == [("good", 2)]
@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from tests.helpers import make_args, TinyExperiment, random_batch
+
+"""
+NOTE:
+    - `Experiment.optimize` and `update_lr`: the accumulated gradients of the batches of a group give the update
+    of their concatenation (`lr_scaling="none"`), the last group of an epoch may be shorter, and the lr is warmed
+    up linearly over `warmup_steps` updates unless the scheduler changed it.
+"""
+
+def build_experiment(tmp_path, **kwargs):
+    torch.manual_seed(0)
+    return TinyExperiment(make_args(str(tmp_path), **kwargs), dropout=0.)
+
+def cat_batches(batches):
+    return tuple(torch.cat(tensors) for tensors in zip(*batches))
+
+@pytest.mark.parametrize("accum_steps, num_batches", [(2, 4), (2, 5), (3, 7)])
+def test_accumulation_matches_full_batch(tmp_path, accum_steps, num_batches):
+    torch.manual_seed(1)
+    half_batches = [random_batch(bz=4) for _ in range(num_batches)]
+    # the last group is shorter when `num_batches` is not a multiple of `accum_steps`
+    full_batches = [cat_batches(half_batches[k:k + accum_steps]) for k in range(0, num_batches, accum_steps)]
+
+    accumulated = build_experiment(tmp_path, grad_accum_steps=accum_steps)
+    for batch_idx, batch in enumerate(half_batches):
+        accumulated.train_step(batch, batch_idx, num_batches)
+    reference = build_experiment(tmp_path)
+    for batch_idx, batch in enumerate(full_batches):
+        reference.train_step(batch, batch_idx, len(full_batches))
+
+    assert accumulated.updates == reference.updates == len(full_batches)
+    for param, ref_param in zip(accumulated.model.parameters(), reference.model.parameters()):
+        torch.testing.assert_close(param, ref_param)
+
+def test_no_update_inside_group(tmp_path):
+    experiment = build_experiment(tmp_path, grad_accum_steps=3)
+    weights = experiment.model[1].weight.detach().clone()
+    experiment.train_step(random_batch(), 0, 6)
+    experiment.train_step(random_batch(), 1, 6)
+    assert experiment.updates == 0
+    assert torch.equal(experiment.model[1].weight, weights)
+
+    experiment.train_step(random_batch(), 2, 6)
+    assert experiment.updates == 1
+    assert not torch.equal(experiment.model[1].weight, weights)
+
+@pytest.mark.parametrize("lr_scaling, scale", [("none", 1.), ("linear", 2.), ("sqrt", 2 ** 0.5)])
+def test_warmup_lr(tmp_path, lr_scaling, scale):
+    experiment = build_experiment(tmp_path, lr=0.1, grad_accum_steps=2, lr_scaling=lr_scaling, warmup_steps=4)
+    lrs = []
+    for batch_idx in range(12):
+        experiment.train_step(random_batch(), batch_idx, 12)
+        lrs.append(experiment.optimizer.param_groups[0]["lr"])
+
+    # one update every 2 batches, then the lr is left as is after the warmup
+    expected = [0.1 * scale * min(1., (update + 1) / 4) for update in range(6)]
+    assert lrs[1::2] == pytest.approx(expected)
+    assert lrs[0::2] == pytest.approx([0.1] + expected[:-1])
+
+def test_warmup_yields_to_scheduler(tmp_path):
+    experiment = build_experiment(tmp_path, lr=0.1, warmup_steps=4)
+    experiment.train_step(random_batch())
+    assert experiment.optimizer.param_groups[0]["lr"] == pytest.approx(0.025)
+
+    # e.g. `ReduceLROnPlateau` during the warmup, the reduced lr is kept
+    experiment.scheduler.step()
+    for _ in range(4):
+        experiment.train_step(random_batch())
+        assert experiment.optimizer.param_groups[0]["lr"] == pytest.approx(0.0125)
+
+def test_unknown_lr_scaling(tmp_path):
+    experiment = build_experiment(tmp_path, lr_scaling="cubic")
+    with pytest.raises(ValueError, match="cubic is not predefined"):
+        experiment.train_step(random_batch())
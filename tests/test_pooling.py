@@ -0,0 +1,67 @@
+import pytest
+import torch
+
+from utils import masked_max_pool1d, masked_mean_pool1d
+
+"""
+NOTE:
+    - The fused pooling functions give the same outputs and gradients as the unfused (autograd) versions they replace.
+"""
+
+def _reference_masked_mean_pool1d(inputs, input_masks):
+    float_masks = input_masks.unsqueeze(1).to(inputs.dtype)
+    return (inputs * float_masks).sum(dim=2, keepdim=True) / (float_masks.sum(dim=2, keepdim=True) + 1e-8)
+
+def _reference_masked_max_pool1d(inputs, input_masks):
+    input_masks = input_masks[:, :inputs.size(2)].unsqueeze(1)
+    outputs, _ = torch.max(torch.masked_fill(inputs, ~input_masks, -1e8), dim=2, keepdim=True)
+    return torch.masked_fill(outputs, ~input_masks.any(dim=2, keepdim=True), 0.)
+
+# the max pooling reads only the first `seq_len` positions of a longer mask
+POOLINGS = [(masked_mean_pool1d, _reference_masked_mean_pool1d, 12),
+            (masked_max_pool1d, _reference_masked_max_pool1d, 10)]
+
+@pytest.fixture
+def input_masks():
+    torch.manual_seed(0)
+    input_masks = torch.rand(6, 12) > 0.4
+    input_masks[0] = False # empty row
+    input_masks[1] = True
+    return input_masks
+
+@pytest.mark.parametrize("func, ref_func, seq_len", POOLINGS)
+def test_gradcheck(func, ref_func, seq_len, input_masks):
+    inputs = torch.randn(6, 5, seq_len, dtype=torch.float64, requires_grad=True)
+    assert torch.autograd.gradcheck(func, (inputs, input_masks[:, :seq_len]))
+
+@pytest.mark.parametrize("func, ref_func, seq_len", POOLINGS)
+@pytest.mark.parametrize("transposed", [False, True])
+def test_matches_reference(func, ref_func, seq_len, input_masks, transposed):
+    if transposed:
+        # non contiguous inputs, as the transposed embeddings of the models
+        leaf = torch.randn(6, seq_len, 5, requires_grad=True)
+        inputs = leaf.transpose(1, 2)
+        assert not inputs.is_contiguous()
+    else:
+        leaf = inputs = torch.randn(6, 5, seq_len, requires_grad=True)
+    grad_outputs = torch.randn(6, 5, 1)
+
+    outputs = func(inputs, input_masks)
+    ref_outputs = ref_func(inputs, input_masks)
+    grads, = torch.autograd.grad(outputs, leaf, grad_outputs)
+    ref_grads, = torch.autograd.grad(ref_outputs, leaf, grad_outputs)
+
+    assert outputs.shape == (6, 5, 1)
+    torch.testing.assert_close(outputs, ref_outputs, atol=1e-6, rtol=1e-5)
+    torch.testing.assert_close(grads, ref_grads, atol=1e-6, rtol=1e-5)
+
+@pytest.mark.parametrize("func, ref_func, seq_len", POOLINGS)
+def test_empty_rows(func, ref_func, seq_len, input_masks):
+    inputs = torch.randn(6, 5, seq_len, requires_grad=True)
+    outputs = func(inputs, input_masks)
+    grads, = torch.autograd.grad(outputs.sum(), inputs)
+
+    assert torch.equal(outputs[0], torch.zeros(5, 1))
+    assert torch.equal(grads[0], torch.zeros(5, seq_len))
+    # the masked positions of the other rows get no gradient either
+    assert torch.all(grads[1:].masked_select(~input_masks[1:, :seq_len].unsqueeze(1)) == 0)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from utils import (RaggedReviews, segment_sum, segment_max, segment_softmax, embedding_bag_mean, masked_softmax,
+                    masked_mean_pool1d, masked_max_pool1d)
+
+"""
+NOTE:
+    - `RaggedReviews` round trips the padded reviews, and the segment ops match their padded, masked versions.
+"""
+
+@pytest.fixture
+def revs():
+    rng = np.random.RandomState(0)
+    revs = np.zeros((5, 4, 6), dtype=np.int64)
+    for k, rv_num in enumerate([3, 0, 4, 1, 2]):
+        for r in range(rv_num):
+            rv_len = rng.randint(1, 7)
+            revs[k, r, :rv_len] = rng.randint(1, 20, size=rv_len)
+    return revs
+
+def test_round_trip(revs):
+    ragged = RaggedReviews.from_padded(revs)
+    assert torch.equal(ragged.to_padded(), torch.from_numpy(revs))
+
+def test_cat_of_rows(revs):
+    ragged = RaggedReviews.from_padded(revs)
+    merged = RaggedReviews.cat([ragged[k] for k in range(len(ragged))])
+    assert torch.equal(merged.tokens, ragged.tokens)
+    assert all(torch.equal(x, y) for x, y in zip(merged.offsets, ragged.offsets))
+
+def test_sentences_drop_empty():
+    # sentence level: the empty sentences and reviews are dropped
+    sents = np.zeros((2, 3, 2, 4), dtype=np.int64)
+    sents[0, 0, 0, :2] = [3, 4]
+    sents[0, 0, 1, :1] = [5]
+    sents[1, 2, 1, :3] = [6, 7, 8]
+    ragged_sents = RaggedReviews.from_padded(sents)
+    assert ragged_sents.tokens.tolist() == [3, 4, 5, 6, 7, 8]
+    assert [x.tolist() for x in ragged_sents.offsets] == [[0, 1, 2], [0, 2, 3], [0, 2, 3, 6]]
+
+SEGMENT_OPS = {
+    "sum": (lambda x, masks, offsets: segment_sum(x[masks], offsets),
+            lambda x, masks: (x * masks.unsqueeze(-1)).sum(dim=2)[masks.any(dim=-1)]),
+    "max": (lambda x, masks, offsets: segment_max(x[masks], offsets),
+            lambda x, masks: masked_max_pool1d(x.view(20, 6, 3).transpose(1, 2), masks.view(20, 6)).view(5, 4, 3)[masks.any(dim=-1)]),
+    "softmax": (lambda x, masks, offsets: segment_softmax(x[masks][:, 0], offsets),
+                lambda x, masks: masked_softmax(x[..., 0], masks)[masks]),
+}
+
+@pytest.mark.parametrize("op", list(SEGMENT_OPS))
+def test_segment_ops(revs, op):
+    func, ref_func = SEGMENT_OPS[op]
+    ragged = RaggedReviews.from_padded(revs)
+    masks = torch.from_numpy(revs != 0)
+    torch.manual_seed(0)
+    inputs = torch.randn(5, 4, 6, 3, dtype=torch.float64, requires_grad=True)
+
+    outputs, ref_outputs = func(inputs, masks, ragged.token_offsets), ref_func(inputs, masks)
+    grad_outputs = torch.randn_like(outputs)
+    grads, = torch.autograd.grad(outputs, inputs, grad_outputs)
+    ref_grads, = torch.autograd.grad(ref_outputs, inputs, grad_outputs)
+    torch.testing.assert_close(outputs, ref_outputs)
+    torch.testing.assert_close(grads, ref_grads)
+
+def test_embedding_bag_mean(revs):
+    ragged = RaggedReviews.from_padded(revs)
+    masks = torch.from_numpy(revs != 0)
+    torch.manual_seed(0)
+    word_embedding = nn.Module()
+    word_embedding.embedding = nn.Embedding(20, 3, padding_idx=0)
+    ref_outputs = masked_mean_pool1d(word_embedding.embedding(torch.from_numpy(revs)).view(20, 6, 3).transpose(1, 2),
+                                    masks.view(20, 6))
+
+    with torch.no_grad():
+        # ragged tokens with their offsets, and padded rows
+        torch.testing.assert_close(embedding_bag_mean(word_embedding, ragged.tokens, ragged.token_offsets),
+                                    ref_outputs.view(5, 4, 3)[masks.any(dim=-1)], atol=1e-6, rtol=1e-5)
+        torch.testing.assert_close(embedding_bag_mean(word_embedding, torch.from_numpy(revs).view(20, 6)),
+                                    ref_outputs.view(20, 3), atol=1e-6, rtol=1e-5)
@@ -0,0 +1,46 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from preprocess._tokenizer import Indexlizer
+from preprocess._stop_words import ENGLISH_STOP_WORDS
+from preprocess.divide_and_create_example_word import clean_str
+
+"""
+NOTE:
+    - Size regression test of the persisted `Indexlizer`, the pytest counterpart of `benchmarks.check_vocab_size`:
+    the pickled `freeze()` must scale with the vocab, not with the corpus it was built on.
+"""
+
+MAX_BYTES_PER_TOKEN = 32.
+
+WORDS = [f"word{k}" for k in range(300)]
+
+def make_corpus(num_reviews, seed=0):
+    """ Reviews drawn from the fixed `WORDS`, so the vocab stays the same whatever the corpus size. """
+    rng = np.random.RandomState(seed)
+    reviews = [" ".join(rng.choice(WORDS, size=rng.randint(5, 40))) + "." for _ in range(num_reviews)]
+    # every word appears at least once
+    reviews.append(" ".join(WORDS) + ".")
+    return reviews
+
+def frozen_size(reviews, keep_corpus):
+    indexlizer = Indexlizer(reviews, special_tokens=["<pad>", "<unk>"], preprocessor=clean_str, mode="word",
+                            stop_words=ENGLISH_STOP_WORDS, max_len=60, keep_corpus=keep_corpus)
+    indexlizer.transform(reviews)
+    return len(indexlizer._vocab), len(pickle.dumps(indexlizer.freeze()))
+
+@pytest.mark.parametrize("keep_corpus", [False, True])
+def test_frozen_size_bounded_per_token(keep_corpus):
+    vocab_size, frozen_bytes = frozen_size(make_corpus(200), keep_corpus)
+    assert vocab_size == len(WORDS) + 2
+    assert frozen_bytes / vocab_size <= MAX_BYTES_PER_TOKEN
+
+@pytest.mark.parametrize("keep_corpus", [False, True])
+def test_frozen_size_does_not_grow_with_corpus(keep_corpus):
+    small_vocab, small_bytes = frozen_size(make_corpus(100), keep_corpus)
+    large_vocab, large_bytes = frozen_size(make_corpus(2000, seed=1), keep_corpus)
+    assert small_vocab == large_vocab
+    # only the order of the vocab (by frequency) may differ, not its size
+    assert large_bytes / large_vocab <= small_bytes / small_vocab + 1.
@@ -15,12 +15,14 @@ from torch import LongTensor, FloatTensor
 import numpy as np
 from tensorboardX import SummaryWriter
 
-from experiment import Experiment
+from experiment import Experiment, AsyncHistogramWriter
 from gensim.models import KeyedVectors
-from utils import get_mask, get_seq_lengths_from_mask
+from utils import get_mask, get_seq_lengths_from_mask, compile_model
 #from ahn import LSTMForUserItemPredictionHIRCOAA as AHN
 from models.ahn.ahn_model import AHN
-from preprocess.divide_and_create_sent import clean_str
+from preprocess.divide_and_create_example_sent import clean_str
+from preprocess._meta import LazyMeta
+from preprocess._incremental import read_examples
 
 class Args(object):
     pass
@@ -97,12 +99,16 @@ class AhnExperiment(Experiment):
         self.build_scheduler() #self.scheduler
         self.build_loss_func() #self.loss_func
 
+        # resume
+        if self.args.resume_path:
+            self.load(self.args.resume_path)
+
         # print
-        self.global_step = 0
         self.print_args()
         self.print_model_stats()
         if self.args.tensorboard:
             self.writer = SummaryWriter(log_dir=self.out_dir)
+            self.att_writer = AsyncHistogramWriter(self.writer)
 
     def build_scheduler(self):
         pass
@@ -128,7 +134,7 @@ class AhnExperiment(Experiment):
 
         self.model = AHN(self.args.embedding_dim, self.args.hidden_dim, self.args.k_factor, 
                         user_size=_dataset.user_num, item_size=_dataset.item_num, 
-                        word_vocab_size=len(_dataset.word_vocab), 
+                        word_vocab_size=_dataset.vocab_size, 
                         pretrained_word_embeddings=None,
                         rnn_dropout=self.args.rnn_dropout, dropout=self.args.dropout,
                         item_review_num=_dataset.rv_num)
@@ -136,6 +142,9 @@ class AhnExperiment(Experiment):
             self.model = torch.nn.DataParallel(self.model)
             self.print_write_to_log("the model is parallel training.")
         self.model.to(self.device)
+        if self.args.compile:
+            compile_model(self.model)
+            self.print_write_to_log("the model is compiled by torch.compile.")
 
     def build_optimizer(self):
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.lr)
@@ -191,8 +200,7 @@ class AhnExperiment(Experiment):
         start_time = time.time()
 
         self.model.train()
-        for i, (u_text, i_text, u_id, i_id, _, _, label) in enumerate(self.train_dataloader):
-            self.global_step += 1
+        for i, (u_text, i_text, u_id, i_id, _, _, label) in enumerate(self.profiler.wrap(self.train_dataloader)):
             # form mask and lengths 
             u_sent_mask = self.get_sent_mask(u_text).to(self.device)
             i_sent_mask = self.get_sent_mask(i_text).to(self.device)
@@ -209,16 +217,14 @@ class AhnExperiment(Experiment):
             i_id = i_id.to(self.device)
             
             label = label.to(self.device)
+            self.profiler.mark("h2d")
 
-            self.optimizer.zero_grad()
             y_pred, us_weights, is_weights, ur_weights, ir_weights \
                     = self.model(u_text, i_text, u_sent_mask, i_sent_mask, u_sent_lengths, i_sent_lengths,
                                 u_review_mask, i_review_mask, u_id, i_id)
             loss = self.loss_func(y_pred, label)
-            loss.backward()
-
-            gnorm = nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
-            self.optimizer.step()
+            self.profiler.mark("forward")
+            gnorm = self.optimize(loss, i, len(self.train_dataloader))
 
             # val 
             avg_loss.update(loss.mean().item())
@@ -243,54 +249,45 @@ class AhnExperiment(Experiment):
 
             # tensorboard 
             if (i+1) % self.args.tensorboard_idx == 0 and self.args.tensorboard:
-                self.writer.add_histogram("user sentence attention weights", us_weights.clone().cpu().data.numpy(), global_step=self.global_step)
-                self.writer.add_histogram("item sentence attention weights", is_weights.clone().cpu().data.numpy(), global_step=self.global_step)
-                self.writer.add_histogram("user review attention weights", ur_weights.clone().cpu().data.numpy(), global_step=self.global_step)
-                self.writer.add_histogram("item review attention weights", ir_weights.clone().cpu().data.numpy(), global_step=self.global_step)
-
-    def valid_one_epoch(self):
-        square_error = 0.
-        accum_count = 0
-        avg_loss = AvgMeters()
-
-        self.model.eval()
-        for i, (u_text, i_text, u_id, i_id, _, _, label) in enumerate(self.valid_dataloader):
-            # form mask and lengths 
-            u_sent_mask = self.get_sent_mask(u_text).to(self.device)
-            i_sent_mask = self.get_sent_mask(i_text).to(self.device)
-            u_sent_lengths = self.get_sent_lengths(u_text).to(self.device)
-            i_sent_lengths = self.get_sent_lengths(i_text).to(self.device)
-            u_review_mask = self.get_review_mask(u_text).to(self.device)
-            i_review_mask = self.get_review_mask(i_text).to(self.device)
-
-
-            # to devicde
-            u_text = u_text.to(self.device)
-            i_text = i_text.to(self.device)
-            u_id = u_id.to(self.device)
-            i_id = i_id.to(self.device)
-
-            label = label.to(self.device)
-
-            with torch.no_grad():
-                y_pred, _, _, _, _= self.model(u_text, i_text, u_sent_mask, i_sent_mask, u_sent_lengths, i_sent_lengths,
-                                u_review_mask, i_review_mask, u_id, i_id)
-                #y_pred = self.model(u_id, i_id)
-                loss = self.loss_func(y_pred, label)
-
-            square_error += loss.mean().item() * label.size(0)
-            accum_count += label.size(0)
-            avg_loss.update(loss.mean().item())
-
-        rmse = math.sqrt(square_error / accum_count)
+                self.att_writer.add("user sentence attention weights", us_weights, self.updates, u_sent_mask)
+                self.att_writer.add("item sentence attention weights", is_weights, self.updates, i_sent_mask)
+                self.att_writer.add("user review attention weights", ur_weights, self.updates, u_review_mask)
+                self.att_writer.add("item review attention weights", ir_weights, self.updates, i_review_mask)
+
+            self.profiler.step(label.size(0), self.updates)
+
+    def forward_batch(self, batch):
+        u_text, i_text, u_id, i_id, _, _, label = batch
+        # form mask and lengths 
+        u_sent_mask = self.get_sent_mask(u_text).to(self.device)
+        i_sent_mask = self.get_sent_mask(i_text).to(self.device)
+        u_sent_lengths = self.get_sent_lengths(u_text).to(self.device)
+        i_sent_lengths = self.get_sent_lengths(i_text).to(self.device)
+        u_review_mask = self.get_review_mask(u_text).to(self.device)
+        i_review_mask = self.get_review_mask(i_text).to(self.device)
+
+        y_pred, _, _, _, _ = self.model(u_text.to(self.device), i_text.to(self.device), u_sent_mask, i_sent_mask,
+                                u_sent_lengths, i_sent_lengths, u_review_mask, i_review_mask, u_id.to(self.device), i_id.to(self.device))
+        return y_pred, label.to(self.device)
+
+    def valid_one_epoch(self, epoch, metrics=None, model_state=None):
+        """
+        Args:
+            epoch: last finished epoch of the validated weights, saved with the best model
+            metrics, model_state: the result of an `AsyncEvaluator` and the weights it evaluated, default to
+                evaluating the current model
+        """
+        if metrics is None:
+            metrics = self.evaluate(self.valid_dataloader)
+        rmse = metrics["rmse"]
         if rmse < self.best_rmse:
             self.best_rmse =  rmse 
-            self.save("best_model.pt")
+            self.save("best_model.pt", epoch=epoch, model_state=model_state)
             self.patience = 0
         else:
             self.patience += 1
 
-        log_text =  "valid loss: {:.3f}, valid rmse: {:.3f}, best rmse: {:.3f}".format(avg_loss.val, rmse, self.best_rmse)
+        log_text =  "valid loss: {:.3f}, valid rmse: {:.3f}, valid mae: {:.3f}, best rmse: {:.3f}".format(metrics["mse"], rmse, metrics["mae"], self.best_rmse)
         self.print_write_to_log(log_text)
 
         # ealry stop
@@ -312,9 +309,11 @@ class AhnExperiment(Experiment):
 
     def train(self):
         print("start training ...")
-        for epoch in range(self.args.epochs):
+        for epoch in range(self.start_epoch, self.args.epochs):
             self.train_one_epoch(epoch)
-            self.valid_one_epoch()
+            self.validate(epoch)
+            self.save(epoch=epoch)
+        self.wait_validation()
 
 class AhnDataset(torch.utils.data.Dataset):
     def __init__(self, args, set_name):
@@ -322,25 +321,27 @@ class AhnDataset(torch.utils.data.Dataset):
 
         self.args = args
         self.set_name = set_name
-        param_path = os.path.join(self.args.data_dir, "meta.pkl")
-        with open(param_path, "rb") as f:
-            para = pickle.load(f)
-
-        self.user_num = para['user_num']
-        self.item_num = para['item_num']
-        self.indexlizer = para['indexlizer']
-        self.rv_num = para["rv_num"]
-        self.sent_num = para["sent_num"]
-        self.word_num = para["word_num"]
-        self.u_text = para['user_reviews']
-        self.i_text = para['item_reviews']
-        self.u_rids = para["user_rids"]
-        self.i_rids = para["item_rids"]
-        self.word_vocab = self.indexlizer._vocab
+        # only the header is read here, the other components of the meta are loaded on first access
+        self.meta = LazyMeta(self.args.data_dir)
+
+        self.user_num = self.meta["user_num"]
+        self.item_num = self.meta["item_num"]
+        self.rv_num = self.meta["rv_num"]
+        self.sent_num = self.meta["sent_num"]
+        self.word_num = self.meta["word_num"]
+        self.vocab_size = self.meta["vocab_size"]
 
         example_path = os.path.join(self.args.data_dir, f"{set_name}_exmaples.pkl")
-        with open(example_path, "rb") as f:
-            self.examples = pickle.load(f)
+        # the examples of the deltas are appended to the file, see `read_examples`
+        self.examples = read_examples(example_path)
+
+    @property
+    def indexlizer(self):
+        return self.meta["indexlizer"]
+
+    @property
+    def word_vocab(self):
+        return self.indexlizer._vocab
 
     def __getitem__(self, i):
         # for each review(u_text or i_text) [...] 
@@ -449,12 +450,18 @@ if __name__ == "__main__":
     args = parse_args(config_file)
     train_dataset = AhnDataset(args, "train")
     valid_dataset = AhnDataset(args, "valid")
+    test_dataset = AhnDataset(args, "test")
 
     train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_size=50, shuffle=True, collate_fn=train_dataset.collate_fn, num_workers=8)
     valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_size=50, shuffle=False, collate_fn=valid_dataset.collate_fn, num_workers=8)
+    test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=50, shuffle=False, collate_fn=test_dataset.collate_fn, num_workers=8)
     #train_dataset.print_info()
     #valid_dataset.print_info()
 
-    dataloaders = {"train": train_dataloder, "valid": valid_dataloader, "test": None}
+    dataloaders = {"train": train_dataloder, "valid": valid_dataloader, "test": test_dataloader}
     experiment = AhnExperiment(args, dataloaders)
-    experiment.train()
+    try:
+        experiment.train()
+    except EarlyStop:
+        pass
+    experiment.test()
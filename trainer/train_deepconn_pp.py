@@ -17,8 +17,11 @@ from gensim.models import KeyedVectors
 
 from models.deepconn.deepconn import DeepCoNNpp
 from experiment import Experiment
-from utils import get_mask
+from utils import get_mask, compile_model
+from samplers import LengthSortedBatchSampler
 from preprocess.divide_and_create_example_sent import clean_str
+from preprocess._meta import LazyMeta
+from preprocess._incremental import read_examples
 
 class Args(object):
     pass
@@ -93,6 +96,10 @@ class DeepCoNNExperiment(Experiment):
         self.build_scheduler() #self.scheduler
         self.build_loss_func() #self.loss_func
 
+        # resume
+        if self.args.resume_path:
+            self.load(self.args.resume_path)
+
         # print
         self.print_args()
         self.print_model_stats()
@@ -122,7 +129,7 @@ class DeepCoNNExperiment(Experiment):
             word_pretrained=None
 
         self.model = DeepCoNNpp(user_size=_dataset.user_num, item_size=_dataset.item_num, 
-                vocab_size=len(_dataset.word_vocab), kernel_sizes=[3],hidden_dim=self.args.hidden_dim, embedding_dim=self.args.embedding_dim,
+                vocab_size=_dataset.vocab_size, kernel_sizes=[3],hidden_dim=self.args.hidden_dim, embedding_dim=self.args.embedding_dim,
                 dropout=self.args.dropout, latent_dim=self.args.latent_dim, doc_len=_dataset.doc_len, pretrained_embeddings=word_pretrained, 
                 arch=self.args.arch)
 
@@ -130,6 +137,9 @@ class DeepCoNNExperiment(Experiment):
             self.model = torch.nn.DataParallel(self.model)
             self.print_write_to_log("the model is parallel training.")
         self.model.to(self.device)
+        if self.args.compile:
+            compile_model(self.model)
+            self.print_write_to_log("the model is compiled by torch.compile.")
 
     def build_optimizer(self):
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.lr)
@@ -147,7 +157,7 @@ class DeepCoNNExperiment(Experiment):
         start_time = time.time()
 
         self.model.train()
-        for i, (u_docs, i_docs, u_doc_word_masks, i_doc_word_masks, u_ids, i_ids, ratings) in enumerate(self.train_dataloader):
+        for i, (u_docs, i_docs, u_doc_word_masks, i_doc_word_masks, u_ids, i_ids, ratings) in enumerate(self.profiler.wrap(self.train_dataloader)):
             if i == 0 and current_epoch == 0:
                 print("u_docs", u_docs.shape, "i_docs", i_docs.shape)
             u_docs = u_docs.to(self.device)
@@ -157,15 +167,13 @@ class DeepCoNNExperiment(Experiment):
             u_ids = u_ids.to(self.device)
             i_ids = i_ids.to(self.device)
             ratings = ratings.to(self.device)
+            self.profiler.mark("h2d")
 
-            self.optimizer.zero_grad()
             y_pred = self.model(u_docs, i_docs, u_doc_word_masks, i_doc_word_masks, u_ids, i_ids)
             #y_pred = self.model(u_id, i_id)
             loss = self.loss_func(y_pred, ratings)
-            loss.backward()
-
-            gnorm = nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
-            self.optimizer.step()
+            self.profiler.mark("forward")
+            gnorm = self.optimize(loss, i, len(self.train_dataloader))
 
             # val 
             avg_loss.update(loss.mean().item())
@@ -188,38 +196,30 @@ class DeepCoNNExperiment(Experiment):
                 accum_count = 0
                 start_time = time.time()
 
-    def valid_one_epoch(self):
-        square_error = 0.
-        accum_count = 0
-        avg_loss = AvgMeters()
-
-        self.model.eval()
-        for i, (u_docs, i_docs, u_doc_word_masks, i_doc_word_masks, u_ids, i_ids, ratings) in enumerate(self.valid_dataloader):
-            u_docs = u_docs.to(self.device)
-            i_docs = i_docs.to(self.device)
-            u_doc_word_masks = u_doc_word_masks.to(self.device)
-            i_doc_word_masks = i_doc_word_masks.to(self.device)
-            u_ids = u_ids.to(self.device)
-            i_ids = i_ids.to(self.device)
-            ratings = ratings.to(self.device)
-
-            with torch.no_grad():
-                y_pred = self.model(u_docs, i_docs, u_doc_word_masks, i_doc_word_masks, u_ids, i_ids)
-                loss = self.loss_func(y_pred, ratings)
-
-            square_error += loss.mean().item() * ratings.size(0)
-            accum_count += ratings.size(0)
-            avg_loss.update(loss.mean().item())
-
-        rmse = math.sqrt(square_error / accum_count)
+            self.profiler.step(ratings.size(0), self.updates)
+
+    def forward_batch(self, batch):
+        batch = [x.to(self.device) for x in batch]
+        return self.model(*batch[:-1]), batch[-1]
+
+    def valid_one_epoch(self, epoch, metrics=None, model_state=None):
+        """
+        Args:
+            epoch: last finished epoch of the validated weights, saved with the best model
+            metrics, model_state: the result of an `AsyncEvaluator` and the weights it evaluated, default to
+                evaluating the current model
+        """
+        if metrics is None:
+            metrics = self.evaluate(self.valid_dataloader)
+        rmse = metrics["rmse"]
         if rmse < self.best_rmse:
             self.best_rmse =  rmse 
-            self.save("best_model.pt")
+            self.save("best_model.pt", epoch=epoch, model_state=model_state)
             self.patience = 0
         else:
             self.patience += 1
 
-        log_text =  "valid loss: {:.3f}, valid rmse: {:.3f}, best rmse: {:.3f}".format(avg_loss.val, rmse, self.best_rmse)
+        log_text =  "valid loss: {:.3f}, valid rmse: {:.3f}, valid mae: {:.3f}, best rmse: {:.3f}".format(metrics["mse"], rmse, metrics["mae"], self.best_rmse)
         self.print_write_to_log(log_text)
 
         # ealry stop
@@ -241,51 +241,96 @@ class DeepCoNNExperiment(Experiment):
 
     def train(self):
         print("start training ...")
-        for epoch in range(self.args.epochs):
+        for epoch in range(self.start_epoch, self.args.epochs):
             self.train_one_epoch(epoch)
-            self.valid_one_epoch()
+            self.validate(epoch)
+            self.save(epoch=epoch)
+        self.wait_validation()
 
 class DeepCoNNDataset(torch.utils.data.Dataset):
+    # shortest length a batch is truncated to, the widest convolution without padding needs it
+    min_doc_len = 3
+
     def __init__(self, args, set_name):
         super(DeepCoNNDataset, self).__init__()
 
         self.args = args
         self.set_name = set_name
-        param_path = os.path.join(self.args.data_dir, "meta.pkl")
-        with open(param_path, "rb") as f:
-            para = pickle.load(f)
-
-        self.user_num = para['user_num']
-        self.item_num = para['item_num']
-        self.indexlizer = para['indexlizer']
-        self.u_docs = para['user_docs']
-        self.i_docs = para['item_docs']
-        self.doc_len = para["doc_len"]
-        self.word_vocab = self.indexlizer._vocab
+        # only the header is read here, the other components of the meta are loaded on first access
+        self.meta = LazyMeta(self.args.data_dir)
+
+        self.user_num = self.meta["user_num"]
+        self.item_num = self.meta["item_num"]
+        self.doc_len = self.meta["doc_len"]
+        # int32 [num, doc_len], memory-mapped so that dataloader workers share the pages
+        self.u_docs = self.meta["user_docs"]
+        self.i_docs = self.meta["item_docs"]
+        self.vocab_size = self.meta["vocab_size"]
 
         example_path = os.path.join(self.args.data_dir, f"{set_name}_exmaples.pkl")
-        with open(example_path, "rb") as f:
-            self.examples = pickle.load(f)
+        # the examples of the deltas are appended to the file, see `read_examples`
+        self.examples = read_examples(example_path)
+
+        # number of real tokens of each example, used to group similar lengths in a batch
+        u_doc_lens = np.count_nonzero(self.u_docs, axis=1)
+        i_doc_lens = np.count_nonzero(self.i_docs, axis=1)
+        u_ids, i_ids = self.get_ids(self.examples)
+        self.lengths = np.maximum(u_doc_lens[u_ids], i_doc_lens[i_ids])
 
+    @property
+    def indexlizer(self):
+        return self.meta["indexlizer"]
+
+    @property
+    def word_vocab(self):
+        return self.indexlizer._vocab
 
     def __getitem__(self, i):
-        # for each review(u_docs or i_docs) [...] 
-        # NOTE: not padding 
-        u_id, i_id, rating, u_doc, i_doc = self.examples[i]
+        # documents are gathered by id in `collate_fn`
+        u_id, i_id, rating = self.examples[i]
 
-        return u_id, i_id, rating, u_doc, i_doc
+        return u_id, i_id, rating
 
     def __len__(self):
         return len(self.examples)
 
+    @staticmethod
+    def get_ids(examples):
+        u_ids = np.array([exp[0] for exp in examples], dtype=np.int64)
+        i_ids = np.array([exp[1] for exp in examples], dtype=np.int64)
+        return u_ids, i_ids
+
+    def gather_docs(self, docs, ids):
+        """
+        Args:
+            docs: int32 memmap with shape of [num, doc_len]
+            ids: list of int with length of bz
+
+        Returns:
+            docs: LongTensor with shape of [bz, doc_len]
+        """
+        return torch.from_numpy(docs[np.asarray(ids, dtype=np.int64)].astype(np.int64))
+
+    def truncate_docs(self, docs):
+        """
+        Drop the padding columns shared by the whole batch.
+        Args:
+            docs: LongTensor with shape of [bz, doc_len], padding only at the end
+
+        Returns:
+            docs: LongTensor with shape of [bz, max(longest doc in batch, min_doc_len)]
+        """
+        max_len = int(docs.ne(0).sum(dim=1).max())
+        return docs[:, :max(max_len, self.min_doc_len)].contiguous()
+
     def collate_fn(self, batch):
-        u_ids, i_ids, ratings, u_docs, i_docs = zip(*batch)
+        u_ids, i_ids, ratings = zip(*batch)
         
+        u_docs = self.truncate_docs(self.gather_docs(self.u_docs, u_ids))
+        i_docs = self.truncate_docs(self.gather_docs(self.i_docs, i_ids))
         u_ids = LongTensor(u_ids)
         i_ids = LongTensor(i_ids)
         ratings = FloatTensor(ratings)
-        u_docs = LongTensor(u_docs)
-        i_docs= LongTensor(i_docs)
         u_doc_word_masks = get_mask(u_docs)
         i_doc_word_masks = get_mask(i_docs)
 
@@ -296,10 +341,24 @@ if __name__ == "__main__":
     args = parse_args(config_file)
     train_dataset = DeepCoNNDataset(args, "train")
     valid_dataset = DeepCoNNDataset(args, "valid")
-
-    train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=train_dataset.collate_fn, num_workers=8)
-    valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=valid_dataset.collate_fn, num_workers=8)
-
-    dataloaders = {"train": train_dataloder, "valid": valid_dataloader, "test": None}
+    test_dataset = DeepCoNNDataset(args, "test")
+
+    if args.sort_by_length:
+        train_sampler = LengthSortedBatchSampler(train_dataset.lengths, args.batch_size, shuffle=True)
+        valid_sampler = LengthSortedBatchSampler(valid_dataset.lengths, args.batch_size, shuffle=False)
+        train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=train_dataset.collate_fn, num_workers=8)
+        valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_sampler=valid_sampler, collate_fn=valid_dataset.collate_fn, num_workers=8)
+        test_sampler = LengthSortedBatchSampler(test_dataset.lengths, args.batch_size, shuffle=False)
+        test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_sampler=test_sampler, collate_fn=test_dataset.collate_fn, num_workers=8)
+    else:
+        train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=train_dataset.collate_fn, num_workers=8)
+        valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=valid_dataset.collate_fn, num_workers=8)
+        test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=test_dataset.collate_fn, num_workers=8)
+
+    dataloaders = {"train": train_dataloder, "valid": valid_dataloader, "test": test_dataloader}
     experiment = DeepCoNNExperiment(args, dataloaders)
-    experiment.train()
\ No newline at end of file
+    try:
+        experiment.train()
+    except EarlyStop:
+        pass
+    experiment.test()
\ No newline at end of file
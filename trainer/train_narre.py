@@ -13,12 +13,16 @@ import torch
 import torch.nn as nn
 from torch import LongTensor, FloatTensor
 import numpy as np
+from tensorboardX import SummaryWriter
 from gensim.models import KeyedVectors
 
 from models.narre.narre import NARRE
-from experiment import Experiment
-from utils import get_mask
+from experiment import Experiment, AsyncHistogramWriter
+from utils import get_mask, compile_model
+from samplers import LengthSortedBatchSampler
 from preprocess.divide_and_create_example_word import clean_str
+from preprocess._meta import LazyMeta
+from preprocess._incremental import read_examples
 
 class Args(object):
     pass
@@ -93,9 +97,16 @@ class NarreExperiment(Experiment):
         self.build_scheduler() #self.scheduler
         self.build_loss_func() #self.loss_func
 
+        # resume
+        if self.args.resume_path:
+            self.load(self.args.resume_path)
+
         # print
         self.print_args()
         self.print_model_stats()
+        if self.args.tensorboard:
+            self.writer = SummaryWriter(log_dir=self.out_dir)
+            self.att_writer = AsyncHistogramWriter(self.writer)
 
     def build_scheduler(self):
         pass
@@ -121,16 +132,20 @@ class NarreExperiment(Experiment):
             _dataset  = self.train_dataloader.dataset
             word_pretrained=None
         self.model = NARRE(user_size=_dataset.user_num, item_size=_dataset.item_num, 
-                vocab_size=len(_dataset.word_vocab), kernel_sizes=[3],
+                vocab_size=_dataset.vocab_size, kernel_sizes=[3],
                 hidden_dim=150, embedding_dim=self.args.embedding_dim, 
                 att_dim=self.args.att_dim, latent_dim=self.args.latent_dim,
                 max_doc_num=_dataset.rv_num, max_doc_len=_dataset.rv_len, dropout=self.args.dropout, 
                 word_padding_idx=0, user_padding_idx=0, item_padding_idx=0, 
-                pretrained_embeddings=word_pretrained, arch=self.args.arch)
+                pretrained_embeddings=word_pretrained, arch=self.args.arch,
+                mask_padded_reviews=self.args.mask_padded_reviews)
         if self.args.parallel:
             self.model = torch.nn.DataParallel(self.model)
             self.print_write_to_log("the model is parallel training.")
         self.model.to(self.device)
+        if self.args.compile:
+            compile_model(self.model)
+            self.print_write_to_log("the model is compiled by torch.compile.")
 
     def build_optimizer(self):
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.lr)
@@ -148,7 +163,7 @@ class NarreExperiment(Experiment):
         start_time = time.time()
 
         self.model.train()
-        for i, (u_text, i_text, u_rv_masks, i_rv_masks, u_id, i_id, reuid, reiid, label) in enumerate(self.train_dataloader):
+        for i, (u_text, i_text, u_rv_masks, i_rv_masks, u_id, i_id, reuid, reiid, label) in enumerate(self.profiler.wrap(self.train_dataloader)):
             if i == 0 and current_epoch == 0:
                 print("u_text", u_text.shape, "i_text", i_text.shape, "reuid", reuid.shape, "reiid", reiid.shape)
             u_text = u_text.to(self.device)
@@ -160,15 +175,13 @@ class NarreExperiment(Experiment):
             reuid = reuid.to(self.device)
             reiid = reiid.to(self.device)
             label = label.to(self.device)
+            self.profiler.mark("h2d")
 
-            self.optimizer.zero_grad()
-            y_pred, _, _ = self.model(u_text, i_text, u_rv_masks, i_rv_masks, u_id, i_id, reuid, reiid)
+            y_pred, u_att_scores, i_att_scores = self.model(u_text, i_text, u_rv_masks, i_rv_masks, u_id, i_id, reuid, reiid)
             #y_pred = self.model(u_id, i_id)
             loss = self.loss_func(y_pred, label)
-            loss.backward()
-
-            gnorm = nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
-            self.optimizer.step()
+            self.profiler.mark("forward")
+            gnorm = self.optimize(loss, i, len(self.train_dataloader))
 
             # val 
             avg_loss.update(loss.mean().item())
@@ -191,41 +204,36 @@ class NarreExperiment(Experiment):
                 accum_count = 0
                 start_time = time.time()
 
-    def valid_one_epoch(self):
-        square_error = 0.
-        accum_count = 0
-        avg_loss = AvgMeters()
+            # tensorboard 
+            if (i+1) % self.args.tensorboard_idx == 0 and self.args.tensorboard:
+                self.att_writer.add("user review attention weights", u_att_scores.squeeze(-1), self.updates, u_rv_masks.any(dim=-1))
+                self.att_writer.add("item review attention weights", i_att_scores.squeeze(-1), self.updates, i_rv_masks.any(dim=-1))
 
-        self.model.eval()
-        for i, (u_text, i_text, u_rv_masks, i_rv_masks, u_id, i_id, reuid, reiid, label) in enumerate(self.valid_dataloader):
-            u_text = u_text.to(self.device)
-            i_text = i_text.to(self.device)
-            u_rv_masks = u_rv_masks.to(self.device)
-            i_rv_masks = i_rv_masks.to(self.device)
-            u_id = u_id.to(self.device)
-            i_id = i_id.to(self.device)
-            reuid = reuid.to(self.device)
-            reiid = reiid.to(self.device)
-            label = label.to(self.device)
+            self.profiler.step(label.size(0), self.updates)
 
-            with torch.no_grad():
-                y_pred, _, _ = self.model(u_text, i_text, u_rv_masks, i_rv_masks, u_id, i_id, reuid, reiid)
-                #y_pred = self.model(u_id, i_id)
-                loss = self.loss_func(y_pred, label)
-
-            square_error += loss.mean().item() * label.size(0)
-            accum_count += label.size(0)
-            avg_loss.update(loss.mean().item())
+    def forward_batch(self, batch):
+        batch = [x.to(self.device) for x in batch]
+        y_pred, _, _ = self.model(*batch[:-1])
+        return y_pred, batch[-1]
 
-        rmse = math.sqrt(square_error / accum_count)
+    def valid_one_epoch(self, epoch, metrics=None, model_state=None):
+        """
+        Args:
+            epoch: last finished epoch of the validated weights, saved with the best model
+            metrics, model_state: the result of an `AsyncEvaluator` and the weights it evaluated, default to
+                evaluating the current model
+        """
+        if metrics is None:
+            metrics = self.evaluate(self.valid_dataloader)
+        rmse = metrics["rmse"]
         if rmse < self.best_rmse:
             self.best_rmse =  rmse 
-            self.save("best_model.pt")
+            self.save("best_model.pt", epoch=epoch, model_state=model_state)
             self.patience = 0
         else:
             self.patience += 1
 
-        log_text =  "valid loss: {:.3f}, valid rmse: {:.3f}, best rmse: {:.3f}".format(avg_loss.val, rmse, self.best_rmse)
+        log_text =  "valid loss: {:.3f}, valid rmse: {:.3f}, valid mae: {:.3f}, best rmse: {:.3f}".format(metrics["mse"], rmse, metrics["mae"], self.best_rmse)
         self.print_write_to_log(log_text)
 
         # ealry stop
@@ -247,9 +255,11 @@ class NarreExperiment(Experiment):
 
     def train(self):
         print("start training ...")
-        for epoch in range(self.args.epochs):
+        for epoch in range(self.start_epoch, self.args.epochs):
             self.train_one_epoch(epoch)
-            self.valid_one_epoch()
+            self.validate(epoch)
+            self.save(epoch=epoch)
+        self.wait_validation()
 
 class NarreDataset(torch.utils.data.Dataset):
     def __init__(self, args, set_name):
@@ -257,25 +267,29 @@ class NarreDataset(torch.utils.data.Dataset):
 
         self.args = args
         self.set_name = set_name
-        param_path = os.path.join(self.args.data_dir, "meta.pkl")
-        with open(param_path, "rb") as f:
-            para = pickle.load(f)
-
-        self.user_num = para['user_num']
-        self.item_num = para['item_num']
-        self.indexlizer = para['indexlizer']
-        self.rv_num = para["rv_num"]
-        self.rv_len = para["rv_len"]
-        self.u_text = para['user_reviews']
-        self.i_text = para['item_reviews']
-        self.u_rids = para["user_rids"]
-        self.i_rids = para["item_rids"]
-        self.word_vocab = self.indexlizer._vocab
+        # only the header is read here, the other components of the meta are loaded on first access
+        self.meta = LazyMeta(self.args.data_dir)
+
+        self.user_num = self.meta["user_num"]
+        self.item_num = self.meta["item_num"]
+        self.rv_num = self.meta["rv_num"]
+        self.rv_len = self.meta["rv_len"]
+        self.vocab_size = self.meta["vocab_size"]
 
         example_path = os.path.join(self.args.data_dir, f"{set_name}_exmaples.pkl")
-        with open(example_path, "rb") as f:
-            self.examples = pickle.load(f)
+        # the examples of the deltas are appended to the file, see `read_examples`
+        self.examples = read_examples(example_path)
+
+        # number of reviews of each example, used to group similar review counts in a batch
+        self.lengths = np.maximum(self.get_review_nums(self.examples, 3), self.get_review_nums(self.examples, 4))
 
+    @property
+    def indexlizer(self):
+        return self.meta["indexlizer"]
+
+    @property
+    def word_vocab(self):
+        return self.indexlizer._vocab
 
     def __getitem__(self, i):
         # for each review(u_text or i_text) [...] 
@@ -313,16 +327,49 @@ class NarreDataset(torch.utils.data.Dataset):
 
         return masks.bool()
 
+    @staticmethod
+    def get_review_nums(examples, field):
+        """
+        Args:
+            examples: list of examples, `exp[field]` is a list of rv_num padded reviews
+
+        Returns:
+            review_nums: np.ndarray with shape of [num_examples], 1 + the position of the last non-empty review
+        """
+        nonempty = np.array([[rev[0] for rev in exp[field]] for exp in examples], dtype=np.int64).reshape(len(examples), -1) != 0
+        return np.where(nonempty.any(axis=1), nonempty.shape[1] - np.argmax(nonempty[:, ::-1], axis=1), 0)
+
+    @staticmethod
+    def truncate_reviews(revs, rids):
+        """
+        Drop the review columns which are empty for the whole batch.
+        Args:
+            revs: LongTensor with shape of [bz, rv_num, rv_len]
+            rids: LongTensor with shape of [bz, rv_num]
+
+        Returns:
+            revs: LongTensor with shape of [bz, max(most reviews in batch, 1), rv_len]
+            rids: LongTensor with shape of [bz, max(most reviews in batch, 1)]
+        """
+        nonempty_cols = revs[:, :, 0].ne(0).any(dim=0).nonzero()
+        rv_num = int(nonempty_cols.max()) + 1 if len(nonempty_cols) > 0 else 1
+        return revs[:, :rv_num].contiguous(), rids[:, :rv_num].contiguous()
+
     def collate_fn(self, batch):
         u_ids, i_ids, ratings, u_revs, i_revs, u_rids, i_rids = zip(*batch)
         
         u_ids = LongTensor(u_ids)
         i_ids = LongTensor(i_ids)
         ratings = FloatTensor(ratings)
-        u_revs = LongTensor(u_revs)
-        i_revs = LongTensor(i_revs)
+        # nested lists -> ndarray is faster than `LongTensor`
+        u_revs = torch.from_numpy(np.array(u_revs, dtype=np.int64))
+        i_revs = torch.from_numpy(np.array(i_revs, dtype=np.int64))
         u_rids = LongTensor(u_rids)
         i_rids = LongTensor(i_rids)
+        # the padded reviews change the outputs unless they are masked
+        if self.args.mask_padded_reviews:
+            u_revs, u_rids = self.truncate_reviews(u_revs, u_rids)
+            i_revs, i_rids = self.truncate_reviews(i_revs, i_rids)
 
         u_rev_word_masks = get_mask(u_revs)
         i_rev_word_masks = get_mask(i_revs)
@@ -334,10 +381,24 @@ if __name__ == "__main__":
     args = parse_args(config_file)
     train_dataset = NarreDataset(args, "train")
     valid_dataset = NarreDataset(args, "valid")
-
-    train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=train_dataset.collate_fn, num_workers=8)
-    valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=valid_dataset.collate_fn, num_workers=8)
-
-    dataloaders = {"train": train_dataloder, "valid": valid_dataloader, "test": None}
+    test_dataset = NarreDataset(args, "test")
+
+    if args.sort_by_length:
+        train_sampler = LengthSortedBatchSampler(train_dataset.lengths, args.batch_size, shuffle=True)
+        valid_sampler = LengthSortedBatchSampler(valid_dataset.lengths, args.batch_size, shuffle=False)
+        train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=train_dataset.collate_fn, num_workers=8)
+        valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_sampler=valid_sampler, collate_fn=valid_dataset.collate_fn, num_workers=8)
+        test_sampler = LengthSortedBatchSampler(test_dataset.lengths, args.batch_size, shuffle=False)
+        test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_sampler=test_sampler, collate_fn=test_dataset.collate_fn, num_workers=8)
+    else:
+        train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=train_dataset.collate_fn, num_workers=8)
+        valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=valid_dataset.collate_fn, num_workers=8)
+        test_dataloader = torch.utils.data.DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=test_dataset.collate_fn, num_workers=8)
+
+    dataloaders = {"train": train_dataloder, "valid": valid_dataloader, "test": test_dataloader}
     experiment = NarreExperiment(args, dataloaders)
-    experiment.train()
\ No newline at end of file
+    try:
+        experiment.train()
+    except EarlyStop:
+        pass
+    experiment.test()
\ No newline at end of file
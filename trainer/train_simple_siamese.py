@@ -17,8 +17,11 @@ import numpy as np
 from gensim.models import KeyedVectors
 
 from experiment import Experiment
-from utils import get_mask
+from utils import get_mask, compile_model, RaggedReviews
+from samplers import NegativeSampler, LengthSortedBatchSampler
 from preprocess.divide_and_create_example_word import clean_str
+from preprocess._meta import LazyMeta
+from preprocess._incremental import read_examples
 
 class MultipleOptimizer(object):
     def __init__(self, *op):
@@ -37,6 +40,10 @@ class MultipleOptimizer(object):
             list_of_state_dict.append(op.state_dict())
         return list_of_state_dict
 
+    def load_state_dict(self, list_of_state_dict):
+        for op, state_dict in zip(self.optimizers, list_of_state_dict):
+            op.load_state_dict(state_dict)
+
 class MultipleScheduler(object):
     def __init__(self, Scheduler, *ops, **kwargs):
         self._optimizers = ops
@@ -46,6 +53,13 @@ class MultipleScheduler(object):
         for sl in self._schedulers:
             sl.step(val)
 
+    def state_dict(self):
+        return [sl.state_dict() for sl in self._schedulers]
+
+    def load_state_dict(self, list_of_state_dict):
+        for sl, state_dict in zip(self._schedulers, list_of_state_dict):
+            sl.load_state_dict(state_dict)
+
 class Args(object):
     pass
 
@@ -119,6 +133,10 @@ class NarreExperiment(Experiment):
         self.build_scheduler() #self.scheduler
         self.build_loss_func() #self.loss_func
 
+        # resume
+        if self.args.resume_path:
+            self.load(self.args.resume_path)
+
         # print
         self.print_args()
         self.print_model_stats()
@@ -159,16 +177,20 @@ class NarreExperiment(Experiment):
             word_pretrained=None
 
         self.model = SimpleSiamese(embedding_dim=self.args.embedding_dim, 
-                             latent_dim=self.args.latent_dim, vocab_size=len(_dataset.word_vocab), 
+                             latent_dim=self.args.latent_dim, vocab_size=_dataset.vocab_size, 
                              user_size=_dataset.user_num, item_size=_dataset.item_num,  
                              pretrained_embeddings=word_pretrained, freeze_embeddings=self.args.freeze_embeddings,
                              dropout=self.args.dropout, word_dropout=self.args.word_dropout, review_dropout=self.args.review_dropout,
                              use_ui_bias=self.args.use_ui_bias,
-                             latent_transform=self.args.latent_transform)
+                             latent_transform=self.args.latent_transform,
+                             embedding_bag=self.args.embedding_bag)
         if self.args.parallel:
             self.model = torch.nn.DataParallel(self.model)
             self.print_write_to_log("the model is parallel training.")
         self.model.to(self.device)
+        if self.args.compile:
+            compile_model(self.model)
+            self.print_write_to_log("the model is compiled by torch.compile.")
 
     def build_optimizer(self):
         def get_sparse_and_dense_parameters(model):
@@ -200,6 +222,25 @@ class NarreExperiment(Experiment):
 
 
 
+    def forward_batch(self, batch):
+        """
+        Args:
+            batch: outputs of `NarreDataset.collate_fn`, padded or `RaggedReviews` (`ragged_reviews` of the config)
+
+        Returns:
+            y_pred: [bz]
+            ratings: [bz]
+        """
+        batch = [x.to(self.device) for x in batch]
+        ratings = batch[-1]
+        if self.args.ragged_reviews:
+            u_reviews, i_reviews, u_ids, i_ids, _ = batch
+            model = self.model.module if isinstance(self.model, torch.nn.DataParallel) else self.model
+            y_pred, _, _ = model.forward_ragged(u_reviews, i_reviews, u_ids, i_ids)
+        else:
+            y_pred, _, _ = self.model(*batch[:-1])
+        return y_pred, ratings
+
     def train_one_epoch(self, current_epoch):
         avg_loss = AvgMeters()
         square_error = 0.
@@ -207,28 +248,21 @@ class NarreExperiment(Experiment):
         start_time = time.time()
 
         self.model.train()
-        for i, (u_revs, i_revs, u_rev_word_masks, i_rev_word_masks, u_rev_masks, i_rev_masks, u_ids, i_ids, ratings) in enumerate(self.train_dataloader):
+        for i, batch in enumerate(self.profiler.wrap(self.train_dataloader)):
             if i == 0 and current_epoch == 0:
-                print("u_revs", u_revs.shape, "i_revs", i_revs.shape)
-            u_revs = u_revs.to(self.device)
-            i_revs = i_revs.to(self.device)
-            u_rev_word_masks = u_rev_word_masks.to(self.device)
-            i_rev_word_masks = i_rev_word_masks.to(self.device)
-            u_rev_masks = u_rev_masks.to(self.device)
-            i_rev_masks = i_rev_masks.to(self.device)
-            u_ids = u_ids.to(self.device)
-            i_ids = i_ids.to(self.device)
-            ratings = ratings.to(self.device)
-
-            self.optimizer.zero_grad()
-            y_pred, _, _ = self.model(u_revs, i_revs, u_rev_word_masks, i_rev_word_masks, u_rev_masks, i_rev_masks, 
-                                u_ids, i_ids)
+                if self.args.ragged_reviews:
+                    print("u_tokens", batch[0].tokens.shape, "i_tokens", batch[1].tokens.shape)
+                else:
+                    print("u_revs", batch[0].shape, "i_revs", batch[1].shape)
+
+            batch = [x.to(self.device) for x in batch]
+            self.profiler.mark("h2d")
+
+            y_pred, ratings = self.forward_batch(batch)
             #y_pred = self.model(u_id, i_id)
             loss = self.loss_func(y_pred, ratings)
-            loss.backward()
-
-            gnorm = nn.utils.clip_grad_norm_(self.model.parameters(), self.args.max_grad_norm)
-            self.optimizer.step()
+            self.profiler.mark("forward")
+            gnorm = self.optimize(loss, i, len(self.train_dataloader))
 
             # val 
             avg_loss.update(loss.mean().item())
@@ -251,41 +285,26 @@ class NarreExperiment(Experiment):
                 accum_count = 0
                 start_time = time.time()
 
-    def valid_one_epoch(self):
-        square_error = 0.
-        accum_count = 0
-        avg_loss = AvgMeters()
-
-        self.model.eval()
-        for i,  (u_revs, i_revs, u_rev_word_masks, i_rev_word_masks, u_rev_masks, i_rev_masks, u_ids, i_ids, ratings) in enumerate(self.valid_dataloader):
-            u_revs = u_revs.to(self.device)
-            i_revs = i_revs.to(self.device)
-            u_rev_word_masks = u_rev_word_masks.to(self.device)
-            i_rev_word_masks = i_rev_word_masks.to(self.device)
-            u_rev_masks = u_rev_masks.to(self.device)
-            i_rev_masks = i_rev_masks.to(self.device)
-            u_ids = u_ids.to(self.device)
-            i_ids = i_ids.to(self.device)
-            ratings = ratings.to(self.device)
-
-            with torch.no_grad():
-                y_pred, _, _ = self.model(u_revs, i_revs, u_rev_word_masks, i_rev_word_masks, u_rev_masks, i_rev_masks, 
-                                u_ids, i_ids)
-                loss = self.loss_func(y_pred, ratings)
-
-            square_error += loss.mean().item() * ratings.size(0)
-            accum_count += ratings.size(0)
-            avg_loss.update(loss.mean().item())
+            self.profiler.step(ratings.size(0), self.updates)
 
-        rmse = math.sqrt(square_error / accum_count)
+    def valid_one_epoch(self, epoch, metrics=None, model_state=None):
+        """
+        Args:
+            epoch: last finished epoch of the validated weights, saved with the best model
+            metrics, model_state: the result of an `AsyncEvaluator` and the weights it evaluated, default to
+                evaluating the current model
+        """
+        if metrics is None:
+            metrics = self.evaluate(self.valid_dataloader)
+        rmse = metrics["rmse"]
         if rmse < self.best_rmse:
             self.best_rmse =  rmse 
-            self.save("best_model.pt")
+            self.save("best_model.pt", epoch=epoch, model_state=model_state)
             self.patience = 0
         else:
             self.patience += 1
 
-        log_text =  "valid loss: {:.3f}, valid rmse: {:.3f}, best rmse: {:.3f}".format(avg_loss.val, rmse, self.best_rmse)
+        log_text =  "valid loss: {:.3f}, valid rmse: {:.3f}, valid mae: {:.3f}, best rmse: {:.3f}".format(metrics["mse"], rmse, metrics["mae"], self.best_rmse)
         self.print_write_to_log(log_text)
 
         # ealry stop
@@ -310,9 +329,14 @@ class NarreExperiment(Experiment):
 
     def train(self):
         print("start training ...")
-        for epoch in range(self.args.epochs):
-            self.valid_one_epoch()
+        for epoch in range(self.start_epoch, self.args.epochs):
+            if hasattr(self.train_dataloader.dataset, "set_epoch"):
+                self.train_dataloader.dataset.set_epoch(epoch)
+            # the weights at the end of the former epoch
+            self.validate(epoch - 1)
             self.train_one_epoch(epoch)
+            self.save(epoch=epoch)
+        self.wait_validation()
 
 class NarreDatasetSameUIReviewNum(torch.utils.data.Dataset):
     def __init__(self, args, set_name):
@@ -320,68 +344,119 @@ class NarreDatasetSameUIReviewNum(torch.utils.data.Dataset):
 
         self.args = args
         self.set_name = set_name
-        param_path = os.path.join(self.args.data_dir, "meta.pkl")
-        with open(param_path, "rb") as f:
-            para = pickle.load(f)
-
-        self.user_num = para['user_num']
-        self.item_num = para['item_num']
-        self.indexlizer = para['indexlizer']
-        self.rv_num = para["rv_num"]
-        self.rv_len = para["rv_len"]
-        self.u_text = para['user_reviews']
-        self.i_text = para['item_reviews']
-        self.u_rids = para["user_rids"]
-        self.i_rids = para["item_rids"]
-        self.word_vocab = self.indexlizer._vocab
+        # only the header is read here, the other components of the meta are loaded on first access
+        self.meta = LazyMeta(self.args.data_dir)
+
+        self.user_num = self.meta["user_num"]
+        self.item_num = self.meta["item_num"]
+        self.rv_num = self.meta["rv_num"]
+        self.rv_len = self.meta["rv_len"]
+        self.vocab_size = self.meta["vocab_size"]
 
         self.sample_train_review = self.args.sample_train_review
         self.u_rv_num = self.args.u_rv_num
         self.i_rv_num = self.args.i_rv_num
 
         example_path = os.path.join(self.args.data_dir, f"{set_name}_exmaples.pkl")
-        with open(example_path, "rb") as f:
-            self.examples = pickle.load(f)
+        # the examples of the deltas are appended to the file, see `read_examples`
+        self.examples = read_examples(example_path)
 
-    def uniform_sample_reviews(self, revs, rv_num):
-        non_zero_indicies = np.nonzero(np.sum(revs, axis=1))[0]
-        np.random.shuffle(non_zero_indicies)
+        if self.set_name == "train":
+            # the ui review of every example, negatives are gathered from it by index
+            self.ui_revs = np.asarray([exp[-1] for exp in self.examples], dtype=np.int64) #[N, rv_len]
+            self.neg_sampling = self.args.neg_sampling
+            self.negative_sampler = NegativeSampler([exp[1] for exp in self.examples], 
+                                                    mode=self.neg_sampling, alpha=self.args.neg_alpha)
+
+        if self.set_name == "train" and self.sample_train_review:
+            u_ids = [exp[0] for exp in self.examples]
+            i_ids = [exp[1] for exp in self.examples]
+            self.u_rev_store, self.u_rev_rows, self.u_rev_counts = self.build_review_store(self.meta["user_reviews"], self.meta["user_rids"], u_ids, i_ids)
+            self.i_rev_store, self.i_rev_rows, self.i_rev_counts = self.build_review_store(self.meta["item_reviews"], self.meta["item_rids"], i_ids, u_ids)
+            self.set_epoch(0)
+
+    def build_review_store(self, id2reviews, id2rids, own_ids, excluded_rids):
+        """
+        Store every review once and describe the candidate reviews of each example by row indices.
+        Args:
+            id2reviews: RaggedArray, user (item) id -> indexed reviews with shape of [num, rv_len]
+            id2rids: RaggedArray, user (item) id -> item (user) ids, aligned with `id2reviews`
+            own_ids: list with length N, user (item) id of each example
+            excluded_rids: list with length N, item (user) id of each example, the ui review is not a candidate
+
+        Returns:
+            rev_store: np.ndarray with shape of [num_reviews+1, rv_len], row 0 is the padded review
+            rev_rows: np.ndarray with shape of [N, rv_num], the non-empty candidates first, then 0
+            rev_counts: np.ndarray with shape of [N], number of non-empty candidates
+        """
+        # the flat reviews of the meta already are a store, only the padded row is prepended
+        rev_store = np.concatenate([np.zeros((1, self.rv_len), dtype=np.int32), id2reviews.data])
+        is_non_empty = rev_store.any(axis=1)
+
+        rev_rows = np.zeros((len(own_ids), self.rv_num), dtype=np.int64)
+        rev_counts = np.zeros(len(own_ids), dtype=np.int64)
+        for n, (_id, excluded_rid) in enumerate(zip(own_ids, excluded_rids)):
+            # same candidates as the example: all reviews but the ui one, truncated to rv_num
+            rows = list(id2reviews.rows(_id) + 1)
+            rows.pop(list(id2rids[_id]).index(excluded_rid))
+            rows = [row for row in rows[:self.rv_num] if is_non_empty[row]]
+            rev_rows[n, :len(rows)] = rows
+            rev_counts[n] = len(rows)
+
+        return rev_store, rev_rows, rev_counts
 
-        new_revs = []
-        for i, idx in enumerate(non_zero_indicies):
-            if i < rv_num:
-                new_revs.append(revs[idx])
-        
-        if len(new_revs) < rv_num:
-            new_revs += [[0] * self.rv_len] * (rv_num - len(new_revs))
+    @staticmethod
+    def uniform_sample_reviews(rev_rows, rev_counts, rv_num):
+        """
+        Sample `rv_num` non-empty candidates of every example without replacement, with one batched permutation.
+        Args:
+            rev_rows: np.ndarray with shape of [N, max_rv_num]
+            rev_counts: np.ndarray with shape of [N]
+
+        Returns:
+            sampled_rows: np.ndarray with shape of [N, rv_num], 0 (the padded review) after the sampled ones
+        """
+        num_examples, max_rv_num = rev_rows.shape
+        if rv_num > max_rv_num:
+            rev_rows = np.pad(rev_rows, ((0, 0), (0, rv_num - max_rv_num)))
+
+        sort_keys = np.random.random(rev_rows.shape)
+        sort_keys[np.arange(rev_rows.shape[1])[None, :] >= rev_counts[:, None]] = 2. # padding goes last
+        permutation = np.argsort(sort_keys, axis=1)[:, :rv_num]
+
+        return np.take_along_axis(rev_rows, permutation, axis=1)
+
+    def set_epoch(self, epoch):
+        """
+        Resample the reviews of the whole dataset, called in the main process at the beginning of each epoch,
+        so DataLoader workers only gather rows from the review stores.
+        """
+        if self.set_name == "train" and self.sample_train_review:
+            self.u_sampled_rows = self.uniform_sample_reviews(self.u_rev_rows, self.u_rev_counts, self.u_rv_num)
+            self.i_sampled_rows = self.uniform_sample_reviews(self.i_rev_rows, self.i_rev_counts, self.i_rv_num)
+
+    @property
+    def indexlizer(self):
+        return self.meta["indexlizer"]
 
-        return new_revs
+    @property
+    def word_vocab(self):
+        return self.indexlizer._vocab
 
     def __getitem__(self, i):
         # for each review(u_text or i_text) [...] 
         # NOTE: not padding 
         if self.set_name == "train":
             u_id, i_id, rating, u_revs, i_revs, u_rids, i_rids, _ = self.examples[i]
-            #print("org: ", u_revs[:4])
             if self.sample_train_review:
-                u_revs = self.uniform_sample_reviews(u_revs, self.u_rv_num)
-                i_revs = self.uniform_sample_reviews(i_revs, self.i_rv_num)
-            #print("after: ", u_revs[:4])
-            
-            
-            neg_idx = random.randint(0, len(self.examples)-1) 
-            while self.examples[neg_idx][1] == i_id:
-                neg_idx = random.randint(0, len(self.examples)-1)
-            neg_ui_rev = self.examples[neg_idx][-1]
+                u_revs = self.u_rev_store[self.u_sampled_rows[i]]
+                i_revs = self.i_rev_store[self.i_sampled_rows[i]]
 
-
-            ui_label = 1. 
-            neg_ui_label = 0.
-
-            return u_id, i_id, rating, u_revs, i_revs, u_rids, i_rids, ui_rev, neg_ui_rev, ui_label, neg_ui_label      
+            # ui review and negatives are gathered for the whole batch in `train_collate_fn`
+            return u_id, i_id, rating, u_revs, i_revs, u_rids, i_rids, i
 
         else:
-            u_id, i_id, rating, u_revs, i_revs, u_rids, i_rids, _, _ = self.examples[i]
+            u_id, i_id, rating, u_revs, i_revs, u_rids, i_rids = self.examples[i]
             return u_id, i_id, rating, u_revs, i_revs, u_rids, i_rids
         
     def __len__(self):
@@ -408,19 +483,44 @@ class NarreDatasetSameUIReviewNum(torch.utils.data.Dataset):
 
         return masks.bool()
 
+    def sample_negative_reviews(self, example_indices, i_ids):
+        """
+        Args:
+            example_indices: np.ndarray with shape of [bz]
+            i_ids: np.ndarray with shape of [bz]
+
+        Returns:
+            ui_revs: np.ndarray with shape of [bz, rv_len]
+            neg_ui_revs: np.ndarray with shape of [bz, rv_len], ui reviews of other items
+        """
+        ui_revs = self.ui_revs[example_indices]
+        if self.neg_sampling == "in_batch":
+            neg_rows = self.negative_sampler.sample_in_batch(i_ids)
+            neg_ui_revs = ui_revs[neg_rows]
+            no_neg_rows = neg_rows < 0
+            if no_neg_rows.any():
+                neg_ui_revs[no_neg_rows] = self.ui_revs[self.negative_sampler.sample(i_ids[no_neg_rows])]
+        else:
+            neg_ui_revs = self.ui_revs[self.negative_sampler.sample(i_ids)]
+
+        return ui_revs, neg_ui_revs
+
     def train_collate_fn(self, batch):
-        u_ids, i_ids, ratings, u_revs, i_revs, u_rids, i_rids, ui_revs, neg_ui_revs, ui_labels, neg_ui_labels = zip(*batch)
+        u_ids, i_ids, ratings, u_revs, i_revs, u_rids, i_rids, example_indices = zip(*batch)
+        ui_revs, neg_ui_revs = self.sample_negative_reviews(np.asarray(example_indices), np.asarray(i_ids))
+        bz = len(ratings)
+
         u_ids = LongTensor(u_ids)
         i_ids = LongTensor(i_ids)
         ratings = FloatTensor(ratings)
-        u_revs = LongTensor(u_revs)
-        i_revs = LongTensor(i_revs)
+        u_revs = torch.as_tensor(np.asarray(u_revs), dtype=torch.long)
+        i_revs = torch.as_tensor(np.asarray(i_revs), dtype=torch.long)
         u_rids = LongTensor(u_rids)
         i_rids = LongTensor(i_rids)
-        ui_revs = LongTensor(ui_revs) 
-        neg_ui_revs = LongTensor(neg_ui_revs)
-        ui_labels = FloatTensor(ui_labels)
-        neg_ui_labels = FloatTensor(neg_ui_labels)
+        ui_revs = torch.from_numpy(ui_revs)
+        neg_ui_revs = torch.from_numpy(neg_ui_revs)
+        ui_labels = torch.ones(bz)
+        neg_ui_labels = torch.zeros(bz)
 
         u_rev_word_masks = get_mask(u_revs)
         i_rev_word_masks = get_mask(i_revs)
@@ -456,29 +556,43 @@ class NarreDataset(torch.utils.data.Dataset):
 
         self.args = args
         self.set_name = set_name
-        param_path = os.path.join(self.args.data_dir, "meta.pkl")
-        with open(param_path, "rb") as f:
-            para = pickle.load(f)
-
-        self.user_num = para['user_num']
-        self.item_num = para['item_num']
-        self.indexlizer = para['indexlizer']
-        self.rv_num = para["rv_num"]
-        self.rv_len = para["rv_len"]
-        self.u_text = para['user_reviews']
-        self.i_text = para['item_reviews']
-        self.u_rids = para["user_rids"]
-        self.i_rids = para["item_rids"]
-        self.word_vocab = self.indexlizer._vocab
+        # only the header is read here, the other components of the meta are loaded on first access
+        self.meta = LazyMeta(self.args.data_dir)
+
+        self.user_num = self.meta["user_num"]
+        self.item_num = self.meta["item_num"]
+        self.rv_num = self.meta["rv_num"]
+        self.rv_len = self.meta["rv_len"]
+        self.vocab_size = self.meta["vocab_size"]
 
         example_path = os.path.join(self.args.data_dir, f"{set_name}_exmaples.pkl")
-        with open(example_path, "rb") as f:
-            self.examples = pickle.load(f)
+        # the examples of the deltas are appended to the file, see `read_examples`
+        self.examples = read_examples(example_path)
 
+        # number of reviews of each example, used to group similar review counts in a batch
+        self.lengths = np.maximum(self.get_review_nums(self.examples, 3), self.get_review_nums(self.examples, 4))
+
+        if self.args.ragged_reviews:
+            # the reviews are stored without padding, the examples keep the ids and the rating
+            self.u_reviews = self.build_ragged_reviews(self.examples, 3)
+            self.i_reviews = self.build_ragged_reviews(self.examples, 4)
+            self.examples = [tuple(exp[:3]) for exp in self.examples]
+
+    @property
+    def indexlizer(self):
+        return self.meta["indexlizer"]
+
+    @property
+    def word_vocab(self):
+        return self.indexlizer._vocab
 
     def __getitem__(self, i):
         # for each review(u_text or i_text) [...] 
         # NOTE: not padding 
+        if self.args.ragged_reviews:
+            u_id, i_id, rating = self.examples[i]
+            return u_id, i_id, rating, self.u_reviews[i], self.i_reviews[i]
+
         if self.set_name == "train":
             u_id, i_id, rating, u_revs, i_revs, u_rids, i_rids, _= self.examples[i]
 
@@ -512,16 +626,58 @@ class NarreDataset(torch.utils.data.Dataset):
 
         return masks.bool()
 
+    @staticmethod
+    def get_review_nums(examples, field):
+        """
+        Args:
+            examples: list of examples, `exp[field]` is a list of rv_num padded reviews
+
+        Returns:
+            review_nums: np.ndarray with shape of [num_examples], 1 + the position of the last non-empty review
+        """
+        nonempty = np.array([[rev[0] for rev in exp[field]] for exp in examples], dtype=np.int64).reshape(len(examples), -1) != 0
+        return np.where(nonempty.any(axis=1), nonempty.shape[1] - np.argmax(nonempty[:, ::-1], axis=1), 0)
+
+    @staticmethod
+    def build_ragged_reviews(examples, field, chunk_size=4096):
+        """
+        Returns:
+            reviews: RaggedReviews of `exp[field]` of all the examples, converted by chunks of padded arrays
+        """
+        return RaggedReviews.cat([RaggedReviews.from_padded(np.array([exp[field] for exp in examples[k:k+chunk_size]], dtype=np.int32))
+                                    for k in range(0, len(examples), chunk_size)])
+
+    @staticmethod
+    def truncate_reviews(revs, rids):
+        """
+        Drop the review columns which are empty for the whole batch.
+        Args:
+            revs: LongTensor with shape of [bz, rv_num, rv_len]
+            rids: LongTensor with shape of [bz, rv_num]
+
+        Returns:
+            revs: LongTensor with shape of [bz, max(most reviews in batch, 1), rv_len]
+            rids: LongTensor with shape of [bz, max(most reviews in batch, 1)]
+        """
+        nonempty_cols = revs[:, :, 0].ne(0).any(dim=0).nonzero()
+        rv_num = int(nonempty_cols.max()) + 1 if len(nonempty_cols) > 0 else 1
+        return revs[:, :rv_num].contiguous(), rids[:, :rv_num].contiguous()
+
     def collate_fn(self, batch):
+        if self.args.ragged_reviews:
+            return self.ragged_collate_fn(batch)
         u_ids, i_ids, ratings, u_revs, i_revs, u_rids, i_rids = zip(*batch)
         
         u_ids = LongTensor(u_ids)
         i_ids = LongTensor(i_ids)
         ratings = FloatTensor(ratings)
-        u_revs = LongTensor(u_revs)
-        i_revs = LongTensor(i_revs)
+        # nested lists -> ndarray is faster than `LongTensor`
+        u_revs = torch.from_numpy(np.array(u_revs, dtype=np.int64))
+        i_revs = torch.from_numpy(np.array(i_revs, dtype=np.int64))
         u_rids = LongTensor(u_rids)
         i_rids = LongTensor(i_rids)
+        u_revs, u_rids = self.truncate_reviews(u_revs, u_rids)
+        i_revs, i_rids = self.truncate_reviews(i_revs, i_rids)
 
         u_rev_word_masks = get_mask(u_revs)
         i_rev_word_masks = get_mask(i_revs)
@@ -530,6 +686,11 @@ class NarreDataset(torch.utils.data.Dataset):
 
         return u_revs, i_revs, u_rev_word_masks, i_rev_word_masks, u_rev_masks, i_rev_masks, u_ids, i_ids, ratings
 
+    def ragged_collate_fn(self, batch):
+        u_ids, i_ids, ratings, u_reviews, i_reviews = zip(*batch)
+
+        return RaggedReviews.cat(u_reviews), RaggedReviews.cat(i_reviews), LongTensor(u_ids), LongTensor(i_ids), FloatTensor(ratings)
+
 
 if __name__ == "__main__":
     config_file = "./models/simple_siamese/defalut_simple_train.json"
@@ -537,9 +698,21 @@ if __name__ == "__main__":
     train_dataset = NarreDataset(args, "train")
     valid_dataset = NarreDataset(args, "test")
 
-    train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=train_dataset.collate_fn, num_workers=4)
-    valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=valid_dataset.collate_fn, num_workers=4)
-
-    dataloaders = {"train": train_dataloder, "valid": valid_dataloader, "test": None}
+    if args.sort_by_length:
+        train_sampler = LengthSortedBatchSampler(train_dataset.lengths, args.batch_size, shuffle=True)
+        valid_sampler = LengthSortedBatchSampler(valid_dataset.lengths, args.batch_size, shuffle=False)
+        train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=train_dataset.collate_fn, num_workers=4)
+        valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_sampler=valid_sampler, collate_fn=valid_dataset.collate_fn, num_workers=4)
+    else:
+        train_dataloder = torch.utils.data.DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, collate_fn=train_dataset.collate_fn, num_workers=4)
+        valid_dataloader = torch.utils.data.DataLoader(valid_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=valid_dataset.collate_fn, num_workers=4)
+
+    # the model is selected on the test set, `test` reports the metrics of the best checkpoint on it
+    test_dataloader = valid_dataloader
+    dataloaders = {"train": train_dataloder, "valid": valid_dataloader, "test": test_dataloader}
     experiment = NarreExperiment(args, dataloaders)
-    experiment.train()
\ No newline at end of file
+    try:
+        experiment.train()
+    except EarlyStop:
+        pass
+    experiment.test()
\ No newline at end of file
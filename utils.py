@@ -1,4 +1,6 @@
+import numpy as np
 import torch
+import torch.nn as nn
 import torch.nn.functional as F 
 
 def masked_softmax(input_scores, input_masks):
@@ -27,6 +29,331 @@ def attention_weighted_sum(input_weights, inputs):
     outputs = torch.sum(input_weights * inputs, dim=1)
     return outputs
 
+def _masked_mean_weights(inputs, input_masks):
+    weights = input_masks.to(inputs.dtype)
+    return weights / (weights.sum(dim=1, keepdim=True) + 1e-8) #[bz, seq_len]
+
+def _masked_max(inputs, input_masks):
+    outputs, indices = torch.max(torch.masked_fill(inputs, ~input_masks.unsqueeze(1), float("-inf")), dim=2, keepdim=True)
+    empty_rows = ~input_masks.any(dim=1).view(-1, 1, 1)
+    return torch.masked_fill(outputs, empty_rows, 0.), indices, empty_rows
+
+class _MaskedMeanPool1d(torch.autograd.Function):
+    """
+    The mean is a batched matmul of `inputs` by the normalized mask, no masked copy of `inputs` is made.
+    Only the normalized mask [bz, seq_len] is saved for the backward, not `inputs`.
+    """
+    @staticmethod
+    def forward(ctx, inputs, input_masks):
+        weights = _masked_mean_weights(inputs, input_masks)
+        ctx.save_for_backward(weights)
+        return torch.bmm(inputs, weights.unsqueeze(2))
+
+    @staticmethod
+    def backward(ctx, grad_outputs):
+        weights, = ctx.saved_tensors
+        return grad_outputs * weights.unsqueeze(1), None
+
+class _MaskedMaxPool1d(torch.autograd.Function):
+    """
+    Only the argmax [bz, hidden_dim, 1] is saved for the backward, the masked copy of `inputs` is freed in the forward.
+    """
+    @staticmethod
+    def forward(ctx, inputs, input_masks):
+        outputs, indices, empty_rows = _masked_max(inputs, input_masks)
+        ctx.save_for_backward(indices, empty_rows)
+        ctx.seq_len = inputs.size(2)
+        return outputs
+
+    @staticmethod
+    def backward(ctx, grad_outputs):
+        indices, empty_rows = ctx.saved_tensors
+        grad_outputs = torch.masked_fill(grad_outputs, empty_rows, 0.)
+        grad_inputs = grad_outputs.new_zeros(grad_outputs.size(0), grad_outputs.size(1), ctx.seq_len)
+        return grad_inputs.scatter_(2, indices, grad_outputs), None
+
+def masked_mean_pool1d(inputs, input_masks):
+    """
+    Mean pooling over the valid positions only, replaces `MaskedAvgPooling1d` and `masked_colwise_mean` of the models.
+    Args:
+        inputs: [bz, hidden_dim, seq_len]
+        input_masks: [bz, seq_len] BoolTensor
+
+    Returns:
+        outputs: [bz, hidden_dim, 1], rows without any valid position are 0.
+    """
+    assert input_masks.dim() == 2
+    if torch.jit.is_tracing():
+        # a custom autograd function can not be exported, the forward is traced as is
+        return torch.bmm(inputs, _masked_mean_weights(inputs, input_masks).unsqueeze(2))
+    return _MaskedMeanPool1d.apply(inputs, input_masks)
+
+def masked_max_pool1d(inputs, input_masks):
+    """
+    Max pooling over the valid positions only, so the output of a sequence does not depend on
+    how much padding its batch carries.
+    Args:
+        inputs: [bz, hidden_dim, seq_len]
+        input_masks: [bz, mask_len] BoolTensor with mask_len >= seq_len, only the first `seq_len`
+            positions are used (e.g. the valid window starts of a convolution without padding).
+
+    Returns:
+        outputs: [bz, hidden_dim, 1], rows without any valid position are 0.
+    """
+    input_masks = input_masks[:, :inputs.size(2)]
+    if torch.jit.is_tracing():
+        return _masked_max(inputs, input_masks)[0]
+    return _MaskedMaxPool1d.apply(inputs, input_masks)
+
+def pack_rows(row_masks):
+    """
+    Indices to run a layer only on the rows of a padded batch where `row_masks` is True (e.g. the non-empty reviews
+    of `[bz*rv_num, rv_len]`), and to put its outputs back in place with `unpack_rows`. The first row is always
+    packed last, so the packed batch is never empty.
+    Args:
+        row_masks: BoolTensor with shape of [num_rows]
+
+    Returns:
+        packed_idxs: LongTensor with shape of [num_packed+1]
+        restoration_idxs: LongTensor with shape of [num_rows], offset of each row in the packed batch, the rows
+            which are not packed point to another row and are zeroed by `unpack_rows`
+    """
+    packed_idxs = torch.cat([row_masks.nonzero().squeeze(1), row_masks.new_zeros(1, dtype=torch.long)])
+    restoration_idxs = torch.clamp(row_masks.long().cumsum(0) - 1, min=0)
+    return packed_idxs, restoration_idxs
+
+def unpack_rows(packed_outputs, restoration_idxs, row_masks):
+    """
+    Args:
+        packed_outputs: [num_packed+1, *]
+        restoration_idxs, row_masks: see `pack_rows`
+
+    Returns:
+        outputs: [num_rows, *], 0 for the rows which are not packed
+    """
+    outputs = packed_outputs.index_select(0, restoration_idxs)
+    return torch.masked_fill(outputs, ~row_masks.view(-1, *[1] * (outputs.dim() - 1)), 0.)
+
+def _offsets_from_counts(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return torch.from_numpy(offsets)
+
+class RaggedReviews(object):
+    """
+    Reviews of a batch (or of a whole set) without padding: a flat buffer of the tokens and one offsets array
+    per level, from the examples down to the tokens. The empty reviews (sentences) are dropped.
+    Args:
+        tokens: IntTensor with shape of [num_tokens]
+        offsets: list of LongTensor, `offsets[0]` [bz+1] are the offsets of the reviews of each example,
+            `offsets[-1]` [num_segments+1] the offsets of the tokens of each review (word level) or of each
+            sentence (sentence level, then `offsets[1]` are the offsets of the sentences of each review)
+
+    e.g. the reviews of example k are `offsets[0][k]` to `offsets[0][k+1]`, the tokens of review r (word level)
+    are `tokens[offsets[1][r]:offsets[1][r+1]]`.
+    """
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = list(offsets)
+
+    @classmethod
+    def from_padded(cls, revs, padding_idx=0):
+        """
+        Args:
+            revs: np.ndarray with shape of [bz, rv_num, rv_len] or [bz, rv_num, sent_num, sent_len]
+        """
+        nonempty = revs != padding_idx
+        tokens = torch.from_numpy(np.ascontiguousarray(revs[nonempty], dtype=np.int32))
+        offsets = []
+        counts = nonempty.sum(axis=-1)
+        while counts.ndim > 1:
+            kept = counts > 0
+            offsets.insert(0, _offsets_from_counts(counts[kept]))
+            counts = kept.sum(axis=-1)
+        offsets.insert(0, _offsets_from_counts(counts))
+        return cls(tokens, offsets)
+
+    @classmethod
+    def cat(cls, list_of_reviews):
+        """
+        Concatenate the examples of `list_of_reviews`, the offsets of each one are rebased on the previous ones.
+        """
+        tokens = torch.cat([x.tokens for x in list_of_reviews])
+        offsets = []
+        for level in range(len(list_of_reviews[0].offsets)):
+            parts = [x.offsets[level] for x in list_of_reviews]
+            shifts = np.cumsum([0] + [int(part[-1]) for part in parts[:-1]])
+            offsets.append(torch.cat([parts[0].new_zeros(1)] + [part[1:] + shift for part, shift in zip(parts, shifts)]))
+        return cls(tokens, offsets)
+
+    def __len__(self):
+        return len(self.offsets[0]) - 1
+
+    def __getitem__(self, idx):
+        """
+        Returns:
+            the RaggedReviews of example `idx`, its tokens and offsets are views of `self` (rebased offsets apart)
+        """
+        start, end = idx, idx + 1
+        offsets = []
+        for level in self.offsets:
+            offsets.append(level[start:end+1] - level[start])
+            start, end = int(level[start]), int(level[end])
+        return RaggedReviews(self.tokens[start:end], offsets)
+
+    @property
+    def review_offsets(self):
+        return self.offsets[0]
+
+    @property
+    def token_offsets(self):
+        return self.offsets[-1]
+
+    def to(self, device):
+        return RaggedReviews(self.tokens.to(device), [x.to(device) for x in self.offsets])
+
+    def pin_memory(self):
+        return RaggedReviews(self.tokens.pin_memory(), [x.pin_memory() for x in self.offsets])
+
+    def to_padded(self):
+        """
+        Returns:
+            revs: LongTensor with shape of [bz, max review num, max review len], word level only
+        """
+        assert len(self.offsets) == 2, "only the word level reviews can be padded back"
+        review_ids = segment_ids(self.review_offsets)
+        token_review_ids = segment_ids(self.token_offsets)
+        review_positions = torch.arange(len(review_ids)) - self.review_offsets[review_ids]
+        token_positions = torch.arange(len(self.tokens)) - self.token_offsets[token_review_ids]
+
+        revs = torch.zeros(len(self), int(self.review_offsets.diff().max()) if len(review_ids) > 0 else 0,
+                            int(self.token_offsets.diff().max()) if len(self.tokens) > 0 else 0, dtype=torch.long)
+        revs[review_ids[token_review_ids], review_positions[token_review_ids], token_positions] = self.tokens.long()
+        return revs
+
+def segment_ids(offsets):
+    """
+    Args:
+        offsets: LongTensor with shape of [num_segments+1]
+
+    Returns:
+        ids: LongTensor with shape of [offsets[-1]], the segment of each row
+    """
+    return torch.repeat_interleave(torch.arange(len(offsets) - 1, device=offsets.device), offsets.diff())
+
+def segment_sum(inputs, offsets):
+    """
+    Args:
+        inputs: [num_rows, *]
+        offsets: LongTensor with shape of [num_segments+1]
+
+    Returns:
+        outputs: [num_segments, *], 0 for the empty segments
+    """
+    outputs = inputs.new_zeros(len(offsets) - 1, *inputs.shape[1:])
+    return outputs.index_add(0, segment_ids(offsets), inputs)
+
+def segment_max(inputs, offsets):
+    """
+    Args:
+        inputs: [num_rows, *]
+        offsets: LongTensor with shape of [num_segments+1]
+
+    Returns:
+        outputs: [num_segments, *], 0 for the empty segments
+    """
+    ids = segment_ids(offsets).view(-1, *[1] * (inputs.dim() - 1)).expand_as(inputs)
+    outputs = inputs.new_zeros(len(offsets) - 1, *inputs.shape[1:])
+    return outputs.scatter_reduce(0, ids, inputs, reduce="amax", include_self=False)
+
+def segment_softmax(logits, offsets):
+    """
+    Softmax of `logits` within each segment, e.g. the attention weights of the reviews of each example.
+    Args:
+        logits: [num_rows]
+        offsets: LongTensor with shape of [num_segments+1]
+
+    Returns:
+        weights: [num_rows]
+    """
+    ids = segment_ids(offsets)
+    exps = (logits - segment_max(logits.detach(), offsets)[ids]).exp()
+    return exps / segment_sum(exps, offsets)[ids]
+
+def embedding_bag_mean(word_embedding, tokens, offsets=None, padding_idx=0):
+    """
+    Mean of the embeddings of the tokens of each bag (review) with `F.embedding_bag`, the embedding of each
+    token is never materialized.
+    Args:
+        word_embedding: a module with an `nn.Embedding` as `.embedding` (`WordEmbedding` of the models), other
+            embeddings (e.g. `CompressedEmbedding`) are called on `tokens` and averaged
+        tokens: IntTensor or LongTensor with shape of [num_tokens] (ragged, with `offsets`) or
+            [num_bags, bag_len] (padded, the `padding_idx` tokens are left out of the mean)
+        offsets: LongTensor with shape of [num_bags+1]
+
+    Returns:
+        outputs: [num_bags, embedding_dim], 0 for the bags without tokens
+    """
+    tokens = tokens.long()
+    embedding = getattr(word_embedding, "embedding", None)
+    # `F.embedding_bag` with `padding_idx` has no ONNX export, the exported graph uses the masked mean
+    if isinstance(embedding, nn.Embedding) and not torch.onnx.is_in_onnx_export():
+        return F.embedding_bag(tokens, embedding.weight, offsets, mode="mean", sparse=embedding.sparse,
+                                include_last_offset=offsets is not None, padding_idx=None if offsets is not None else padding_idx)
+    if offsets is None:
+        return masked_mean_pool1d(word_embedding(tokens).transpose(1, 2), tokens != padding_idx).squeeze(2)
+    lengths = offsets.diff().clamp(min=1).unsqueeze(1)
+    return segment_sum(word_embedding(tokens), offsets) / lengths
+
+def histogram_summary(values, masks=None, num_bins=50, value_range=(0., 1.), quantiles=(0.05, 0.25, 0.5, 0.75, 0.95), sub_bins=20):
+    """
+    Fixed-bin histogram, quantiles and moments of `values` reduced on their device, without a sync (no boolean
+    indexing, the masked values are weighted by 0) nor a sort: the quantiles are interpolated in a histogram
+    `sub_bins` times finer, up to `(high - low) / (num_bins * sub_bins)`. The values out of `value_range` are
+    counted in the first or the last bin.
+    Args:
+        values: FloatTensor of any shape, e.g. attention weights [bz, rv_num]
+        masks: BoolTensor with the shape of `values`, False for the values to leave out (padding)
+
+    Returns:
+        summary: FloatTensor with shape of [5 + len(quantiles) + num_bins], the number of values, min, max, sum,
+            sum of squares, the quantiles then the counts of the bins, see `split_histogram_summary`
+    """
+    values = values.detach().reshape(-1).float()
+    masks = masks.reshape(-1).bool() if masks is not None else torch.ones_like(values, dtype=torch.bool)
+    weights = masks.float()
+    num = weights.sum()
+    min_val = torch.where(masks, values, values.new_tensor(float("inf"))).min()
+    max_val = torch.where(masks, values, values.new_tensor(float("-inf"))).max()
+
+    low, high = value_range
+    num_fine_bins = num_bins * sub_bins
+    fine_bins = ((values - low) * (num_fine_bins / (high - low))).long().clamp(0, num_fine_bins - 1)
+    fine_counts = values.new_zeros(num_fine_bins).index_add_(0, fine_bins, weights)
+    counts = fine_counts.view(num_bins, sub_bins).sum(dim=1)
+
+    # fine bin of each quantile, then linear within the bin
+    cumulative = torch.cat([fine_counts.new_zeros(1), fine_counts.cumsum(dim=0)])
+    targets = values.new_tensor(quantiles) * num
+    quantile_bins = torch.searchsorted(cumulative[1:], targets).clamp(max=num_fine_bins - 1)
+    fractions = (targets - cumulative[quantile_bins]) / fine_counts[quantile_bins].clamp(min=1)
+    quantile_values = low + (quantile_bins + fractions) * ((high - low) / num_fine_bins)
+    quantile_values = torch.min(torch.max(quantile_values, min_val), max_val)
+
+    moments = torch.stack([num, min_val, max_val, (values * weights).sum(), (values * values * weights).sum()])
+    return torch.cat([moments, quantile_values, counts])
+
+def split_histogram_summary(summary, num_quantiles):
+    """
+    Returns:
+        moments: dict, "num", "min", "max", "sum", "sum_squares"
+        quantile_values: list of float
+        counts: list of float
+    """
+    summary = summary.tolist()
+    moments = dict(zip(["num", "min", "max", "sum", "sum_squares"], summary[:5]))
+    return moments, summary[5:5+num_quantiles], summary[5+num_quantiles:]
+
 def get_mask(tensor, padding_idx=0):
     """
     Get a mask to `tensor`.
@@ -53,6 +380,140 @@ def get_seq_lengths_from_mask(mask_tensor):
     return length_tensor
 
 
+def compile_model(model):
+    """
+    Compile `model` in place with torch.compile (`nn.Module.compile`), so its state dict keeps the same keys
+    as the eager model, unlike the module returned by `torch.compile(model)`.
+    """
+    model.compile()
+    return model
+
+def _kmeans(inputs, num_centroids, num_iters=20, seed=0):
+    """
+    Lloyd's k-means.
+    Args:
+        inputs: FloatTensor with shape of [num_points, dim]
+
+    Returns:
+        centroids: [num_centroids, dim]
+        assignments: LongTensor with shape of [num_points]
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = inputs[torch.randperm(inputs.size(0), generator=generator)[:num_centroids]].clone()
+    for _ in range(num_iters):
+        assignments = torch.cdist(inputs, centroids).argmin(dim=1)
+        counts = torch.bincount(assignments, minlength=num_centroids).unsqueeze(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, inputs)
+        # empty clusters keep their centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids, torch.cdist(inputs, centroids).argmin(dim=1)
+
+class CompressedEmbedding(nn.Module):
+    """
+    Read-only word embedding for inference, replaces a `WordEmbedding` (see `compress.py`): only the rows of
+    the kept vocab ids are stored, the other ids are mapped to `unk_idx`, and the rows are stored as
+        - "fp32": as is (pruning only).
+        - "fp16": half precision.
+        - "int8": int8 codes with a scale per row.
+        - "pq": product quantization, each row is split in `embedding_dim // pq_subdim` sub-vectors, each one stored
+        as the uint8 id of its closest centroid (k-means over the kept rows, `pq_centroids` centroids per subspace).
+    Rows are decoded to fp32 on lookup, the row of `padding_idx` stays zero.
+    """
+    MODES = ["fp32", "fp16", "int8", "pq"]
+
+    def __init__(self, vocab_size, num_rows, embedding_dim, mode="fp16", pq_subdim=4, pq_centroids=256, padding_idx=0):
+        super(CompressedEmbedding, self).__init__()
+        if mode not in self.MODES:
+            raise ValueError(f"{mode} is not predefined")
+        self.vocab_size = vocab_size
+        self.num_rows = num_rows
+        self.embedding_dim = embedding_dim
+        self.mode = mode
+        self.pq_subdim = pq_subdim
+        self.pq_centroids = pq_centroids
+        self.padding_idx = padding_idx
+
+        self.register_buffer("id_map", torch.zeros(vocab_size, dtype=torch.int32))
+        if mode in ["fp32", "fp16"]:
+            self.register_buffer("weight", torch.zeros(num_rows, embedding_dim, dtype=torch.float32 if mode == "fp32" else torch.float16))
+        elif mode == "int8":
+            self.register_buffer("codes", torch.zeros(num_rows, embedding_dim, dtype=torch.int8))
+            self.register_buffer("scales", torch.zeros(num_rows))
+        else:
+            assert embedding_dim % pq_subdim == 0, "`pq_subdim` should divide `embedding_dim`"
+            assert pq_centroids <= 256, "codes are stored as uint8"
+            num_subspaces = embedding_dim // pq_subdim
+            self.register_buffer("codes", torch.zeros(num_rows, num_subspaces, dtype=torch.uint8))
+            self.register_buffer("codebooks", torch.zeros(num_subspaces * pq_centroids, pq_subdim))
+            self.register_buffer("code_offsets", torch.arange(num_subspaces) * pq_centroids, persistent=False)
+
+    def config(self):
+        """
+        Returns:
+            kwargs of `__init__`, to rebuild the module before loading its state dict
+        """
+        return {"vocab_size": self.vocab_size, "num_rows": self.num_rows, "embedding_dim": self.embedding_dim,
+                "mode": self.mode, "pq_subdim": self.pq_subdim, "pq_centroids": self.pq_centroids,
+                "padding_idx": self.padding_idx}
+
+    @classmethod
+    def from_weight(cls, weight, keep_ids, unk_idx, mode="fp16", pq_subdim=4, pq_centroids=256, padding_idx=0):
+        """
+        Args:
+            weight: FloatTensor with shape of [vocab_size, embedding_dim]
+            keep_ids: LongTensor, sorted vocab ids to keep, should contain `padding_idx` and `unk_idx`
+        """
+        vocab_size, embedding_dim = weight.size()
+        keep_ids = torch.as_tensor(keep_ids, dtype=torch.long)
+        rows = weight.detach().float()[keep_ids]
+        pq_centroids = min(pq_centroids, len(keep_ids))
+        module = cls(vocab_size, len(keep_ids), embedding_dim, mode, pq_subdim, pq_centroids, padding_idx)
+
+        id_map = torch.full((vocab_size,), int(torch.searchsorted(keep_ids, unk_idx)), dtype=torch.int32)
+        id_map[keep_ids] = torch.arange(len(keep_ids), dtype=torch.int32)
+        module.id_map.copy_(id_map)
+        if mode in ["fp32", "fp16"]:
+            module.weight.copy_(rows)
+        elif mode == "int8":
+            scales = rows.abs().amax(dim=1) / 127.
+            module.scales.copy_(scales)
+            module.codes.copy_(torch.round(rows / scales.clamp(min=1e-12).unsqueeze(1)).clamp(-127, 127))
+        else:
+            num_subspaces = embedding_dim // pq_subdim
+            for k in range(num_subspaces):
+                centroids, assignments = _kmeans(rows[:, k*pq_subdim:(k+1)*pq_subdim], pq_centroids, seed=k)
+                module.codebooks[k*pq_centroids:(k+1)*pq_centroids] = centroids
+                module.codes[:, k] = assignments
+        return module
+
+    def forward(self, inputs):
+        rows = self.id_map[inputs].long()
+        if self.mode in ["fp32", "fp16"]:
+            return F.embedding(rows, self.weight).float()
+        if self.mode == "int8":
+            return self.codes[rows].float() * self.scales[rows].unsqueeze(-1)
+
+        codes = self.codes[rows].long() + self.code_offsets #[*, num_subspaces]
+        outputs = F.embedding(codes, self.codebooks).flatten(-2) #[*, embedding_dim]
+        return torch.masked_fill(outputs, (rows == self.id_map[self.padding_idx]).unsqueeze(-1), 0.)
+
+def get_word_embedding_names(model):
+    """
+    Names of the `WordEmbedding` modules of `model` (each model defines its own class).
+    """
+    return [name for name, module in model.named_modules() if type(module).__name__ == "WordEmbedding"]
+
+def replace_word_embeddings(model, configs):
+    """
+    Replace the modules of `model` by empty `CompressedEmbedding`, before loading a compressed state dict.
+    Args:
+        configs: dict, module name -> `CompressedEmbedding.config()`
+    """
+    for name, config in configs.items():
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(model.get_submodule(parent_name), child_name, CompressedEmbedding(**config))
+    return model
+
 if __name__ == "__main__":
     x = torch.BoolTensor([[[1,1,0,0],[1,0,0,0], [1,1,1,0]],
                             [[1,1,1,1], [1,0,0,0], [1,1,0,0]]])